@@ -0,0 +1,136 @@
+"""Pool di istanze Ollama: routing per richieste in corso, health check ed espulsione dei nodi guasti"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaBackend:
+    """Un'istanza Ollama del pool con i suoi contatori"""
+    
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+    
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+    
+    def stats(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": not self.ejected,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejected_for": round(max(0.0, self.ejected_until - time.monotonic()), 1)
+        }
+
+
+class BackendPool:
+    """
+    Sceglie l'istanza Ollama con meno richieste in corso tra quelle sane.
+    
+    Dopo max_failures errori consecutivi (richieste o health check) un nodo viene escluso
+    per eject_seconds. Le sessioni restano sul nodo che ha già il loro prefisso nella
+    KV cache, a meno che non sia escluso o molto più carico degli altri.
+    """
+    
+    def __init__(self, urls: List[str], max_failures: int = 3, eject_seconds: float = 30.0,
+                 affinity_slack: int = 2, max_sessions: int = 256):
+        if not urls:
+            raise ValueError("Serve almeno un URL Ollama")
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, OllamaBackend]" = OrderedDict()
+        self._affinity_hits = 0
+    
+    def pick(self, session_id: Optional[str] = None, exclude: Iterable[OllamaBackend] = ()) -> OllamaBackend:
+        """Nodo per la prossima richiesta (anche se tutti sono esclusi, per non fallire a priori)"""
+        excluded = set(id(backend) for backend in exclude)
+        candidates = [b for b in self.backends if id(b) not in excluded] or self.backends
+        healthy = [b for b in candidates if not b.ejected]
+        if not healthy:
+            # Tutti esclusi: si prova quello che rientra per primo
+            return min(candidates, key=lambda b: b.ejected_until)
+        
+        least_busy = min(healthy, key=lambda b: b.outstanding)
+        preferred = self._sessions.get(session_id) if session_id else None
+        if (
+            preferred is not None
+            and preferred in healthy
+            and preferred.outstanding <= least_busy.outstanding + self.affinity_slack
+        ):
+            self._affinity_hits += 1
+            return preferred
+        return least_busy
+    
+    @contextmanager
+    def lease(self, session_id: Optional[str] = None, exclude: Iterable[OllamaBackend] = ()) -> Iterator[OllamaBackend]:
+        """Riserva un nodo per la durata della richiesta e ne registra l'esito"""
+        backend = self.pick(session_id, exclude)
+        backend.outstanding += 1
+        backend.requests += 1
+        try:
+            yield backend
+        except Exception:
+            self.record_failure(backend)
+            raise
+        else:
+            self.record_success(backend)
+            if session_id:
+                self._bind_session(session_id, backend)
+        finally:
+            backend.outstanding -= 1
+    
+    def record_success(self, backend: OllamaBackend):
+        backend.consecutive_failures = 0
+        if backend.ejected_until:
+            logger.info(f"✅ Nodo Ollama {backend.url} di nuovo disponibile")
+        backend.ejected_until = 0.0
+    
+    def record_failure(self, backend: OllamaBackend):
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.max_failures and not backend.ejected:
+            backend.ejected_until = time.monotonic() + self.eject_seconds
+            logger.warning(f"⚠️ Nodo Ollama {backend.url} escluso per {self.eject_seconds:.0f}s dopo {backend.consecutive_failures} errori")
+    
+    def _bind_session(self, session_id: str, backend: OllamaBackend):
+        self._sessions[session_id] = backend
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+    
+    async def check_health(self, client, path: str = "/api/tags", timeout: float = 5.0):
+        """Interroga tutti i nodi in parallelo e aggiorna il loro stato"""
+        async def check(backend: OllamaBackend):
+            try:
+                response = await client.get(f"{backend.url}{path}", timeout=timeout)
+                if response.status_code == 200:
+                    self.record_success(backend)
+                else:
+                    self.record_failure(backend)
+            except Exception as e:
+                logger.debug(f"Health check fallito per {backend.url}: {e}")
+                self.record_failure(backend)
+        
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+    
+    def stats(self) -> Dict:
+        return {
+            "backends": [backend.stats() for backend in self.backends],
+            "sessions": len(self._sessions),
+            "affinity_hits": self._affinity_hits
+        }
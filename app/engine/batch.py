@@ -0,0 +1,98 @@
+"""
+Esecuzione di lotti di richieste (es. replay di conversazioni salvate).
+
+Le ricerche di fonti uguali tra elementi diversi del lotto vengono fatte una sola volta
+(LookupMemo, attivo tramite contextvar anche nei thread di asyncio.to_thread) e gli
+elementi vengono elaborati con parallelismo limitato, restituiti in ordine di completamento.
+"""
+import asyncio
+import copy
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_memo_scope: ContextVar[Optional["LookupMemo"]] = ContextVar("lookup_memo", default=None)
+
+
+class LookupMemo:
+    """
+    Memo thread-safe delle ricerche: ogni chiave viene calcolata una sola volta,
+    chi la chiede mentre è in corso attende lo stesso risultato.
+    """
+    
+    def __init__(self):
+        self._futures: Dict[Any, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get_or_compute(self, key: Any, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        
+        if owner:
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+        # Copia: i chiamanti modificano i dict restituiti (es. la piattaforma di game_info)
+        return copy.deepcopy(future.result())
+    
+    def stats(self) -> Dict[str, int]:
+        return {"lookups": self.hits + self.misses, "deduplicated": self.hits}
+
+
+@contextmanager
+def memo_scope(memo: LookupMemo) -> Iterator[LookupMemo]:
+    """Attiva il memo per il contesto corrente (e per i thread avviati da qui con to_thread)"""
+    token = _memo_scope.set(memo)
+    try:
+        yield memo
+    finally:
+        _memo_scope.reset(token)
+
+
+def memoized(fn: Callable, *args, **kwargs) -> Any:
+    """Chiama fn riusando il risultato se la stessa chiamata è già stata fatta nel lotto corrente"""
+    memo = _memo_scope.get()
+    if memo is None:
+        return fn(*args, **kwargs)
+    key = (getattr(fn, "__qualname__", repr(fn)), args, tuple(sorted(kwargs.items())))
+    return memo.get_or_compute(key, lambda: fn(*args, **kwargs))
+
+
+async def run_bounded(items: List[Any], worker: Callable[[int, Any], Awaitable[Any]], concurrency: int) -> AsyncIterator[Tuple[int, Any, Optional[Exception]]]:
+    """
+    Esegue worker(indice, elemento) con al massimo concurrency elementi in parallelo
+    e restituisce (indice, risultato, errore) in ordine di completamento.
+    Se il chiamante smette di leggere, gli elementi in corso vengono cancellati.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    pending = iter(enumerate(items))
+    
+    async def run():
+        for index, item in pending:
+            try:
+                queue.put_nowait((index, await worker(index, item), None))
+            except Exception as e:
+                queue.put_nowait((index, None, e))
+    
+    tasks = [asyncio.ensure_future(run()) for _ in range(max(1, min(concurrency, len(items))))]
+    try:
+        for _ in range(len(items)):
+            yield await queue.get()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
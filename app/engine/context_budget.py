@@ -0,0 +1,172 @@
+"""
+Assemblaggio del prompt entro la finestra di contesto di Ollama (num_ctx).
+
+Ogni pezzo di contesto (fonti recuperate, personalizzazione, turni della
+cronologia) riceve una priorità e una stima dei token. I pezzi vengono
+inseriti in ordine di priorità finché c'è spazio: i turni più vecchi della
+cronologia e le fonti meno utili vengono tagliati per primi, invece di lasciare
+che Ollama tronchi il prompt in silenzio.
+"""
+import logging
+import math
+from typing import Dict, List, Tuple, Union
+
+from app.engine.prompt_builder import SYSTEM_PROMPT, CONTEXT_TEMPLATE, NO_CONTEXT_GUIDANCE
+
+logger = logging.getLogger(__name__)
+
+# Stima prudente per testo italiano con emoji: meno caratteri per token dell'inglese
+CHARS_PER_TOKEN = 3.5
+# Token aggiunti dal template di chat per ogni messaggio (ruolo e separatori)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Priorità di inserimento (numero più basso = inserito prima)
+PRIORITY_RECENT_HISTORY = 0
+PRIORITY_RETRIEVAL = 1
+PRIORITY_PERSONALIZATION = 2
+PRIORITY_OLD_HISTORY = 3
+
+TRUNCATION_MARKER = "\n\n[... contenuto troncato ...]"
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima veloce dei token di un testo, senza tokenizer"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def context_piece(text: str, priority: int = PRIORITY_RETRIEVAL, label: str = "") -> Dict:
+    """Crea un pezzo di contesto con la sua priorità"""
+    return {"text": text, "priority": priority, "label": label}
+
+
+def render_context(pieces: List[Dict]) -> str:
+    """Unisce i pezzi di contesto nell'ordine in cui sono stati aggiunti"""
+    return "\n\n".join(piece["text"] for piece in pieces if piece.get("text"))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Taglia il testo al numero di token indicato, preferendo un confine di paragrafo o frase.
+    Le istruzioni finali (blocco ⚠️) vengono conservate e si taglia il contenuto prima di esse.
+    """
+    max_chars = int(max_tokens * CHARS_PER_TOKEN) - len(TRUNCATION_MARKER)
+    if len(text) <= max_chars + len(TRUNCATION_MARKER):
+        return text
+    if max_chars <= 0:
+        return ""
+    
+    tail = ""
+    instructions_at = text.rfind("\n\n⚠️")
+    if instructions_at > 0 and len(text) - instructions_at < max_chars // 2:
+        tail = text[instructions_at:]
+        text = text[:instructions_at]
+        max_chars -= len(tail)
+    
+    head = text[:max_chars]
+    for boundary in ("\n\n", "\n", ". "):
+        cut = head.rfind(boundary)
+        if cut > max_chars // 2:
+            head = head[:cut + (1 if boundary == ". " else 0)]
+            break
+    return head.rstrip() + TRUNCATION_MARKER + tail
+
+
+class ContextAssembler:
+    """
+    Adatta cronologia e fonti a num_ctx lasciando spazio ai token della risposta.
+    
+    Il system prompt e l'ultimo messaggio dell'utente sono sempre inclusi. Il resto
+    viene inserito per priorità: ultimo scambio della cronologia, fonti recuperate,
+    personalizzazione e infine i turni più vecchi (dal più recente al più vecchio).
+    """
+    
+    def __init__(self, num_ctx: int, history_keep_recent: int = 2, min_piece_tokens: int = 64):
+        self.num_ctx = num_ctx
+        self.history_keep_recent = history_keep_recent
+        self.min_piece_tokens = min_piece_tokens
+        self._calls = 0
+        self._trimmed_calls = 0
+        self._dropped_messages = 0
+        self._truncated_pieces = 0
+        self._dropped_pieces = 0
+        self._prompt_tokens = 0
+    
+    def fit(self, history: List[Dict], context: Union[str, List[Dict]], num_predict: int) -> Tuple[List[Dict], str]:
+        """Restituisce la cronologia e il contesto (stringa) che stanno nella finestra"""
+        pieces = [context_piece(context)] if isinstance(context, str) else list(context)
+        pieces = [piece for piece in pieces if piece.get("text")]
+        messages = [msg for msg in history if isinstance(msg, dict) and "content" in msg]
+        last_message = messages[-1:] if messages else []
+        previous = messages[:-1]
+        
+        template = CONTEXT_TEMPLATE.format(context="") if pieces else NO_CONTEXT_GUIDANCE
+        used = (
+            estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(template) + 2 * MESSAGE_OVERHEAD_TOKENS
+            + sum(estimate_tokens(str(msg["content"])) + MESSAGE_OVERHEAD_TOKENS for msg in last_message)
+        )
+        available = self.num_ctx - num_predict - used
+        
+        # Candidati: (priorità, ordine, tipo, indice). I turni vecchi vanno dal più recente al più vecchio
+        candidates = []
+        for index in range(len(previous) - 1, -1, -1):
+            recent = index >= len(previous) - self.history_keep_recent
+            priority = PRIORITY_RECENT_HISTORY if recent else PRIORITY_OLD_HISTORY
+            candidates.append((priority, len(previous) - index, "history", index))
+        for index, piece in enumerate(pieces):
+            candidates.append((piece.get("priority", PRIORITY_RETRIEVAL), index, "piece", index))
+        candidates.sort(key=lambda c: (c[0], c[1]))
+        
+        kept_history = set()
+        history_cut = False
+        kept_pieces: Dict[int, str] = {}
+        trimmed = False
+        for _, _, kind, index in candidates:
+            if kind == "history":
+                cost = estimate_tokens(str(previous[index]["content"])) + MESSAGE_OVERHEAD_TOKENS
+                # Una volta tolto un turno si tolgono anche i precedenti, per non lasciare buchi
+                if history_cut or cost > available:
+                    history_cut = True
+                    trimmed = True
+                    self._dropped_messages += 1
+                    continue
+                kept_history.add(index)
+                available -= cost
+            else:
+                text = pieces[index]["text"]
+                cost = estimate_tokens(text)
+                if cost > available:
+                    trimmed = True
+                    if available < self.min_piece_tokens:
+                        self._dropped_pieces += 1
+                        logger.info(f"✂️ Fonte '{pieces[index].get('label', '')}' esclusa: non c'è spazio in num_ctx")
+                        continue
+                    text = truncate_to_tokens(text, available)
+                    cost = estimate_tokens(text)
+                    self._truncated_pieces += 1
+                    logger.info(f"✂️ Fonte '{pieces[index].get('label', '')}' ridotta a ~{cost} token")
+                kept_pieces[index] = text
+                available -= cost
+        
+        fitted_history = [msg for index, msg in enumerate(previous) if index in kept_history] + last_message
+        fitted_context = render_context([{"text": kept_pieces[index]} for index in sorted(kept_pieces)])
+        
+        self._calls += 1
+        self._prompt_tokens += self.num_ctx - num_predict - available
+        if trimmed:
+            self._trimmed_calls += 1
+            logger.info(f"✂️ Prompt adattato a num_ctx={self.num_ctx}: {len(fitted_history)}/{len(messages)} messaggi, {len(kept_pieces)}/{len(pieces)} fonti")
+        return fitted_history, fitted_context
+    
+    def stats(self) -> Dict:
+        calls = self._calls or 1
+        return {
+            "num_ctx": self.num_ctx,
+            "calls": self._calls,
+            "trimmed_calls": self._trimmed_calls,
+            "dropped_messages": self._dropped_messages,
+            "truncated_pieces": self._truncated_pieces,
+            "dropped_pieces": self._dropped_pieces,
+            "avg_prompt_tokens_estimate": round(self._prompt_tokens / calls, 1)
+        }
@@ -0,0 +1,125 @@
+"""Budget di latenza per richiesta e stima della velocità di generazione di Ollama"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Terminatori di frase usati per tagliare pulito il testo parziale
+SENTENCE_ENDINGS = ('.', '!', '?', '。', '！', '？')
+
+_DONE = object()
+
+
+class Deadline:
+    """Scadenza assoluta di una richiesta, calcolata dal budget di latenza in secondi"""
+    
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.expired = False
+    
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+class ThroughputEstimator:
+    """
+    Media mobile dei token al secondo (eval_count / eval_duration) e del tempo
+    speso prima del primo token (caricamento modello + prompt eval).
+    Serve a scegliere num_predict in modo che la generazione stia nel budget.
+    """
+    
+    def __init__(self, alpha: float = 0.2, safety: float = 0.8, min_tokens: int = 48):
+        self._alpha = alpha
+        self._safety = safety
+        self._min_tokens = min_tokens
+        self._tokens_per_second: Optional[float] = None
+        self._overhead_seconds: Optional[float] = None
+        self._samples = 0
+        self._deadline_hits = 0
+    
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return (1 - self._alpha) * current + self._alpha * value
+    
+    def record(self, data: Dict):
+        """Aggiorna le stime dall'ultimo chunk di una risposta Ollama (durate in nanosecondi)"""
+        eval_count = data.get("eval_count") or 0
+        eval_duration = data.get("eval_duration") or 0
+        if eval_count > 0 and eval_duration > 0:
+            self._tokens_per_second = self._ewma(self._tokens_per_second, eval_count / (eval_duration / 1e9))
+            self._samples += 1
+        overhead = (data.get("load_duration") or 0) + (data.get("prompt_eval_duration") or 0)
+        if overhead > 0:
+            self._overhead_seconds = self._ewma(self._overhead_seconds, overhead / 1e9)
+    
+    def record_deadline_hit(self):
+        self._deadline_hits += 1
+    
+    def num_predict_for(self, remaining: float, cap: int) -> int:
+        """Numero massimo di token generabili nel tempo rimasto, senza superare il cap del profilo"""
+        if self._tokens_per_second is None:
+            return cap
+        usable = remaining - (self._overhead_seconds or 0.0)
+        tokens = int(usable * self._tokens_per_second * self._safety)
+        return max(self._min_tokens, min(cap, tokens))
+    
+    def stats(self) -> Dict:
+        return {
+            "tokens_per_second": round(self._tokens_per_second, 2) if self._tokens_per_second else None,
+            "overhead_seconds": round(self._overhead_seconds, 2) if self._overhead_seconds else None,
+            "samples": self._samples,
+            "deadline_hits": self._deadline_hits
+        }
+
+
+async def iterate_until(source: AsyncIterator[str], deadline: Deadline) -> AsyncIterator[str]:
+    """
+    Itera source fino alla scadenza. Lo stream viene consumato in un task separato,
+    così alla scadenza basta cancellarlo per chiudere la connessione verso Ollama.
+    Alla scadenza imposta deadline.expired e termina senza errori.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    async def pump():
+        try:
+            async for item in source:
+                queue.put_nowait(item)
+            queue.put_nowait(_DONE)
+        except Exception as e:
+            queue.put_nowait(e)
+    
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                deadline.expired = True
+                return
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+def trim_to_sentence(text: str) -> str:
+    """Taglia il testo parziale all'ultima frase completa (o aggiunge i puntini se non ce ne sono)"""
+    text = text.rstrip()
+    if not text or text.endswith(SENTENCE_ENDINGS):
+        return text
+    cut = max(text.rfind(ending) for ending in SENTENCE_ENDINGS)
+    if cut > 0:
+        return text[:cut + 1]
+    return text + "…"
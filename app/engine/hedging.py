@@ -0,0 +1,173 @@
+"""Richieste di riserva (hedging) verso Ollama per risposte lente o vuote"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FirstTokenTracker:
+    """Finestra mobile dei tempi al primo token, per calcolarne un percentile"""
+    
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+    
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+    
+    def __len__(self) -> int:
+        return len(self._samples)
+    
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class Hedger:
+    """
+    Lancia una seconda richiesta quando la prima non produce il primo token entro
+    il percentile configurato dei tempi osservati, oppure termina senza testo.
+    Vince il primo tentativo che produce un token; l'altro viene cancellato.
+    
+    L'hedging per lentezza ha senso solo con più nodi (slow_hedging): sullo stesso
+    nodo la seconda richiesta finirebbe dietro la prima. Con uno scheduler la richiesta
+    di riserva per lentezza gira in parallelo alla prima e occupa un suo slot: se non ce
+    n'è uno libero subito non parte, così le generazioni restano entro max_concurrency.
+    Il tentativo dopo una risposta vuota parte quando il primo è finito e usa lo slot della richiesta.
+    """
+    
+    def __init__(self, percentile: float = 95.0, min_samples: int = 20, min_delay: float = 1.0, slow_hedging: bool = True,
+                 scheduler=None):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.slow_hedging = slow_hedging
+        self.scheduler = scheduler
+        self.tracker = FirstTokenTracker()
+        self._hedges = {"slow": 0, "empty": 0}
+        self._hedge_wins = 0
+        self._hedges_skipped = 0
+        self._requests = 0
+    
+    def hedge_delay(self) -> Optional[float]:
+        """Attesa del primo token oltre la quale parte la richiesta di riserva (None = mai)"""
+        if not self.slow_hedging or len(self.tracker) < self.min_samples:
+            return None
+        return max(self.min_delay, self.tracker.percentile(self.percentile))
+    
+    async def stream(self, start: Callable[[str, Dict], AsyncIterator[str]], final: Optional[Dict] = None) -> AsyncIterator[str]:
+        """
+        Restituisce i token del tentativo vincente. start(reason, final) avvia un tentativo:
+        reason è "primary", "slow" o "empty" e final riceve l'ultimo chunk di quel tentativo.
+        """
+        self._requests += 1
+        queue: asyncio.Queue = asyncio.Queue()
+        tasks: Dict[int, asyncio.Task] = {}
+        finals: Dict[int, Dict] = {}
+        started: Dict[int, float] = {}
+        reasons: Dict[int, str] = {}
+        errors: Dict[int, Exception] = {}
+        finished = set()
+        
+        def launch(reason: str) -> bool:
+            slot = reason == "slow" and self.scheduler is not None
+            if slot and not self.scheduler.try_acquire():
+                self._hedges_skipped += 1
+                logger.info("🛡️ Richiesta di riserva saltata: nessuno slot libero verso Ollama")
+                return False
+            index = len(tasks)
+            finals[index] = {}
+            started[index] = time.monotonic()
+            reasons[index] = reason
+            if index > 0:
+                self._hedges[reason] += 1
+                logger.info(f"🛡️ Richiesta di riserva verso Ollama ({'primo token in ritardo' if reason == 'slow' else 'risposta vuota'})")
+            
+            async def pump():
+                try:
+                    async for token in start(reason, finals[index]):
+                        queue.put_nowait((index, "token", token))
+                    queue.put_nowait((index, "done", None))
+                except Exception as e:
+                    queue.put_nowait((index, "error", e))
+            
+            tasks[index] = asyncio.ensure_future(pump())
+            if slot:
+                # Anche se il task viene cancellato prima di partire
+                tasks[index].add_done_callback(lambda _: self.scheduler.release())
+            return True
+        
+        launch("primary")
+        delay = self.hedge_delay()
+        winner = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and len(tasks) == 1 and delay is not None:
+                    timeout = max(0.0, started[0] + delay - time.monotonic())
+                try:
+                    index, kind, value = await asyncio.wait_for(queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    if not launch("slow"):
+                        delay = None
+                    continue
+                if winner is not None and index != winner:
+                    continue
+                
+                if kind == "token":
+                    if winner is None:
+                        winner = index
+                        if reasons[index] != "empty":
+                            # Il tentativo dopo una risposta vuota parte tardi: falserebbe il percentile
+                            self.tracker.record(time.monotonic() - started[index])
+                        if index > 0:
+                            self._hedge_wins += 1
+                        for other, task in tasks.items():
+                            if other != index:
+                                task.cancel()
+                    yield value
+                    continue
+                
+                if winner == index:
+                    if kind == "error":
+                        raise value
+                    break
+                
+                # Tentativo terminato senza testo (vuoto o in errore)
+                finished.add(index)
+                if kind == "error":
+                    errors[index] = value
+                if len(tasks) == 1 and kind == "done":
+                    launch("empty")
+                    continue
+                if len(finished) == len(tasks):
+                    if len(errors) == len(tasks):
+                        raise errors[0]
+                    break
+            
+            if final is not None and winner is not None:
+                final.update(finals[winner])
+            elif final is not None:
+                final.update(finals[len(finals) - 1])
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+    
+    def stats(self) -> Dict:
+        delay = self.hedge_delay()
+        return {
+            "requests": self._requests,
+            "hedges": dict(self._hedges),
+            "hedge_wins": self._hedge_wins,
+            "hedges_skipped": self._hedges_skipped,
+            "hedge_delay_seconds": round(delay, 2) if delay is not None else None,
+            "first_token_p50": round(self.tracker.percentile(50), 2) if len(self.tracker) else None,
+            "first_token_p95": round(self.tracker.percentile(95), 2) if len(self.tracker) else None
+        }
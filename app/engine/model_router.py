@@ -0,0 +1,124 @@
+"""Instradamento delle richieste verso modelli diversi in base a intent e dimensione del contesto"""
+import json
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def default_routes(small_model: str = "", small_max_context_tokens: int = 0) -> List[Dict]:
+    """
+    Tabella di default: small_talk senza fonti (o con poche fonti) va sul modello piccolo,
+    tutto il resto sul modello principale. Senza modello piccolo entrambe usano il principale.
+    """
+    return [
+        {
+            "name": "small_talk",
+            "intents": ["small_talk"],
+            "max_context_tokens": small_max_context_tokens,
+            "model": small_model or None,
+            "profile": "fast"
+        },
+        {
+            "name": "default",
+            "intents": None,
+            "max_context_tokens": None,
+            "model": None,
+            "profile": "default"
+        }
+    ]
+
+
+def load_routes(raw: str, small_model: str = "", small_max_context_tokens: int = 0) -> List[Dict]:
+    """Legge la tabella da JSON (OLLAMA_MODEL_ROUTES) o usa quella di default"""
+    if not raw:
+        return default_routes(small_model, small_max_context_tokens)
+    try:
+        routes = json.loads(raw)
+        if isinstance(routes, list) and routes:
+            return routes
+    except ValueError as e:
+        logger.error(f"OLLAMA_MODEL_ROUTES non valido, uso la tabella di default: {e}")
+    return default_routes(small_model, small_max_context_tokens)
+
+
+class ModelRouter:
+    """
+    Sceglie modello e profilo di opzioni per ogni richiesta. Le route vengono provate
+    in ordine: vince la prima il cui intent corrisponde (None = qualunque) e il cui
+    contesto non supera max_context_tokens (None = nessun limite). model None indica
+    il modello principale; un modello non installato in Ollama viene ignorato.
+    """
+    
+    def __init__(self, routes: List[Dict]):
+        self.routes = routes
+        self._available: Optional[set] = None
+        self._stats: Dict[str, Dict[str, float]] = {}
+    
+    def set_available(self, model_names: List[str]):
+        """Registra i modelli installati (da /api/tags) e segnala le route che non potranno usarli"""
+        self._available = set(model_names)
+        for route in self.routes:
+            model = route.get("model")
+            if model and not self._installed(model):
+                logger.warning(f"⚠️ Modello '{model}' della route {route['name']} non installato: uso il modello principale")
+    
+    def _installed(self, model: str) -> Optional[str]:
+        # Ollama elenca i modelli senza tag esplicito come "nome:latest"
+        if self._available is None:
+            return model
+        for name in (model, f"{model}:latest"):
+            if name in self._available:
+                return name
+        return None
+    
+    def _resolve_model(self, route: Dict, default_model: str) -> str:
+        model = route.get("model")
+        if not model:
+            return default_model
+        return self._installed(model) or default_model
+    
+    def route(self, intent: Optional[str], context_tokens: int, default_model: str) -> Dict:
+        """Restituisce nome della route, modello e profilo di opzioni per la richiesta"""
+        for route in self.routes:
+            intents = route.get("intents")
+            if intents is not None and intent not in intents:
+                continue
+            max_tokens = route.get("max_context_tokens")
+            if max_tokens is not None and context_tokens > max_tokens:
+                continue
+            return {
+                "name": route["name"],
+                "model": self._resolve_model(route, default_model),
+                "profile": route.get("profile", "default")
+            }
+        return {"name": "default", "model": default_model, "profile": "default"}
+    
+    def models(self, default_model: str) -> List[str]:
+        """Modelli distinti usati dalla tabella (da tenere caldi)"""
+        models = []
+        for route in self.routes:
+            model = self._resolve_model(route, default_model)
+            if model not in models:
+                models.append(model)
+        return models
+    
+    def record(self, route: Dict, seconds: float, data: Optional[Dict] = None):
+        """Metriche per route: richieste, latenza media e token generati"""
+        entry = self._stats.setdefault(route["name"], {"requests": 0, "seconds": 0.0, "eval_tokens": 0})
+        entry["requests"] += 1
+        entry["seconds"] += seconds
+        entry["eval_tokens"] += (data or {}).get("eval_count", 0) or 0
+        entry["model"] = route["model"]
+    
+    def stats(self) -> Dict[str, Dict]:
+        result = {}
+        for name, entry in self._stats.items():
+            requests = entry["requests"] or 1
+            result[name] = {
+                "model": entry["model"],
+                "requests": entry["requests"],
+                "avg_seconds": round(entry["seconds"] / requests, 2),
+                "avg_eval_tokens": round(entry["eval_tokens"] / requests, 1)
+            }
+        return result
@@ -0,0 +1,92 @@
+"""Scelta del modello tra quelli installati in Ollama e stato di riscaldamento (warm/cold)"""
+import logging
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Modelli preferiti in ordine di priorità (corrispondenza parziale sul nome)
+PREFERRED_MODELS = ["qwen3:8b", "qwen3", "gpt-oss:120b", "gpt-oss"]
+
+
+def select_model(model_names: List[str], preferred: List[str] = PREFERRED_MODELS) -> Optional[str]:
+    """Sceglie il modello da usare tra quelli installati, o None se non ce ne sono"""
+    # Priorità 1: Cerca il modello esatto o varianti
+    for wanted in preferred:
+        for name in model_names:
+            if wanted.lower() in name.lower() or name.lower() in wanted.lower():
+                return name
+    
+    # Priorità 2: Cerca modelli qwen3 o gpt-oss
+    for name in model_names:
+        if "qwen3" in name.lower() or "gpt-oss" in name.lower():
+            return name
+    
+    # Ultima scelta: il primo modello disponibile
+    return model_names[0] if model_names else None
+
+
+class ModelState:
+    """
+    Stato del modello lato Ollama: lista dei modelli installati (in cache), modello scelto
+    e se è già caricato in memoria. Il modello resta "warm" finché viene usato entro keep_alive,
+    dopo Ollama lo scarica e la prossima richiesta ripaga il caricamento.
+    
+    ready indica che il worker può ricevere traffico: diventa vero dopo il primo caricamento
+    del modello e non torna falso quando il modello si raffredda per inattività (altrimenti
+    un orchestratore che guarda /ready non manderebbe più richieste a un worker inattivo).
+    """
+    
+    def __init__(self, keep_alive: float):
+        self.keep_alive = keep_alive
+        self.status = "cold"  # cold, discovering, warming, warm, unavailable
+        self.models: List[str] = []
+        self.model_name: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.discovered_at: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.ready = False
+        self._last_activity: Dict[str, float] = {}
+    
+    def set_status(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.last_error = error
+    
+    def set_ready(self):
+        """Worker pronto anche senza modello caricato (warmup disattivato)"""
+        self.ready = True
+    
+    def set_models(self, models: List[str], model_name: Optional[str]):
+        self.models = models
+        self.model_name = model_name
+        self.discovered_at = time.time()
+    
+    def touch(self, model: Optional[str] = None):
+        """Registra una generazione completata: il modello è in memoria per altri keep_alive secondi"""
+        model = model or self.model_name
+        if not model:
+            return
+        self._last_activity[model] = time.monotonic()
+        if model == self.model_name:
+            self.status = "warm"
+            self.ready = True
+    
+    def is_warm(self, model: Optional[str] = None) -> bool:
+        last_activity = self._last_activity.get(model or self.model_name)
+        if last_activity is None:
+            return False
+        return time.monotonic() - last_activity < self.keep_alive
+    
+    def stats(self) -> Dict:
+        status = self.status
+        if status == "warm" and not self.is_warm():
+            status = "cold"
+        return {
+            "status": status,
+            "ready": self.ready,
+            "model": self.model_name,
+            "models": self.models,
+            "warm_models": [model for model in self._last_activity if self.is_warm(model)],
+            "warmup_seconds": round(self.warmup_seconds, 2) if self.warmup_seconds is not None else None,
+            "last_error": self.last_error
+        }
@@ -0,0 +1,144 @@
+"""Cache delle risposte generate da Ollama con chiavi normalizzate ed eviction LRU + TTL"""
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalizza il testo per la chiave: minuscole, niente punteggiatura, spazi compressi"""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_cache_key(model: str, profile: str, context: str, history: List[Dict], history_window: int = 3) -> str:
+    """
+    Chiave della cache: hash di modello, profilo di opzioni, contesto recuperato
+    e ultimi `history_window` messaggi della conversazione (tutti normalizzati).
+    """
+    window = history[-history_window:] if history_window > 0 else []
+    serialized = json.dumps([
+        model,
+        profile,
+        normalize_text(context),
+        [[msg.get("role", ""), normalize_text(msg.get("content", ""))] for msg in window]
+    ], ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache LRU in memoria con scadenza (TTL) e livello opzionale su disco.
+    
+    Il livello su disco salva un file JSON per chiave in `disk_dir`: sopravvive ai riavvii
+    e viene consultato solo in caso di miss in memoria.
+    """
+    
+    def __init__(self, max_entries: int = 512, ttl: float = 3600.0, disk_dir: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+    
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+    
+    def _is_expired(self, entry: Dict) -> bool:
+        return time.time() - entry["created_at"] > self.ttl
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+    
+    def _load_from_disk(self, key: str) -> Optional[Dict]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                if not self._is_expired(entry):
+                    return entry
+                os.remove(path)
+        except Exception as e:
+            logger.warning(f"Error reading response cache entry from disk: {e}")
+        return None
+    
+    def _save_to_disk(self, key: str, entry: Dict):
+        if not self.disk_dir:
+            return
+        try:
+            with open(self._disk_path(key), 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f"Error writing response cache entry to disk: {e}")
+    
+    def get(self, key: str) -> Optional[str]:
+        """Restituisce la risposta in cache per la chiave, o None"""
+        if not self.enabled:
+            return None
+        
+        entry = self._entries.get(key)
+        if entry is not None and self._is_expired(entry):
+            del self._entries[key]
+            entry = None
+        
+        if entry is None:
+            entry = self._load_from_disk(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+            self._store(key, entry)
+        
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry["reply"]
+    
+    def set(self, key: str, reply: str):
+        """Salva una risposta generata"""
+        if not self.enabled or not reply:
+            return
+        entry = {"reply": reply, "created_at": time.time()}
+        self._store(key, entry)
+        self._save_to_disk(key, entry)
+    
+    def _store(self, key: str, entry: Dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self) -> Dict:
+        lookups = self._hits + self._misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk_tier": bool(self.disk_dir),
+            "hits": self._hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0
+        }
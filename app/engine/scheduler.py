@@ -0,0 +1,162 @@
+"""Controllo di ammissione e coda con priorità davanti al backend Ollama"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """La coda verso Ollama è piena: la richiesta va rifiutata con 503"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Coda Ollama piena, riprova tra {retry_after} secondi")
+        self.retry_after = retry_after
+
+
+class RequestScheduler:
+    """
+    Limita le generazioni concorrenti verso Ollama e mette in coda le altre.
+    
+    Le richieste fast_mode (small_talk) hanno una corsia preferenziale e vengono
+    servite prima di quelle normali. Quando la coda è piena le nuove richieste
+    vengono rifiutate subito con QueueFullError invece di accumularsi in Ollama.
+    
+    Il lavoro offline (/chat/batch) ha una corsia a parte a bassa priorità: non occupa
+    posti nella coda delle richieste interattive, viene servito solo quando le altre corsie
+    sono vuote e non usa mai più di max_batch slot insieme. Non viene mai rifiutato, aspetta.
+    """
+    
+    def __init__(self, max_concurrency: int = 2, max_queue: int = 16, max_batch: int = 1):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_batch = max(1, min(max_batch, self.max_concurrency))
+        self._active = 0
+        self._batch_active = 0
+        self._fast_lane: Deque[asyncio.Future] = deque()
+        self._normal_lane: Deque[asyncio.Future] = deque()
+        self._batch_lane: Deque[asyncio.Future] = deque()
+        self._admitted = 0
+        self._rejected = 0
+        self._avg_service_time = 10.0  # Stima iniziale in secondi, aggiornata con media mobile
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._fast_lane) + len(self._normal_lane)
+    
+    def retry_after(self) -> int:
+        """Stima in secondi di quando la coda avrà di nuovo posto"""
+        waves = (self.queue_depth + 1) / self.max_concurrency
+        return max(1, math.ceil(self._avg_service_time * waves))
+    
+    def ensure_capacity(self):
+        """Solleva QueueFullError se una nuova richiesta verrebbe rifiutata in questo momento"""
+        if self._active >= self.max_concurrency and self.queue_depth >= self.max_queue:
+            self._rejected += 1
+            raise QueueFullError(self.retry_after())
+    
+    def try_acquire(self) -> bool:
+        """Occupa uno slot solo se è libero subito, senza coda (es. per una richiesta di riserva)"""
+        if self._active < self.max_concurrency and self.queue_depth == 0:
+            self._active += 1
+            self._admitted += 1
+            return True
+        return False
+    
+    async def acquire_batch(self):
+        """Attende uno slot per il lavoro offline, dopo tutte le richieste interattive"""
+        if self._active < self.max_concurrency and self.queue_depth == 0 and not self._batch_lane and self._batch_active < self.max_batch:
+            self._active += 1
+            self._batch_active += 1
+            self._admitted += 1
+            return
+        
+        # Lo slot arriva da release(), che aggiorna già _batch_active
+        waiter = asyncio.get_running_loop().create_future()
+        self._batch_lane.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(batch=True)
+            elif waiter in self._batch_lane:
+                self._batch_lane.remove(waiter)
+            raise
+        self._admitted += 1
+    
+    async def acquire(self, fast: bool = False):
+        """Attende uno slot libero (o solleva QueueFullError se la coda è piena)"""
+        if self._active < self.max_concurrency and self.queue_depth == 0:
+            self._active += 1
+            self._admitted += 1
+            return
+        
+        self.ensure_capacity()
+        
+        waiter = asyncio.get_running_loop().create_future()
+        lane = self._fast_lane if fast else self._normal_lane
+        lane.append(waiter)
+        logger.info(f"Richiesta in coda per Ollama ({'fast' if fast else 'normale'}), profondità coda: {self.queue_depth}")
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Lo slot era già stato assegnato: restituiscilo
+                self.release()
+            elif waiter in lane:
+                lane.remove(waiter)
+            raise
+        self._admitted += 1
+    
+    def release(self, batch: bool = False):
+        """Libera uno slot passandolo direttamente alla prossima richiesta in coda"""
+        if batch:
+            self._batch_active = max(0, self._batch_active - 1)
+        for lane in (self._fast_lane, self._normal_lane):
+            while lane:
+                waiter = lane.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)  # Lo slot passa al waiter, _active non cambia
+                    return
+        while self._batch_lane and self._batch_active < self.max_batch:
+            waiter = self._batch_lane.popleft()
+            if not waiter.done():
+                self._batch_active += 1
+                waiter.set_result(None)
+                return
+        self._active = max(0, self._active - 1)
+    
+    @asynccontextmanager
+    async def slot(self, fast: bool = False, batch: bool = False):
+        """Context manager che occupa uno slot per tutta la durata della generazione"""
+        if batch:
+            await self.acquire_batch()
+        else:
+            await self.acquire(fast)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed_time = time.time() - start_time
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed_time
+            self.release(batch)
+    
+    def stats(self) -> Dict:
+        return {
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "queued_fast": len(self._fast_lane),
+            "queued_normal": len(self._normal_lane),
+            "queued_batch": len(self._batch_lane),
+            "batch_active": self._batch_active,
+            "max_batch": self.max_batch,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "avg_service_time": round(self._avg_service_time, 2)
+        }
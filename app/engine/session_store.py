@@ -0,0 +1,86 @@
+"""Memorizza per conversazione il context di token restituito da Ollama (/api/generate)"""
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def history_fingerprint(history: List[Dict]) -> str:
+    """Hash stabile della cronologia (ruoli e contenuti) per verificare la continuità della sessione"""
+    serialized = json.dumps(
+        [[msg.get("role", ""), str(msg.get("content", ""))] for msg in history],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class SessionContextStore:
+    """
+    Cache LRU, per session_id, dell'array `context` restituito da Ollama.
+    
+    Al turno successivo il context può essere riutilizzato solo se la nuova cronologia
+    estende esattamente quella già valutata con la risposta dell'assistente e un
+    nuovo messaggio utente: in quel caso basta inviare il nuovo turno.
+    """
+    
+    def __init__(self, max_sessions: int = 256):
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+    
+    def get_context(self, session_id: str, history: List[Dict]) -> Optional[List[int]]:
+        """Restituisce il context riutilizzabile per questa cronologia, o None"""
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            self._misses += 1
+            return None
+        
+        covered = entry["message_count"]
+        is_continuation = (
+            len(history) == covered + 2
+            and history[covered].get("role") == "assistant"
+            and history[-1].get("role") == "user"
+            and history_fingerprint(history[:covered]) == entry["fingerprint"]
+        )
+        if not is_continuation:
+            # La conversazione è stata modificata o ha saltato un turno: ricomincia da capo
+            logger.info(f"Sessione {session_id}: cronologia non allineata, context scartato")
+            del self._sessions[session_id]
+            self._misses += 1
+            return None
+        
+        self._sessions.move_to_end(session_id)
+        self._hits += 1
+        return entry["context"]
+    
+    def update(self, session_id: str, history: List[Dict], context: Optional[List[int]]):
+        """Salva il context restituito da Ollama dopo aver valutato questa cronologia"""
+        if not context:
+            self._sessions.pop(session_id, None)
+            return
+        self._sessions[session_id] = {
+            "context": context,
+            "message_count": len(history),
+            "fingerprint": history_fingerprint(history),
+            "updated_at": time.time()
+        }
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            logger.info(f"Sessione {evicted_id} rimossa dalla cache (LRU)")
+    
+    def discard(self, session_id: str):
+        self._sessions.pop(session_id, None)
+    
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "hits": self._hits,
+            "misses": self._misses
+        }
@@ -0,0 +1,111 @@
+"""Deduplicazione delle generazioni identiche in corso (single-flight)"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _consume_result(task: asyncio.Future):
+    # Evita il warning "exception was never retrieved" se tutti i chiamanti sono stati cancellati
+    if not task.cancelled():
+        task.exception()
+
+
+class _StreamBroadcast:
+    """Consuma uno stream una sola volta e lo ritrasmette a tutti gli iscritti, dall'inizio"""
+    
+    def __init__(self, source: AsyncIterator[str]):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+    
+    def _notify(self):
+        # Sveglia chi attende sull'evento corrente e ne prepara uno nuovo per il prossimo chunk
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError as e:
+            # Cancellazione (es. shutdown): arriva anche agli iscritti come tale, e il task
+            # del pump risulta cancellato invece che concluso normalmente
+            self.error = e
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+    
+    async def subscribe(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    La prima richiesta per una chiave esegue la generazione; le richieste identiche
+    che arrivano mentre è in corso attendono lo stesso risultato (o lo stesso stream)
+    invece di avviare un'altra generazione su Ollama.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _StreamBroadcast] = {}
+        self._leaders = 0
+        self._followers = 0
+    
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Esegue fn una sola volta per chiave tra le chiamate concorrenti"""
+        task = self._calls.get(key)
+        if task is None:
+            self._leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+            task.add_done_callback(_consume_result)
+        else:
+            self._followers += 1
+            logger.info("🔗 Generazione identica già in corso, attendo il suo risultato")
+        # shield: se un chiamante viene cancellato, la generazione continua per gli altri
+        return await asyncio.shield(task)
+    
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Come do(), ma condivide uno stream di chunk tra le richieste concorrenti"""
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self._leaders += 1
+            broadcast = _StreamBroadcast(factory())
+            self._streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda t: self._forget(self._streams, key, broadcast))
+        else:
+            self._followers += 1
+            logger.info("🔗 Stream identico già in corso, mi collego allo stesso stream")
+        async for chunk in broadcast.subscribe():
+            yield chunk
+    
+    @staticmethod
+    def _forget(registry: Dict, key: str, value: Any):
+        if registry.get(key) is value:
+            del registry[key]
+    
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self._leaders,
+            "coalesced": self._followers
+        }
@@ -0,0 +1,243 @@
+"""
+Telemetria delle generazioni Ollama: contatori e istogrammi esportati in formato Prometheus.
+
+Per ogni generazione si registrano le durate restituite da Ollama (load, prompt eval,
+eval) e i token, etichettati con intent, modello e profilo di opzioni: così si capisce
+se una richiesta lenta dipende da un prompt troppo lungo, da un modello freddo
+da caricare o dalla decodifica.
+"""
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+# Sopra questa durata di load_duration il modello non era in memoria
+COLD_LOAD_SECONDS = 0.5
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in (labels or {}).items()))
+
+
+def _format_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(round(value, 6))
+
+
+class Counter:
+    """Contatore monotono per combinazione di etichette"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, labels: Optional[Dict[str, str]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Valore istantaneo (può scendere)"""
+    
+    kind = "gauge"
+    
+    def set(self, value: float, labels: Optional[Dict[str, str]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """Istogramma a bucket cumulativi per combinazione di etichette"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelKey, Dict] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, labels: Optional[Dict[str, str]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+    
+    def summary(self) -> Dict[str, float]:
+        """Conteggio e media su tutte le etichette (per /engine/stats)"""
+        with self._lock:
+            count = sum(series["count"] for series in self._series.values())
+            total = sum(series["sum"] for series in self._series.values())
+        return {"count": count, "avg": round(total / count, 3) if count else None}
+    
+    def render(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Raccolta delle metriche del processo, esportata da /metrics"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+    
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+    
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._register(Gauge(name, help_text))
+    
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = SECONDS_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+    
+    def render(self) -> str:
+        """Testo nel formato di esposizione Prometheus (text/plain; version=0.0.4)"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Registro di default del processo
+registry = MetricsRegistry()
+
+
+def dominant_phase(data: Dict) -> Optional[str]:
+    """Fase che ha pesato di più sulla generazione: load, prompt_eval o eval"""
+    durations = {
+        "load": data.get("load_duration") or 0,
+        "prompt_eval": data.get("prompt_eval_duration") or 0,
+        "eval": data.get("eval_duration") or 0
+    }
+    phase, duration = max(durations.items(), key=lambda item: item[1])
+    return phase if duration > 0 else None
+
+
+class GenerationTelemetry:
+    """Metriche per ogni generazione Ollama, etichettate con intent, modello e profilo"""
+    
+    def __init__(self, metrics: MetricsRegistry = registry):
+        self.requests = metrics.counter("ollama_generations_total", "Generazioni Ollama completate")
+        self.cold_loads = metrics.counter("ollama_cold_loads_total", f"Generazioni con load_duration oltre {COLD_LOAD_SECONDS}s (modello non in memoria)")
+        self.dominant = metrics.counter("ollama_dominant_phase_total", "Fase più lunga della generazione (load, prompt_eval, eval)")
+        self.prompt_tokens_total = metrics.counter("ollama_prompt_tokens_total", "Token di prompt valutati")
+        self.eval_tokens_total = metrics.counter("ollama_eval_tokens_total", "Token generati")
+        self.wall_seconds = metrics.histogram("ollama_generation_seconds", "Durata totale della generazione vista dal backend")
+        self.load_seconds = metrics.histogram("ollama_load_seconds", "Tempo di caricamento del modello (load_duration)")
+        self.prompt_eval_seconds = metrics.histogram("ollama_prompt_eval_seconds", "Tempo di valutazione del prompt (prompt_eval_duration)")
+        self.eval_seconds = metrics.histogram("ollama_eval_seconds", "Tempo di decodifica (eval_duration)")
+        self.prompt_tokens = metrics.histogram("ollama_prompt_tokens", "Token di prompt per richiesta", TOKEN_BUCKETS)
+        self.eval_tokens = metrics.histogram("ollama_eval_tokens", "Token generati per richiesta", TOKEN_BUCKETS)
+        self.eval_rate = metrics.histogram("ollama_eval_tokens_per_second", "Velocità di decodifica", RATE_BUCKETS)
+        self.prompt_rate = metrics.histogram("ollama_prompt_tokens_per_second", "Velocità di valutazione del prompt", RATE_BUCKETS + (500, 1000, 2000))
+    
+    def record(self, data: Dict, wall_seconds: float, intent: Optional[str] = None, model: Optional[str] = None, profile: Optional[str] = None):
+        """Registra l'ultimo chunk di Ollama (done=True) di una generazione"""
+        labels = {
+            "intent": intent or "none",
+            "model": data.get("model") or model or "unknown",
+            "profile": profile or "default"
+        }
+        self.requests.inc(labels=labels)
+        self.wall_seconds.observe(wall_seconds, labels)
+        if not data:
+            return
+        
+        load = (data.get("load_duration") or 0) / 1e9  # Ollama usa nanosecondi
+        prompt_eval = (data.get("prompt_eval_duration") or 0) / 1e9
+        eval_time = (data.get("eval_duration") or 0) / 1e9
+        prompt_count = data.get("prompt_eval_count") or 0
+        eval_count = data.get("eval_count") or 0
+        
+        if "load_duration" in data:
+            self.load_seconds.observe(load, labels)
+            if load > COLD_LOAD_SECONDS:
+                self.cold_loads.inc(labels=labels)
+        if "prompt_eval_duration" in data:
+            self.prompt_eval_seconds.observe(prompt_eval, labels)
+            self.prompt_tokens.observe(prompt_count, labels)
+            self.prompt_tokens_total.inc(prompt_count, labels)
+            if prompt_eval > 0:
+                self.prompt_rate.observe(prompt_count / prompt_eval, labels)
+        if "eval_duration" in data:
+            self.eval_seconds.observe(eval_time, labels)
+            self.eval_tokens.observe(eval_count, labels)
+            self.eval_tokens_total.inc(eval_count, labels)
+            if eval_time > 0:
+                self.eval_rate.observe(eval_count / eval_time, labels)
+        
+        phase = dominant_phase(data)
+        if phase:
+            self.dominant.inc(labels={**labels, "phase": phase})
+        logger.info(
+            f"📈 {labels['model']} [{labels['intent']}/{labels['profile']}]: load {load:.2f}s, "
+            f"prompt {prompt_count} token in {prompt_eval:.2f}s, eval {eval_count} token in {eval_time:.2f}s "
+            f"(totale {wall_seconds:.2f}s, fase dominante: {phase or '-'})"
+        )
+    
+    def stats(self) -> Dict:
+        return {
+            "generations": int(self.requests.total()),
+            "cold_loads": int(self.cold_loads.total()),
+            "prompt_tokens": self.prompt_tokens.summary(),
+            "eval_tokens": self.eval_tokens.summary(),
+            "load_seconds": self.load_seconds.summary(),
+            "prompt_eval_seconds": self.prompt_eval_seconds.summary(),
+            "eval_seconds": self.eval_seconds.summary(),
+            "eval_tokens_per_second": self.eval_rate.summary()
+        }
@@ -0,0 +1,345 @@
+"""
+Tracing leggero delle richieste: span per fase (intent, Fandom, Wikipedia, RAG locale,
+personalizzazione, Ollama, scrittura della memoria) senza dipendenze esterne.
+
+La traccia della richiesta vive in un contextvar, quindi segue il codice anche nei worker
+pool e nelle ricerche in parallelo. Per ogni richiesta:
+- le durate per fase vanno nell'header Server-Timing (visibile negli strumenti del browser);
+- una riga di log JSON riassume fasi, stato e durata totale;
+- con OTEL_EXPORTER_OTLP_ENDPOINT gli span vengono inviati in background a un collector
+  OpenTelemetry (OTLP/HTTP JSON, es. http://localhost:4318).
+
+Con /chat/stream l'header parte prima della generazione: contiene le fasi di preparazione,
+mentre Ollama e la scrittura della memoria finiscono solo nel log e nell'export.
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from app.engine.telemetry import registry
+
+logger = logging.getLogger(__name__)
+
+TRACE_LOG = os.getenv("TRACE_LOG", "1") != "0"
+TRACE_SKIP_PATHS = {path.strip() for path in os.getenv("TRACE_SKIP_PATHS", "/metrics,/ready,/engine/stats").split(",") if path.strip()}
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "").rstrip("/")
+OTLP_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "nintendo-ai")
+OTLP_QUEUE_SIZE = 1000
+OTLP_BATCH_SIZE = 64
+OTLP_FLUSH_SECONDS = 2.0
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[str]] = ContextVar("trace_span", default=None)
+
+_stage_seconds = registry.histogram("request_stage_seconds", "Durata delle fasi delle richieste (span di tracing)")
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+class Trace:
+    """Span raccolti durante una richiesta (anche da thread diversi)"""
+    
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = _new_id(16)
+        self.root_id = _new_id(8)
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.started_ns = time.time_ns()
+        self.started = time.perf_counter()
+        self.ended: Optional[float] = None
+        self.status: Optional[int] = None
+        self.spans: List[Dict] = []
+        self._lock = threading.Lock()
+    
+    def add(self, span: Dict):
+        with self._lock:
+            self.spans.append(span)
+    
+    def finish(self, status: int):
+        self.status = status
+        self.ended = time.perf_counter()
+    
+    def elapsed(self) -> float:
+        return (self.ended or time.perf_counter()) - self.started
+    
+    def timings(self) -> Dict[str, float]:
+        """
+        Millisecondi per fase. Più span con lo stesso nome (es. due ricerche Fandom) si sommano;
+        uno span dentro un altro con lo stesso nome non viene contato due volte.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        by_id = {span["id"]: span for span in spans}
+        timings: Dict[str, float] = {}
+        for span in spans:
+            parent = by_id.get(span["parent"])
+            nested = False
+            while parent is not None:
+                if parent["name"] == span["name"]:
+                    nested = True
+                    break
+                parent = by_id.get(parent["parent"])
+            if not nested:
+                timings[span["name"]] = timings.get(span["name"], 0.0) + (span["end"] - span["start"]) * 1000
+        return {name: round(ms, 1) for name, ms in timings.items()}
+    
+    def server_timing(self) -> str:
+        """Valore dell'header Server-Timing (fasi concluse finora più il totale)"""
+        entries = [f"{name};dur={ms}" for name, ms in self.timings().items()]
+        entries.append(f"total;dur={round(self.elapsed() * 1000, 1)}")
+        return ", ".join(entries)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def annotate(**attributes):
+    """Aggiunge attributi alla richiesta corrente (es. intent), riportati nel log e nell'export"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    """Misura un blocco come fase della richiesta corrente (nessun costo fuori da una richiesta)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = _new_id(8)
+    parent = _current_span.get() or trace.root_id
+    token = _current_span.set(span_id)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Generatore async chiuso da un altro contesto (es. client disconnesso durante lo stream)
+            pass
+        trace.add({
+            "id": span_id,
+            "parent": parent,
+            "name": name,
+            "start": start,
+            "end": time.perf_counter(),
+            "attributes": attributes,
+            "error": error
+        })
+
+
+def traced(name: str) -> Callable:
+    """Decoratore: ogni chiamata della funzione diventa uno span con questo nome"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def _otlp_spans(trace: Trace) -> List[Dict]:
+    def unix_ns(offset: float) -> str:
+        return str(trace.started_ns + int((offset - trace.started) * 1e9))
+    
+    root = {
+        "traceId": trace.trace_id,
+        "spanId": trace.root_id,
+        "name": trace.name,
+        "kind": 2,  # SERVER
+        "startTimeUnixNano": unix_ns(trace.started),
+        "endTimeUnixNano": unix_ns(trace.ended or time.perf_counter()),
+        "attributes": _otlp_attributes({**trace.attributes, "http.response.status_code": trace.status}),
+        "status": {"code": 2} if (trace.status or 0) >= 500 else {}
+    }
+    with trace._lock:
+        spans = list(trace.spans)
+    return [root] + [{
+        "traceId": trace.trace_id,
+        "spanId": span["id"],
+        "parentSpanId": span["parent"],
+        "name": span["name"],
+        "kind": 1,  # INTERNAL
+        "startTimeUnixNano": unix_ns(span["start"]),
+        "endTimeUnixNano": unix_ns(span["end"]),
+        "attributes": _otlp_attributes({**span["attributes"], "error.type": span["error"]}),
+        "status": {"code": 2} if span["error"] else {}
+    } for span in spans]
+
+
+class OtlpExporter:
+    """
+    Invia le tracce a un collector OTLP/HTTP (JSON) da un thread in background, a lotti.
+    Se il collector è lento o assente le tracce in eccesso vengono scartate: la richiesta
+    non aspetta mai l'export.
+    """
+    
+    def __init__(self, endpoint: str, service_name: str = OTLP_SERVICE_NAME):
+        self.url = f"{endpoint}/v1/traces"
+        self.service_name = service_name
+        self._queue: queue.Queue = queue.Queue(maxsize=OTLP_QUEUE_SIZE)
+        self._dropped = registry.counter("trace_export_dropped_total", "Tracce non esportate (coda piena o collector in errore)")
+        self._exported = registry.counter("trace_export_spans_total", "Span inviati al collector OTLP")
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+        self._thread.start()
+    
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self._dropped.inc()
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + OTLP_FLUSH_SECONDS
+            while len(batch) < OTLP_BATCH_SIZE and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                self._send(traces)
+            if batch[-1] is None:
+                return
+    
+    def _send(self, traces: List[Trace]):
+        spans = [otlp_span for trace in traces for otlp_span in _otlp_spans(trace)]
+        body = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "app.engine.tracing"}, "spans": spans}]
+        }]}
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+            self._exported.inc(len(spans))
+        except Exception as e:
+            self._dropped.inc(len(traces))
+            logger.warning(f"Export delle tracce verso {self.url} fallito: {e}")
+    
+    def shutdown(self, timeout: float = 5.0):
+        """Invia le tracce ancora in coda e ferma il thread"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+_exporter: Optional[OtlpExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> Optional[OtlpExporter]:
+    """Exporter OTLP, avviato al primo uso solo se OTEL_EXPORTER_OTLP_ENDPOINT è impostato"""
+    global _exporter
+    if not OTLP_ENDPOINT:
+        return None
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = OtlpExporter(OTLP_ENDPOINT)
+            logger.info(f"🧭 Export delle tracce attivo verso {_exporter.url}")
+        return _exporter
+
+
+def shutdown_tracing():
+    global _exporter
+    with _exporter_lock:
+        exporter, _exporter = _exporter, None
+    if exporter is not None:
+        exporter.shutdown()
+
+
+def finish_trace(trace: Trace):
+    """Metriche per fase, riga di log strutturata ed export della richiesta conclusa"""
+    timings = trace.timings()
+    for name, ms in timings.items():
+        _stage_seconds.observe(ms / 1000, {"stage": name})
+    if TRACE_LOG:
+        logger.info(json.dumps({
+            "event": "request_trace",
+            "trace_id": trace.trace_id,
+            "request": trace.name,
+            "status": trace.status,
+            "total_ms": round(trace.elapsed() * 1000, 1),
+            "stages": timings,
+            **trace.attributes
+        }, ensure_ascii=False, default=str))
+    exporter = get_exporter()
+    if exporter is not None:
+        exporter.export(trace)
+
+
+class TracingMiddleware:
+    """
+    Middleware ASGI: apre una traccia per richiesta, aggiunge Server-Timing alla risposta
+    e alla fine scrive il log ed esporta gli span. È ASGI puro (non BaseHTTPMiddleware)
+    per non bufferizzare le risposte in streaming.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in TRACE_SKIP_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        trace = Trace(f"{scope.get('method', 'GET')} {scope.get('path', '')}")
+        token = _current_trace.set(trace)
+        status = 500
+        
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_trace.reset(token)
+            trace.finish(status)
+            finish_trace(trace)
@@ -0,0 +1,164 @@
+"""
+Pool di thread con nome e dimensione limitata per il lavoro bloccante della pipeline di chat.
+
+Scraping con BeautifulSoup, chiamate HTTP di wikipediaapi, lettura e scrittura del JSON
+della memoria utente e confronti con SequenceMatcher non devono girare sull'event loop:
+un solo worker uvicorn servirebbe una conversazione alla volta. Gli endpoint async
+attendono questi pool (run_in_pool), che restano limitati per non moltiplicare i thread
+sotto carico; coda e thread occupati sono esportati come metriche di saturazione.
+
+Pool disponibili:
+- chat: preparazione del turno (classificazione, ricerche, contesto di personalizzazione)
+- retrieval: ricerche nelle singole fonti e chiamate dirette a Wikipedia
+- memory: lettura e aggiornamento della memoria utente (un thread: le scritture sul file
+  JSON restano in ordine e due turni non si sovrascrivono gli aggiornamenti a vicenda)
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from app.engine.telemetry import MetricsRegistry, registry
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZES = {
+    "chat": int(os.getenv("WORKER_POOL_CHAT_SIZE", "16")),
+    "retrieval": int(os.getenv("WORKER_POOL_RETRIEVAL_SIZE", "16")),
+    "memory": int(os.getenv("WORKER_POOL_MEMORY_SIZE", "1"))
+}
+
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+# Oltre questa attesa in coda il pool è sottodimensionato per il carico
+SATURATION_WARNING_SECONDS = 1.0
+
+
+class WorkerPool:
+    """
+    ThreadPoolExecutor limitato che tiene il conto dei task in coda e in esecuzione.
+    I task girano con una copia dei contextvars del chiamante (memo di /chat/batch,
+    memo delle pagine web del turno).
+    """
+    
+    def __init__(self, name: str, max_workers: int, metrics: MetricsRegistry = registry):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"pool-{name}")
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self.submitted = 0
+        self._labels = {"pool": name}
+        self._active_gauge = metrics.gauge("worker_pool_active", "Task in esecuzione per pool")
+        self._queued_gauge = metrics.gauge("worker_pool_queued", "Task in attesa di un thread libero per pool")
+        self._tasks = metrics.counter("worker_pool_tasks_total", "Task inviati per pool")
+        self._wait_seconds = metrics.histogram("worker_pool_wait_seconds", "Attesa in coda prima dell'esecuzione", WAIT_BUCKETS)
+        self._run_seconds = metrics.histogram("worker_pool_run_seconds", "Durata dei task per pool")
+        metrics.gauge("worker_pool_size", "Thread massimi per pool").set(self.max_workers, self._labels)
+        self._publish()
+    
+    def _publish(self):
+        self._active_gauge.set(self.active, self._labels)
+        self._queued_gauge.set(self.queued, self._labels)
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        context = contextvars.copy_context()
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+            self.submitted += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            self._publish()
+        self._tasks.inc(labels=self._labels)
+        try:
+            future = self._executor.submit(self._run, context, submitted_at, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self.queued -= 1
+                self._publish()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+    
+    def _run(self, context: contextvars.Context, submitted_at: float, fn: Callable, args: tuple, kwargs: dict) -> Any:
+        started = time.monotonic()
+        waited = started - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self._publish()
+        self._wait_seconds.observe(waited, self._labels)
+        if waited > SATURATION_WARNING_SECONDS:
+            logger.warning(f"🧵 Pool {self.name} saturo: task in coda per {waited:.2f}s ({self.max_workers} thread)")
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+                self._publish()
+            self._run_seconds.observe(time.monotonic() - started, self._labels)
+    
+    def _on_done(self, future: Future):
+        # Un task annullato prima di partire non passa da _run: esce dalla coda qui
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+                self._publish()
+    
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Esegue fn nel pool e la attende senza bloccare l'event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {
+                "size": self.max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "peak_queued": self.peak_queued,
+                "submitted": self.submitted
+            }
+        stats["wait_seconds"] = self._wait_seconds.summary()
+        return stats
+
+
+_pools: Dict[str, WorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name: str) -> WorkerPool:
+    """Pool con questo nome, creato al primo uso con la dimensione di POOL_SIZES"""
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = WorkerPool(name, POOL_SIZES.get(name, 4))
+        return pool
+
+
+async def run_in_pool(name: str, fn: Callable, *args, **kwargs) -> Any:
+    """Esegue una funzione bloccante nel pool indicato e ne attende il risultato"""
+    return await get_pool(name).run(fn, *args, **kwargs)
+
+
+def pool_stats() -> Dict[str, Dict]:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
+
+
+def shutdown_pools(wait: bool = True):
+    """Chiude i pool lasciando finire i task già inviati (es. le scritture della memoria)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait)
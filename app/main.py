@@ -1,25 +1,40 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.schemas import ChatRequest, ChatResponse, Game, GameInfo, GameInfoRequest, GameInfoResponse
-from app.ai_engine_ollama import chat_nintendo_ai
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from app.schemas import ChatRequest, ChatResponse, BatchChatRequest, Game, GameInfo, GameInfoRequest, GameInfoResponse
+from app.ai_engine_ollama import chat_nintendo_ai_async, stream_nintendo_ai, close_http_client, scheduler, prompt_eval_tracker, session_store, response_cache, single_flight, throughput_estimator, context_assembler, model_state, backend_pool, hedger, model_router, generation_telemetry, start_background_tasks, stop_background_tasks, QueueFullError
 from app.utils import validate_history, format_for_engine, classify_intent
 from app.services.recommender_service import load_games, filter_by_platform, smart_recommend, get_similar_games
 from app.services.info_service import get_game_info, search_game_info, get_context_for_ai
-from app.services.web_search_service import get_web_context, get_web_game_info, get_web_image_url, extract_entity_name, detect_fandom_series
+from app.services.web_search_service import get_web_context, get_web_game_info, get_web_image_url, extract_entity_name, detect_fandom_series, lookup_web, web_request_scope
+from app.services.retrieval_service import RetrievalFanOut, retrieval_source, fandom_timeout, first_available, is_wiki_answer, retrieval_stats
 from app.services.user_memory_service import (
     update_memory_from_conversation, 
     get_personalization_context, 
-    load_memory, 
+    memory_snapshot, 
+    memory_snapshot_with_version,
     clear_memory,
     detect_save_favorite_intent,
     save_to_favorites,
     set_user_name,
     get_user_profile,
-    generate_personality_report
+    generate_personality_report,
+    memory_writer,
+    memory_store,
+    compact_memory_store,
+    MEMORY_COMPACTION_INTERVAL
 )
 from app.tools.wiki_agent import WikiAgent
+from app.engine.context_budget import context_piece, render_context, PRIORITY_RETRIEVAL, PRIORITY_PERSONALIZATION
+from app.engine.telemetry import registry as metrics_registry
+from app.engine.batch import LookupMemo, memo_scope, memoized, run_bounded
+from app.engine.worker_pools import run_in_pool, pool_stats, shutdown_pools
+from app.engine.tracing import TracingMiddleware, annotate, shutdown_tracing, span, traced
+from typing import AsyncIterator, List, Optional
 import uvicorn
+import asyncio
 import logging
+import os
 import re
 import json
 import time
@@ -38,11 +53,66 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Il browser può leggere le durate per fase anche da un'altra origine
+    expose_headers=["Server-Timing"],
 )
 
+# Span per fase, header Server-Timing e log strutturato per ogni richiesta
+app.add_middleware(TracingMiddleware)
+
 # Inizializza WikiAgent
 wiki_agent = WikiAgent(lang="it")
 
+# /chat/batch: elementi elaborati in parallelo e tentativi quando la coda verso Ollama è piena
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "5000"))
+
+_memory_compaction_task: Optional[asyncio.Task] = None
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    # Backend Ollama saturo: meglio rifiutare subito che far crescere la latenza per tutti
+    logger.warning(f"Richiesta rifiutata, coda Ollama piena (retry tra {exc.retry_after}s)")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Il server è occupato, riprova tra poco.", "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+async def compact_memory_periodically(interval: float = MEMORY_COMPACTION_INTERVAL):
+    """Compattazione periodica della memoria utente: la prima passata, all'avvio, riduce i profili già troppo grandi"""
+    while True:
+        try:
+            await run_in_pool("memory", compact_memory_store)
+        except Exception as e:
+            logger.warning(f"Compattazione della memoria fallita: {e}")
+        await asyncio.sleep(interval)
+
+@app.on_event("startup")
+async def startup_event():
+    global _memory_compaction_task
+    # Ricerca del modello, warmup e health check in background: il worker parte subito, /ready dice quando è pronto
+    start_background_tasks()
+    _memory_compaction_task = asyncio.create_task(compact_memory_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_background_tasks()
+    if _memory_compaction_task is not None:
+        _memory_compaction_task.cancel()
+        try:
+            await _memory_compaction_task
+        except asyncio.CancelledError:
+            pass
+    # Chiude le connessioni keep-alive verso Ollama
+    await close_http_client()
+    # Aspetta i task bloccanti già inviati (es. scritture della memoria) senza fermare l'event loop
+    await asyncio.to_thread(shutdown_pools)
+    # Scrive gli aggiornamenti della memoria ancora in coda
+    await asyncio.to_thread(memory_writer.close)
+    # Invia al collector le tracce ancora in coda
+    await asyncio.to_thread(shutdown_tracing)
+
 def extract_tags_from_response(response: str) -> list:
     words = response.lower().split()
     common_tags = [
@@ -92,6 +162,39 @@ def extract_mood_from_text(text: str) -> list:
     
     return found_moods + tags
 
+def build_wiki_context(wiki_answer: dict, content_label: str = "Contenuto completo", complement: bool = False) -> str:
+    """Contesto per l'AI da una risposta di WikiAgent.answer_multilang (principale o complementare a Fandom)"""
+    lang_info = ""
+    if wiki_answer.get('language') == "it+en":
+        lang_info = " (combinato da Wikipedia italiana e inglese)"
+    elif wiki_answer.get('language') == "en":
+        lang_info = " (da Wikipedia inglese - traduci in italiano)"
+    
+    header = f"\n\n📚 INFORMAZIONI COMPLEMENTARI DA WIKIPEDIA{lang_info}:" if complement else f"📚 INFORMAZIONI DA WIKIPEDIA{lang_info}:"
+    wiki_context = f"""{header}
+
+Pagina: {wiki_answer.get('matched_page', 'N/A')}
+Riassunto: {wiki_answer.get('summary', '')}
+"""
+    if wiki_answer.get('relevant_section'):
+        wiki_context += f"Sezione rilevante: {wiki_answer.get('relevant_section')}\n\n"
+    
+    # Testo completo limitato per non appesantire il prompt
+    full_text = wiki_answer.get('full_text', '')
+    max_chars = 1500 if complement else 2000
+    if full_text:
+        wiki_context += f"{'Contenuto aggiuntivo' if complement else content_label}:\n{full_text[:max_chars]}"
+        if len(full_text) > max_chars:
+            wiki_context += "\n\n[... contenuto troncato ...]"
+    
+    # Aggiungi istruzione per traduzione se c'è contenuto inglese
+    if wiki_answer.get('language') == "en" or wiki_answer.get('language') == "it+en":
+        if complement:
+            wiki_context += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Combina le informazioni da entrambe le lingue se disponibili"
+        else:
+            wiki_context += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Mantieni la struttura e i dettagli, ma adatta il linguaggio all'italiano\n- Combina le informazioni da entrambe le lingue se disponibili"
+    return wiki_context
+
 @app.get("/")
 async def root():
     return {
@@ -99,6 +202,10 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/chat": "POST - Chat with Nintendo Game Advisor",
+            "/chat/stream": "POST - Chat with streaming NDJSON response",
+            "/chat/batch": "POST - Many chat histories at once, NDJSON results in completion order",
+            "/engine/stats": "GET - Live AI engine stats (queue depth)",
+            "/ready": "GET - Readiness: 200 when the model is loaded (warm), 503 otherwise",
             "/game/info": "POST - Get game information",
             "/games/list": "GET - List all games",
             "/games/platform/{platform}": "GET - Games by platform",
@@ -113,423 +220,295 @@ async def root():
         }
     }
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(payload: ChatRequest):
-    logger.info(f"Chat request received. History length: {len(payload.history)}")
+@traced("prepare")
+def prepare_chat_turn(payload: ChatRequest) -> dict:
+    """
+    Valida la cronologia, rileva l'intent e recupera il contesto per il turno di chat.
+    Le ricerche passano da memoized: dentro un lotto (/chat/batch) quelle uguali si fanno una volta sola.
+    Nel turno ogni pagina web viene scaricata una sola volta (web_request_scope).
+    """
+    with web_request_scope():
+        return _prepare_chat_turn(payload)
+
+def _prepare_chat_turn(payload: ChatRequest) -> dict:
+    history_dicts = [{"role": msg.role, "content": msg.content} for msg in payload.history]
     
-    try:
-        history_dicts = [{"role": msg.role, "content": msg.content} for msg in payload.history]
-        
-        validated = validate_history(history_dicts)
-        logger.info(f"Validated history length: {len(validated)}")
-        
-        last_user_message = ""
-        if validated:
-            last_user_msg = [m for m in validated if m.get("role") == "user"]
-            if last_user_msg:
-                last_user_message = last_user_msg[-1].get("content", "")
-        
-        # Controlla PRIMA se l'utente vuole solo salvare nei preferiti (senza altre domande)
-        should_save_favorite = detect_save_favorite_intent(last_user_message)
-        # Considera come richiesta singola se contiene solo parole relative al salvataggio
-        save_only_phrases = ["segna tra i preferiti", "segna nei preferiti", "metti nei preferiti", 
-                            "salva nei preferiti", "aggiungi ai preferiti", "salva questo", 
-                            "metti questo", "segna questo"]
-        is_only_save_request = should_save_favorite and any(phrase in last_user_message.lower() for phrase in save_only_phrases)
+    validated = validate_history(history_dicts)
+    logger.info(f"Validated history length: {len(validated)}")
+    
+    # Un solo snapshot della memoria per tutto il turno (personalizzazione e preferiti)
+    memory, memory_version = memory_snapshot_with_version(payload.user_id)
+    
+    last_user_message = ""
+    if validated:
+        last_user_msg = [m for m in validated if m.get("role") == "user"]
+        if last_user_msg:
+            last_user_message = last_user_msg[-1].get("content", "")
+    
+    # Controlla PRIMA se l'utente vuole solo salvare nei preferiti (senza altre domande)
+    should_save_favorite = detect_save_favorite_intent(last_user_message)
+    # Considera come richiesta singola se contiene solo parole relative al salvataggio
+    save_only_phrases = ["segna tra i preferiti", "segna nei preferiti", "metti nei preferiti", 
+                        "salva nei preferiti", "aggiungi ai preferiti", "salva questo", 
+                        "metti questo", "segna questo"]
+    is_only_save_request = should_save_favorite and any(phrase in last_user_message.lower() for phrase in save_only_phrases)
+    
+    intent = classify_intent(last_user_message)
+    logger.info(f"Detected intent: {intent}")
+    annotate(intent=intent)
+    
+    context = ""
+    game_info = None
+    recommended_game = None
+    all_text = " ".join([m.get("content", "") for m in validated])
+    
+    # Per small_talk o domande generali, prova Wikipedia se sembra una domanda informativa
+    if intent == "small_talk":
+        # Rileva se è una domanda informativa (può essere su giochi o personaggi)
+        info_keywords = [
+            "cos'è", "cosa è", "chi è", "quando", "dove", "perché", "come",
+            "storia di", "storia del", "storia della", "origine", "nascita",
+            "quando è nato", "quando è stato creato", "quando è uscito",
+            "mi parli di", "parlami di", "dimmi di", "raccontami di"
+        ]
+        is_info_query = any(keyword in last_user_message.lower() for keyword in info_keywords)
         
-        intent = classify_intent(last_user_message)
-        logger.info(f"Detected intent: {intent}")
+        if is_info_query and len(last_user_message.split()) > 3:  # Solo per domande abbastanza specifiche
+            # Cerca come gioco o personaggio: Fandom, database locale e Wikipedia in parallelo,
+            # in quest'ordine di preferenza
+            logger.info(f"Small talk con domanda informativa, provo ricerca gioco: {last_user_message}")
+            
+            try:
+                source, found = first_available([
+                    retrieval_source("fandom", lambda: memoized(lookup_web, last_user_message, "", deep_scrape=False)),
+                    retrieval_source("local", lambda: memoized(get_context_for_ai, last_user_message)),
+                    retrieval_source("wikipedia", lambda: memoized(wiki_agent.answer_multilang, last_user_message), is_useful=is_wiki_answer)
+                ])
+                if source == "fandom":
+                    context = found["context"]
+                    logger.info(f"✅ Informazioni trovate su Fandom per small talk")
+                    
+                    # Crea GameInfo se è un gioco (stessa ricerca web, nessuno scraping in più)
+                    web_game_info = found["info"]
+                    if web_game_info:
+                        try:
+                            game_info = GameInfo(**web_game_info)
+                            logger.info(f"Created GameInfo from web for small talk query")
+                        except Exception as e:
+                            logger.warning(f"Failed to create GameInfo from web: {e}")
+                elif source == "local":
+                    context = found
+                    logger.info(f"✅ Informazioni trovate nel database locale per small talk")
+                    search_results = memoized(search_game_info, last_user_message, top_k=1)
+                    if search_results:
+                        try:
+                            game_info_data = search_results[0]
+                            game_info = GameInfo(**game_info_data)
+                            logger.info(f"Found game info in local database for small talk")
+                        except Exception as e:
+                            logger.warning(f"Failed to create GameInfo from local: {e}")
+                elif source == "wikipedia":
+                    context = build_wiki_context(found, "Contenuto")
+                    logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per small talk")
+            except Exception as e:
+                logger.warning(f"Error searching for game info in small talk: {e}")
+    
+    # Se è una richiesta di informazioni, cerca il gioco specifico
+    if intent == "info_request":
+        # Distingui tra richieste su personaggi e richieste su giochi
+        is_character_query = any(phrase in last_user_message.lower() for phrase in [
+            "chi è", "cos'è", "cosa è", "chi e", "cos e", "cosa e",
+            "mi parli di", "parlami di", "dimmi di", "raccontami di",
+            "info su", "informazioni su", "che cos'è", "che cosa è"
+        ])
         
-        context = ""
-        game_info = None
-        recommended_game = None
-        all_text = " ".join([m.get("content", "") for m in validated])
+        # Rileva se l'utente chiede approfondimenti
+        deep_scrape_keywords = [
+            "approfondisci", "dimmi di più", "altre info", "altre informazioni",
+            "dimmi altro", "raccontami di più", "espandi", "più dettagli",
+            "più informazioni", "altro su", "altro riguardo"
+        ]
+        deep_scrape = any(keyword in last_user_message.lower() for keyword in deep_scrape_keywords)
+        if deep_scrape:
+            logger.info("Richiesta di approfondimento rilevata, estraggo tutto il contenuto")
         
-        # Per small_talk o domande generali, prova Wikipedia se sembra una domanda informativa
-        if intent == "small_talk":
-            # Rileva se è una domanda informativa (può essere su giochi o personaggi)
-            info_keywords = [
-                "cos'è", "cosa è", "chi è", "quando", "dove", "perché", "come",
-                "storia di", "storia del", "storia della", "origine", "nascita",
-                "quando è nato", "quando è stato creato", "quando è uscito",
-                "mi parli di", "parlami di", "dimmi di", "raccontami di"
-            ]
-            is_info_query = any(keyword in last_user_message.lower() for keyword in info_keywords)
+        if is_character_query:
+            # Per personaggi, vai direttamente a web (non cercare nel database giochi):
+            # Fandom e Wikipedia in parallelo, Wikipedia usata solo se Fandom non trova nulla
+            logger.info(f"Character query detected, searching web for: {last_user_message}")
             
-            if is_info_query and len(last_user_message.split()) > 3:  # Solo per domande abbastanza specifiche
-                # Prova prima a cercare come gioco (Fandom o database locale)
-                logger.info(f"Small talk con domanda informativa, provo ricerca gioco: {last_user_message}")
-                
-                # Prova Fandom prima
-                try:
-                    deep_scrape = False
-                    web_context = get_web_context(last_user_message, "", deep_scrape=deep_scrape)
-                    if web_context:
-                        context = web_context
-                        logger.info(f"✅ Informazioni trovate su Fandom per small talk")
-                        
-                        # Crea GameInfo se è un gioco
-                        web_game_info = get_web_game_info(last_user_message, "")
-                        if web_game_info:
-                            try:
-                                game_info = GameInfo(**web_game_info)
-                                logger.info(f"Created GameInfo from web for small talk query")
-                            except Exception as e:
-                                logger.warning(f"Failed to create GameInfo from web: {e}")
-                    else:
-                        # Fallback: database locale
-                        local_context = get_context_for_ai(last_user_message)
-                        if local_context:
-                            context = local_context
-                            logger.info(f"✅ Informazioni trovate nel database locale per small talk")
-                            search_results = search_game_info(last_user_message, top_k=1)
-                            if search_results:
-                                try:
-                                    game_info_data = search_results[0]
-                                    game_info = GameInfo(**game_info_data)
-                                    logger.info(f"Found game info in local database for small talk")
-                                except Exception as e:
-                                    logger.warning(f"Failed to create GameInfo from local: {e}")
-                        else:
-                            # Ultimo fallback: Wikipedia
-                            try:
-                                logger.info(f"Trying Wikipedia (multilang) for small talk query: {last_user_message}")
-                                wiki_answer = wiki_agent.answer_multilang(last_user_message)
-                                if "error" not in wiki_answer:
-                                    lang_info = ""
-                                    if wiki_answer.get('language') == "it+en":
-                                        lang_info = " (combinato da Wikipedia italiana e inglese)"
-                                    elif wiki_answer.get('language') == "en":
-                                        lang_info = " (da Wikipedia inglese - traduci in italiano)"
-                                    
-                                    wiki_context = f"""📚 INFORMAZIONI DA WIKIPEDIA{lang_info}:
-
-Pagina: {wiki_answer.get('matched_page', 'N/A')}
-Riassunto: {wiki_answer.get('summary', '')}
-"""
-                                    if wiki_answer.get('relevant_section'):
-                                        wiki_context += f"Sezione rilevante: {wiki_answer.get('relevant_section')}\n\n"
-                                    
-                                    full_text = wiki_answer.get('full_text', '')
-                                    if full_text:
-                                        wiki_context += f"Contenuto:\n{full_text[:2000]}"
-                                        if len(full_text) > 2000:
-                                            wiki_context += "\n\n[... contenuto troncato ...]"
-                                    
-                                    # Aggiungi istruzione per traduzione se c'è contenuto inglese
-                                    if wiki_answer.get('language') == "en" or wiki_answer.get('language') == "it+en":
-                                        wiki_context += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Mantieni la struttura e i dettagli, ma adatta il linguaggio all'italiano\n- Combina le informazioni da entrambe le lingue se disponibili"
-                                    
-                                    context = wiki_context
-                                    logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per small talk")
-                            except Exception as wiki_error:
-                                logger.warning(f"Wikipedia search failed for small talk: {wiki_error}")
-                except Exception as e:
-                    logger.warning(f"Error searching for game info in small talk: {e}")
-        
-        # Se è una richiesta di informazioni, cerca il gioco specifico
-        if intent == "info_request":
-            # Distingui tra richieste su personaggi e richieste su giochi
-            is_character_query = any(phrase in last_user_message.lower() for phrase in [
-                "chi è", "cos'è", "cosa è", "chi e", "cos e", "cosa e",
-                "mi parli di", "parlami di", "dimmi di", "raccontami di",
-                "info su", "informazioni su", "che cos'è", "che cosa è"
+            game_info = None
+            # Passa l'intera query come additional_query per mantenere il contesto (es. "in ace attorney")
+            source, found = first_available([
+                retrieval_source("fandom", lambda: memoized(lookup_web, last_user_message, last_user_message, deep_scrape=deep_scrape), timeout=fandom_timeout(deep_scrape)),
+                retrieval_source("wikipedia", lambda: memoized(wiki_agent.answer_multilang, last_user_message), is_useful=is_wiki_answer)
             ])
-            
-            if is_character_query:
-                # Per personaggi, vai direttamente a web (non cercare nel database giochi)
-                logger.info(f"Character query detected, searching web for: {last_user_message}")
-                
-                # Rileva se l'utente chiede approfondimenti
-                deep_scrape_keywords = [
-                    "approfondisci", "dimmi di più", "altre info", "altre informazioni",
-                    "dimmi altro", "raccontami di più", "espandi", "più dettagli",
-                    "più informazioni", "altro su", "altro riguardo"
-                ]
-                deep_scrape = any(keyword in last_user_message.lower() for keyword in deep_scrape_keywords)
+            if source == "fandom":
+                context = found["context"]
+                # Aggiungi istruzione per generare informazioni diverse
                 if deep_scrape:
-                    logger.info("Richiesta di approfondimento rilevata, estraggo tutto il contenuto")
-                
-                game_info = None  # Inizializza prima del try
+                    context += "\n\n⚠️ ISTRUZIONE IMPORTANTE PER APPROFONDIMENTO:\n- L'utente ha già ricevuto informazioni su questo argomento\n- DEVI fornire informazioni DIVERSE e COMPLEMENTARI rispetto a quelle già date\n- Evita di ripetere le stesse informazioni già fornite\n- Concentrati su aspetti nuovi, dettagli aggiuntivi, curiosità, o prospettive diverse\n- Sii specifico e dettagliato con nuove informazioni"
+                # Crea GameInfo SOLO se c'è un'immagine da mostrare
                 try:
-                    # Passa l'intera query come additional_query per mantenere il contesto (es. "in ace attorney")
-                    web_context = get_web_context(last_user_message, last_user_message, deep_scrape=deep_scrape)
-                    if web_context:
-                        context = web_context
-                        # Aggiungi istruzione per generare informazioni diverse
-                        if deep_scrape:
-                            context += "\n\n⚠️ ISTRUZIONE IMPORTANTE PER APPROFONDIMENTO:\n- L'utente ha già ricevuto informazioni su questo argomento\n- DEVI fornire informazioni DIVERSE e COMPLEMENTARI rispetto a quelle già date\n- Evita di ripetere le stesse informazioni già fornite\n- Concentrati su aspetti nuovi, dettagli aggiuntivi, curiosità, o prospettive diverse\n- Sii specifico e dettagliato con nuove informazioni"
-                        # Crea GameInfo SOLO se c'è un'immagine da mostrare
-                        try:
-                            image_url = get_web_image_url(last_user_message, last_user_message, deep_scrape=deep_scrape)
-                            # Pulisci l'URL da newline e spazi
-                            if image_url:
-                                image_url = image_url.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-                            # Filtra immagini placeholder o base64 vuote
-                            if image_url and not image_url.startswith('data:image') and len(image_url) > 20:
-                                # Crea GameInfo minimale solo con immagine per il frontend
-                                entity_name = extract_entity_name(last_user_message)
-                                if not entity_name:
-                                    entity_name = last_user_message.strip()
-                                game_info = GameInfo(
-                                    title=entity_name.title(),
-                                    platform="Nintendo",
-                                    description="",
-                                    gameplay="",
-                                    difficulty="N/A",
-                                    modes=[],
-                                    keywords=[],
-                                    image_url=image_url
-                                )
-                                logger.info(f"Created GameInfo with image for character: {entity_name}")
-                                logger.info(f"GameInfo image_url value: {game_info.image_url}")
-                                logger.info(f"GameInfo JSON serialized: {game_info.model_dump()}")
-                        except Exception as img_error:
-                            logger.warning(f"Error getting image URL: {img_error}")
-                            game_info = None
-                    else:
-                        game_info = None
-                except Exception as e:
-                    logger.warning(f"Web search failed for character query: {e}")
+                    # Immagine dalla stessa ricerca web del contesto (URL già ripulito)
+                    image_url = found["image_url"]
+                    # Filtra immagini placeholder o base64 vuote
+                    if image_url and not image_url.startswith('data:image') and len(image_url) > 20:
+                        # Crea GameInfo minimale solo con immagine per il frontend
+                        entity_name = extract_entity_name(last_user_message)
+                        if not entity_name:
+                            entity_name = last_user_message.strip()
+                        game_info = GameInfo(
+                            title=entity_name.title(),
+                            platform="Nintendo",
+                            description="",
+                            gameplay="",
+                            difficulty="N/A",
+                            modes=[],
+                            keywords=[],
+                            image_url=image_url
+                        )
+                        logger.info(f"Created GameInfo with image for character: {entity_name}")
+                        logger.info(f"GameInfo image_url value: {game_info.image_url}")
+                        logger.info(f"GameInfo JSON serialized: {game_info.model_dump()}")
+                except Exception as img_error:
+                    logger.warning(f"Error getting image URL: {img_error}")
                     game_info = None
+            elif source == "wikipedia":
+                # Fandom non ha trovato nulla: Wikipedia
+                context = build_wiki_context(found)
+                logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per: {last_user_message}")
+            # Altrimenti si continua senza info web, l'AI userà la sua conoscenza
+        else:
+            # Per giochi: Fandom (più accurato), database locale e Wikipedia in parallelo, in quest'ordine di preferenza
+            logger.info(f"Game query detected, trying Fandom first for: {last_user_message}")
+            
+            fan_out = RetrievalFanOut([
+                retrieval_source("fandom", lambda: memoized(lookup_web, last_user_message, "", deep_scrape=deep_scrape), timeout=fandom_timeout(deep_scrape)),
+                retrieval_source("local", lambda: memoized(get_context_for_ai, last_user_message)),
+                retrieval_source("wikipedia", lambda: memoized(wiki_agent.answer_multilang, last_user_message), is_useful=is_wiki_answer)
+            ])
+            # Con un approfondimento Wikipedia serve anche come fonte complementare di Fandom
+            source, found = fan_out.first(keep=["wikipedia"] if deep_scrape else [])
+            web_context = found["context"] if source == "fandom" else None
+            
+            if source == "fandom":
+                # Fandom ha trovato informazioni - usale come fonte principale
+                context = web_context
                 
-                # Fallback: Prova Wikipedia se Fandom non ha trovato nulla
-                if not context:
-                    try:
-                        logger.info(f"Fandom non ha trovato risultati, provo Wikipedia (multilang) per: {last_user_message}")
-                        wiki_answer = wiki_agent.answer_multilang(last_user_message)
-                        if "error" not in wiki_answer:
-                            lang_info = ""
-                            if wiki_answer.get('language') == "it+en":
-                                lang_info = " (combinato da Wikipedia italiana e inglese)"
-                            elif wiki_answer.get('language') == "en":
-                                lang_info = " (da Wikipedia inglese - traduci in italiano)"
-                            
-                            wiki_context = f"""📚 INFORMAZIONI DA WIKIPEDIA{lang_info}:
-
-Pagina: {wiki_answer.get('matched_page', 'N/A')}
-Riassunto: {wiki_answer.get('summary', '')}
-"""
-                            if wiki_answer.get('relevant_section'):
-                                wiki_context += f"Sezione rilevante: {wiki_answer.get('relevant_section')}\n\n"
-                            
-                            # Aggiungi testo completo (limitato per non appesantire)
-                            full_text = wiki_answer.get('full_text', '')
-                            if full_text:
-                                # Prendi i primi 2000 caratteri
-                                wiki_context += f"Contenuto completo:\n{full_text[:2000]}"
-                                if len(full_text) > 2000:
-                                    wiki_context += "\n\n[... contenuto troncato ...]"
-                            
-                            # Aggiungi istruzione per traduzione se c'è contenuto inglese
-                            if wiki_answer.get('language') == "en" or wiki_answer.get('language') == "it+en":
-                                wiki_context += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Mantieni la struttura e i dettagli, ma adatta il linguaggio all'italiano\n- Combina le informazioni da entrambe le lingue se disponibili"
-                            
-                            context = wiki_context
-                            logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per: {last_user_message}")
-                    except Exception as wiki_error:
-                        logger.warning(f"Wikipedia search failed: {wiki_error}")
-                        # Continua senza info web, l'AI userà la sua conoscenza
-            else:
-                # Per giochi, prova prima Fandom (più accurato), poi database locale
-                logger.info(f"Game query detected, trying Fandom first for: {last_user_message}")
-                
-                # Rileva se l'utente chiede approfondimenti
-                deep_scrape_keywords = [
-                    "approfondisci", "dimmi di più", "altre info", "altre informazioni",
-                    "dimmi altro", "raccontami di più", "espandi", "più dettagli",
-                    "più informazioni", "altro su", "altro riguardo"
-                ]
-                deep_scrape = any(keyword in last_user_message.lower() for keyword in deep_scrape_keywords)
+                # Se è una richiesta di approfondimento, aggiungi anche Wikipedia come fonte complementare
                 if deep_scrape:
-                    logger.info("Richiesta di approfondimento rilevata, estraggo tutto il contenuto")
-                
-                web_context = get_web_context(last_user_message, "", deep_scrape=deep_scrape)
-                
-                if web_context:
-                    # Fandom ha trovato informazioni - usale come fonte principale
-                    context = web_context
-                    
-                    # Se è una richiesta di approfondimento, aggiungi anche Wikipedia come fonte complementare
-                    if deep_scrape:
-                        try:
-                            logger.info(f"Richiesta approfondimento: aggiungo Wikipedia (multilang) come fonte complementare")
-                            wiki_answer = wiki_agent.answer_multilang(last_user_message)
-                            if "error" not in wiki_answer:
-                                lang_info = ""
-                                if wiki_answer.get('language') == "it+en":
-                                    lang_info = " (combinato da Wikipedia italiana e inglese)"
-                                elif wiki_answer.get('language') == "en":
-                                    lang_info = " (da Wikipedia inglese - traduci in italiano)"
-                                
-                                wiki_complement = f"""
-
-📚 INFORMAZIONI COMPLEMENTARI DA WIKIPEDIA{lang_info}:
-
-Pagina: {wiki_answer.get('matched_page', 'N/A')}
-Riassunto: {wiki_answer.get('summary', '')}
-"""
-                                if wiki_answer.get('relevant_section'):
-                                    wiki_complement += f"Sezione rilevante: {wiki_answer.get('relevant_section')}\n\n"
-                                
-                                full_text = wiki_answer.get('full_text', '')
-                                if full_text:
-                                    # Per approfondimenti, prendi una porzione più grande
-                                    wiki_complement += f"Contenuto aggiuntivo:\n{full_text[:1500]}"
-                                    if len(full_text) > 1500:
-                                        wiki_complement += "\n\n[... contenuto troncato ...]"
-                                
-                                # Aggiungi istruzione per traduzione se c'è contenuto inglese
-                                if wiki_answer.get('language') == "en" or wiki_answer.get('language') == "it+en":
-                                    wiki_complement += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Combina le informazioni da entrambe le lingue se disponibili"
-                                
-                                context += wiki_complement
-                                logger.info(f"✅ Aggiunte informazioni complementari da Wikipedia (multilang)")
-                        except Exception as wiki_error:
-                            logger.warning(f"Failed to get Wikipedia complement: {wiki_error}")
+                    wiki_answer = fan_out.result("wikipedia")
+                    if wiki_answer:
+                        context += build_wiki_context(wiki_answer, complement=True)
+                        logger.info(f"✅ Aggiunte informazioni complementari da Wikipedia (multilang)")
                     
                     # Aggiungi istruzione per generare informazioni diverse
-                    if deep_scrape:
-                        context += "\n\n⚠️ ISTRUZIONE IMPORTANTE PER APPROFONDIMENTO:\n- L'utente ha già ricevuto informazioni su questo argomento\n- DEVI fornire informazioni DIVERSE e COMPLEMENTARI rispetto a quelle già date\n- Evita di ripetere le stesse informazioni già fornite\n- Concentrati su aspetti nuovi, dettagli aggiuntivi, curiosità, o prospettive diverse\n- Sii specifico e dettagliato con nuove informazioni\n- Combina le informazioni da Fandom e Wikipedia per una risposta completa"
-                    logger.info(f"✅ Using Fandom as primary source for game info")
-                else:
-                    # Fallback: cerca nel database locale
-                    context = get_context_for_ai(last_user_message)
-                    if context:
-                        search_results = search_game_info(last_user_message, top_k=1)
-                        if search_results:
-                            try:
-                                game_info_data = search_results[0]
-                                game_info = GameInfo(**game_info_data)
-                                logger.info(f"Found game info in local database: {game_info_data.get('title')}")
-                            except Exception as e:
-                                logger.warning(f"Failed to create GameInfo from local: {e}")
-                    
-                    # Se ancora non trovato, prova Wikipedia prima della ricerca web tradizionale
-                    if not context:
-                        try:
-                            logger.info(f"Game not found in Fandom or local DB, trying Wikipedia (multilang) for: {last_user_message}")
-                            wiki_answer = wiki_agent.answer_multilang(last_user_message)
-                            if "error" not in wiki_answer:
-                                lang_info = ""
-                                if wiki_answer.get('language') == "it+en":
-                                    lang_info = " (combinato da Wikipedia italiana e inglese)"
-                                elif wiki_answer.get('language') == "en":
-                                    lang_info = " (da Wikipedia inglese - traduci in italiano)"
-                                
-                                wiki_context = f"""📚 INFORMAZIONI DA WIKIPEDIA{lang_info}:
-
-Pagina: {wiki_answer.get('matched_page', 'N/A')}
-Riassunto: {wiki_answer.get('summary', '')}
-"""
-                                if wiki_answer.get('relevant_section'):
-                                    wiki_context += f"Sezione rilevante: {wiki_answer.get('relevant_section')}\n\n"
-                                
-                                # Aggiungi testo completo (limitato)
-                                full_text = wiki_answer.get('full_text', '')
-                                if full_text:
-                                    wiki_context += f"Contenuto completo:\n{full_text[:2000]}"
-                                    if len(full_text) > 2000:
-                                        wiki_context += "\n\n[... contenuto troncato ...]"
-                                
-                                # Aggiungi istruzione per traduzione se c'è contenuto inglese
-                                if wiki_answer.get('language') == "en" or wiki_answer.get('language') == "it+en":
-                                    wiki_context += "\n\n⚠️ ISTRUZIONE IMPORTANTE:\n- Se ci sono informazioni in inglese, traduci tutto in italiano in modo naturale e fluido\n- Mantieni la struttura e i dettagli, ma adatta il linguaggio all'italiano\n- Combina le informazioni da entrambe le lingue se disponibili"
-                                
-                                context = wiki_context
-                                logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per gioco: {last_user_message}")
-                                
-                                # Crea GameInfo anche da Wikipedia se possibile
-                                try:
-                                    wiki_game_info = {
-                                        "title": wiki_answer.get('matched_page', ''),
-                                        "platform": "Nintendo",
-                                        "description": wiki_answer.get('summary', '')[:400],
-                                        "gameplay": wiki_answer.get('full_text', '')[:1000],
-                                        "difficulty": "N/A",
-                                        "modes": [],
-                                        "keywords": []
-                                    }
-                                    game_info = GameInfo(**wiki_game_info)
-                                    logger.info(f"Created GameInfo from Wikipedia")
-                                except Exception as wiki_info_error:
-                                    logger.warning(f"Failed to create GameInfo from Wikipedia: {wiki_info_error}")
-                        except Exception as wiki_error:
-                            logger.warning(f"Wikipedia search failed: {wiki_error}")
-                        
-                        # Ultimo fallback: ricerca web tradizionale
-                        if not context:
-                            logger.info(f"Wikipedia non ha trovato risultati, trying traditional web search")
-                            web_context = get_web_context(last_user_message, "")
-                            if web_context:
-                                context = web_context
+                    context += "\n\n⚠️ ISTRUZIONE IMPORTANTE PER APPROFONDIMENTO:\n- L'utente ha già ricevuto informazioni su questo argomento\n- DEVI fornire informazioni DIVERSE e COMPLEMENTARI rispetto a quelle già date\n- Evita di ripetere le stesse informazioni già fornite\n- Concentrati su aspetti nuovi, dettagli aggiuntivi, curiosità, o prospettive diverse\n- Sii specifico e dettagliato con nuove informazioni\n- Combina le informazioni da Fandom e Wikipedia per una risposta completa"
+                logger.info(f"✅ Using Fandom as primary source for game info")
+            elif source == "local":
+                context = found
+                search_results = memoized(search_game_info, last_user_message, top_k=1)
+                if search_results:
+                    try:
+                        game_info_data = search_results[0]
+                        game_info = GameInfo(**game_info_data)
+                        logger.info(f"Found game info in local database: {game_info_data.get('title')}")
+                    except Exception as e:
+                        logger.warning(f"Failed to create GameInfo from local: {e}")
+            elif source == "wikipedia":
+                context = build_wiki_context(found)
+                logger.info(f"✅ Informazioni trovate su Wikipedia (multilang) per gioco: {last_user_message}")
                 
-                # Crea GameInfo strutturato da web per il frontend
-                # Verifica se è un personaggio controllando se detect_fandom_series trova qualcosa
+                # Crea GameInfo anche da Wikipedia se possibile
                 try:
-                    entity_name = extract_entity_name(last_user_message)
-                    if not entity_name:
-                        entity_name = last_user_message.strip()
-                    is_character = detect_fandom_series(entity_name, last_user_message) is not None
-                except Exception as e:
-                    logger.warning(f"Error detecting character: {e}")
+                    wiki_game_info = {
+                        "title": found.get('matched_page', ''),
+                        "platform": "Nintendo",
+                        "description": found.get('summary', '')[:400],
+                        "gameplay": found.get('full_text', '')[:1000],
+                        "difficulty": "N/A",
+                        "modes": [],
+                        "keywords": []
+                    }
+                    game_info = GameInfo(**wiki_game_info)
+                    logger.info(f"Created GameInfo from Wikipedia")
+                except Exception as wiki_info_error:
+                    logger.warning(f"Failed to create GameInfo from Wikipedia: {wiki_info_error}")
+            elif deep_scrape:
+                # Ultimo fallback: ricerca web senza approfondimento
+                # (senza approfondimento è la stessa ricerca Fandom appena fallita)
+                logger.info(f"Nessuna fonte ha trovato risultati, trying traditional web search")
+                web_context = memoized(get_web_context, last_user_message, "")
+                if web_context:
+                    context = web_context
+            
+            # Crea GameInfo strutturato da web per il frontend
+            # Verifica se è un personaggio controllando se detect_fandom_series trova qualcosa
+            try:
+                entity_name = extract_entity_name(last_user_message)
+                if not entity_name:
                     entity_name = last_user_message.strip()
-                    is_character = False
-                
-                if not game_info and web_context:
-                    if is_character:
-                        # È un personaggio - crea GameInfo con immagine se disponibile
-                        try:
-                            image_url = get_web_image_url(last_user_message, last_user_message)
-                            # Pulisci l'URL da newline e spazi
-                            if image_url:
-                                image_url = image_url.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-                            if image_url and not image_url.startswith('data:image') and len(image_url) > 20:
-                                game_info = GameInfo(
-                                    title=entity_name.title(),
-                                    platform="Nintendo",
-                                    description="",
-                                    gameplay="",
-                                    difficulty="N/A",
-                                    modes=[],
-                                    keywords=[],
-                                    image_url=image_url
-                                )
-                                logger.info(f"Created GameInfo with image for character: {entity_name}")
-                            else:
-                                game_info = None
-                        except Exception as img_error:
-                            logger.warning(f"Error getting image for character: {img_error}")
+                is_character = detect_fandom_series(entity_name, last_user_message) is not None
+            except Exception as e:
+                logger.warning(f"Error detecting character: {e}")
+                entity_name = last_user_message.strip()
+                is_character = False
+            
+            if not game_info and web_context:
+                if is_character:
+                    # È un personaggio - crea GameInfo con immagine se disponibile
+                    try:
+                        image_url = memoized(get_web_image_url, last_user_message, last_user_message)
+                        # Pulisci l'URL da newline e spazi
+                        if image_url:
+                            image_url = image_url.strip().replace('\n', '').replace('\r', '').replace(' ', '')
+                        if image_url and not image_url.startswith('data:image') and len(image_url) > 20:
+                            game_info = GameInfo(
+                                title=entity_name.title(),
+                                platform="Nintendo",
+                                description="",
+                                gameplay="",
+                                difficulty="N/A",
+                                modes=[],
+                                keywords=[],
+                                image_url=image_url
+                            )
+                            logger.info(f"Created GameInfo with image for character: {entity_name}")
+                        else:
                             game_info = None
-                    else:
-                        # È un gioco - crea GameInfo completo
-                        web_game_info = get_web_game_info(last_user_message, "")
-                        if web_game_info:
-                            try:
-                                game_info = GameInfo(**web_game_info)
-                                logger.info(f"Created GameInfo from web for game query")
-                            except Exception as e:
-                                logger.warning(f"Failed to create GameInfo from web: {e}")
+                    except Exception as img_error:
+                        logger.warning(f"Error getting image for character: {img_error}")
+                        game_info = None
+                else:
+                    # È un gioco - crea GameInfo completo
+                    web_game_info = memoized(get_web_game_info, last_user_message, "")
+                    if web_game_info:
+                        try:
+                            game_info = GameInfo(**web_game_info)
+                            logger.info(f"Created GameInfo from web for game query")
+                        except Exception as e:
+                            logger.warning(f"Failed to create GameInfo from web: {e}")
+    
+    # Se è una richiesta di raccomandazione, trova il gioco PRIMA di generare la risposta
+    elif intent == "recommendation_request":
+        # Estrai mood e tags dall'input dell'utente
+        user_mood_tags = extract_mood_from_text(all_text)
+        games = load_games()
+        recommended = smart_recommend(games, user_mood_tags, user_text=all_text)
         
-        # Se è una richiesta di raccomandazione, trova il gioco PRIMA di generare la risposta
-        elif intent == "recommendation_request":
-            # Estrai mood e tags dall'input dell'utente
-            user_mood_tags = extract_mood_from_text(all_text)
-            games = load_games()
-            recommended = smart_recommend(games, user_mood_tags, user_text=all_text)
+        if recommended:
+            recommended_game = Game(
+                title=recommended.get("title", ""),
+                platform=recommended.get("platform", ""),
+                tags=recommended.get("tags", []),
+                mood=recommended.get("mood", [])
+            )
             
-            if recommended:
-                recommended_game = Game(
-                    title=recommended.get("title", ""),
-                    platform=recommended.get("platform", ""),
-                    tags=recommended.get("tags", []),
-                    mood=recommended.get("mood", [])
-                )
-                
-                # Ottieni informazioni dettagliate sul gioco raccomandato
-                game_details = get_game_info(recommended.get("title", ""))
-                if game_details:
-                    context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
+            # Ottieni informazioni dettagliate sul gioco raccomandato
+            game_details = memoized(get_game_info, recommended.get("title", ""))
+            if game_details:
+                context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
 
 Piattaforma: {recommended.get('platform', '')}
 Tags: {', '.join(recommended.get('tags', []))}
@@ -551,11 +530,11 @@ Modalità: {', '.join(game_details.get('modes', []))}
 - Usa le informazioni sopra per dare dettagli concreti sul gameplay
 - Non essere vago o generico!
 - Se l'utente non ha specificato la console, chiedigliela per essere più preciso"""
-                else:
-                    # Se non trovato localmente, prova ricerca web
-                    web_info = get_web_context(recommended.get('title', ''), "")
-                    if web_info:
-                        context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
+            else:
+                # Se non trovato localmente, prova ricerca web
+                web_info = memoized(get_web_context, recommended.get('title', ''), "")
+                if web_info:
+                    context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
 
 Piattaforma: {recommended.get('platform', '')}
 Tags: {', '.join(recommended.get('tags', []))}
@@ -569,18 +548,18 @@ Mood: {', '.join(recommended.get('mood', []))}
 - Usa le informazioni web sopra se rilevanti
 - Sii entusiasta, specifico e coinvolgente
 - Se l'utente non ha specificato la console, chiedigliela per essere più preciso"""
-                        # Crea GameInfo anche da web per il frontend
-                        web_game_info = get_web_game_info(recommended.get('title', ''), "")
-                        if web_game_info:
-                            try:
-                                # Usa piattaforma dal recommended se disponibile
-                                if recommended.get('platform'):
-                                    web_game_info['platform'] = recommended.get('platform')
-                                game_info = GameInfo(**web_game_info)
-                            except Exception as e:
-                                logger.warning(f"Failed to create GameInfo from web for recommendation: {e}")
-                    else:
-                        context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
+                    # Crea GameInfo anche da web per il frontend
+                    web_game_info = memoized(get_web_game_info, recommended.get('title', ''), "")
+                    if web_game_info:
+                        try:
+                            # Usa piattaforma dal recommended se disponibile
+                            if recommended.get('platform'):
+                                web_game_info['platform'] = recommended.get('platform')
+                            game_info = GameInfo(**web_game_info)
+                        except Exception as e:
+                            logger.warning(f"Failed to create GameInfo from web for recommendation: {e}")
+                else:
+                    context = f"""🎮 GIOCO RACCOMANDATO PER L'UTENTE: {recommended.get('title', '')}
 
 Piattaforma: {recommended.get('platform', '')}
 Tags: {', '.join(recommended.get('tags', []))}
@@ -591,164 +570,387 @@ Mood: {', '.join(recommended.get('mood', []))}
 - Spiega PERCHÉ questo gioco è perfetto per l'utente basandoti sul suo umore: {', '.join(user_mood_tags) if user_mood_tags else 'generale'}
 - Sii entusiasta, specifico e coinvolgente
 - Se l'utente non ha specificato la console, chiedigliela per essere più preciso"""
+
+    # Fonti recuperate e personalizzazione restano pezzi separati: se il prompt non sta in num_ctx
+    # il motore taglia prima la personalizzazione e solo dopo le fonti
+    context_pieces = []
+    if context:
+        context_pieces.append(context_piece(context, PRIORITY_RETRIEVAL, "retrieval"))
+    
+    # Aggiungi contesto di personalizzazione dalla memoria
+    # Già in cache se la memoria dell'utente non è cambiata dall'ultimo turno
+    personalization_context = get_personalization_context(memory, payload.user_id, memory_version)
+    if personalization_context:
+        context_pieces.append(context_piece(personalization_context, PRIORITY_PERSONALIZATION, "personalization"))
+    context = render_context(context_pieces)
+    
+    return {
+        "validated": validated,
+        "last_user_message": last_user_message,
+        "intent": intent,
+        "context": context,
+        "context_pieces": context_pieces,
+        "game_info": game_info,
+        "recommended_game": recommended_game,
+        "is_only_save_request": is_only_save_request,
+        "session_id": payload.session_id,
+        "latency_budget": payload.latency_budget,
+        "user_id": payload.user_id,
+        "memory": memory
+    }
+
+@traced("memory_write")
+def handle_save_only_request(last_user_message: str, memory: dict, user_id: Optional[str] = None) -> str:
+    """Gestisce una richiesta di solo salvataggio nei preferiti senza chiamare l'AI (memory: snapshot del turno)"""
+    from app.services.user_memory_service import extract_game_names
+    
+    # Prova a trovare il gioco da salvare
+    games_in_message = extract_game_names(last_user_message)
+    if not games_in_message and memory.get("provided_info"):
+        last_info = memory["provided_info"][-1]
+        games_in_message = [last_info.get("title", "")]
+    
+    if games_in_message:
+        game_name_to_save = games_in_message[0]
+        game_info_from_memory = None
+        for info in memory.get("provided_info", []):
+            if info.get("title", "").lower() == game_name_to_save.lower():
+                game_info_from_memory = info
+                break
         
-        # Aggiungi contesto di personalizzazione dalla memoria
-        personalization_context = get_personalization_context()
-        if personalization_context:
-            if context:
-                context = context + "\n\n" + personalization_context
-            else:
-                context = personalization_context
+        saved_to_favorites = save_to_favorites(game_name_to_save, game_info_from_memory, user_id=user_id)
+        if saved_to_favorites:
+            reply = f"✅ Ho salvato '{game_name_to_save}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo."
+        else:
+            reply = f"'{game_name_to_save}' è già nei tuoi preferiti!"
+    else:
+        reply = "Non ho trovato un gioco da salvare. Chiedimi prima informazioni su un gioco specifico!"
+    return reply
+
+def get_fallback_reply(intent: str) -> str:
+    """Messaggio di fallback quando Ollama restituisce una risposta vuota"""
+    if intent == "small_talk":
+        return "Ciao! Sono qui per aiutarti con i giochi Nintendo! 🎮 Come posso aiutarti oggi?"
+    elif intent == "recommendation_request":
+        return "Mi dispiace, non sono riuscito a generare una raccomandazione. Potresti provare a descrivere meglio il tipo di gioco che cerchi?"
+    elif intent == "info_request":
+        return "Mi dispiace, non sono riuscito a recuperare le informazioni richieste. Potresti riprovare con una domanda più specifica?"
+    return "Mi dispiace, c'è stato un problema nella generazione della risposta. Potresti riprovare?"
+
+@traced("memory_write")
+def finalize_chat_turn(turn: dict, reply: str) -> str:
+    """Gestisce i preferiti e aggiorna la memoria dopo la generazione della risposta"""
+    last_user_message = turn["last_user_message"]
+    game_info = turn["game_info"]
+    recommended_game = turn["recommended_game"]
+    is_only_save_request = turn["is_only_save_request"]
+    user_id = turn["user_id"]
+    
+    # Controlla se l'utente vuole salvare nei preferiti (solo se non è già stato gestito)
+    if not is_only_save_request:
+        should_save_favorite = detect_save_favorite_intent(last_user_message)
+        saved_to_favorites = False
         
-        # Se è solo una richiesta di salvataggio, gestiscila direttamente senza chiamare l'AI
-        if is_only_save_request:
-            from app.services.user_memory_service import extract_game_names, load_memory
-            memory = load_memory()
+        if should_save_favorite:
+            # Prova a salvare il gioco corrente
+            game_to_save = None
+            game_name_to_save = None
             
-            # Prova a trovare il gioco da salvare
-            games_in_message = extract_game_names(last_user_message)
-            if not games_in_message and memory.get("provided_info"):
-                last_info = memory["provided_info"][-1]
-                games_in_message = [last_info.get("title", "")]
-            
-            if games_in_message:
-                game_name_to_save = games_in_message[0]
-                game_info_from_memory = None
-                for info in memory.get("provided_info", []):
-                    if info.get("title", "").lower() == game_name_to_save.lower():
-                        game_info_from_memory = info
-                        break
+            if game_info:
+                game_to_save = game_info.model_dump() if hasattr(game_info, 'model_dump') else game_info.dict()
+                game_name_to_save = game_info.title
+                saved_to_favorites = save_to_favorites(game_name_to_save, game_to_save, user_id=user_id)
+            elif recommended_game:
+                game_to_save = recommended_game.model_dump() if hasattr(recommended_game, 'model_dump') else recommended_game.dict()
+                game_name_to_save = recommended_game.title
+                saved_to_favorites = save_to_favorites(game_name_to_save, game_to_save, user_id=user_id)
+            else:
+                # Se non c'è game_info nel contesto, prova a estrarre il nome del gioco dal messaggio
+                # o cercarlo nella memoria recente
+                from app.services.user_memory_service import extract_game_names
+                memory = turn["memory"]
                 
-                saved_to_favorites = save_to_favorites(game_name_to_save, game_info_from_memory)
-                if saved_to_favorites:
-                    reply = f"✅ Ho salvato '{game_name_to_save}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo."
+                # Estrai nomi di giochi dal messaggio
+                games_in_message = extract_game_names(last_user_message)
+                
+                # Cerca anche nei giochi menzionati di recente o nelle info fornite
+                if not games_in_message and memory.get("provided_info"):
+                    # Prendi l'ultimo gioco di cui si sono chiesti info
+                    last_info = memory["provided_info"][-1]
+                    games_in_message = [last_info.get("title", "")]
+                
+                if games_in_message:
+                    game_name_to_save = games_in_message[0]
+                    # Cerca info del gioco nella memoria
+                    game_info_from_memory = None
+                    for info in memory.get("provided_info", []):
+                        if info.get("title", "").lower() == game_name_to_save.lower():
+                            game_info_from_memory = info
+                            break
+                    
+                    saved_to_favorites = save_to_favorites(game_name_to_save, game_info_from_memory, user_id=user_id)
+            
+            if saved_to_favorites:
+                # Aggiungi conferma alla risposta solo se non è già vuota o di errore
+                game_name = game_name_to_save or (game_info.title if game_info else (recommended_game.title if recommended_game else "questo gioco"))
+                if reply and "non sono riuscito" not in reply.lower():
+                    reply = f"✅ Ho salvato '{game_name}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo.\n\n{reply}"
                 else:
-                    reply = f"'{game_name_to_save}' è già nei tuoi preferiti!"
-            else:
-                reply = "Non ho trovato un gioco da salvare. Chiedimi prima informazioni su un gioco specifico!"
+                    # Se la risposta è vuota o di errore, usa solo la conferma
+                    reply = f"✅ Ho salvato '{game_name}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo."
+            elif should_save_favorite:
+                # Se voleva salvare ma non c'è un gioco da salvare
+                if reply and "non sono riuscito" not in reply.lower():
+                    reply = "Non ho trovato un gioco da salvare nei preferiti. Chiedimi informazioni su un gioco specifico e poi chiedi di salvarlo!\n\n" + reply
+                else:
+                    reply = "Non ho trovato un gioco da salvare nei preferiti. Chiedimi informazioni su un gioco specifico e poi chiedi di salvarlo!"
+    
+    # Salva informazioni nella memoria per personalizzazione futura
+    try:
+        game_info_dict = None
+        if game_info:
+            game_info_dict = game_info.model_dump() if hasattr(game_info, 'model_dump') else game_info.dict()
+        
+        recommended_game_dict = None
+        if recommended_game:
+            recommended_game_dict = recommended_game.model_dump() if hasattr(recommended_game, 'model_dump') else recommended_game.dict()
+        
+        update_memory_from_conversation(
+            user_message=last_user_message,
+            ai_response=reply,
+            game_info=game_info_dict,
+            recommended_game=recommended_game_dict,
+            user_id=user_id
+        )
+        logger.info("Memory updated successfully")
+    except Exception as mem_error:
+        logger.warning(f"Error updating memory: {mem_error}")
+        # Non bloccare la risposta se c'è un errore nella memoria
+    
+    return reply
+
+async def generate_turn_reply(turn: dict, batch: bool = False) -> str:
+    """
+    Genera la risposta dell'AI per un turno già preparato (fallback se vuota o in errore).
+    Con batch la risposta non passa dalla cache e aspetta nella corsia a bassa priorità.
+    """
+    intent = turn["intent"]
+    context = turn["context"]
+    formatted = format_for_engine(turn["validated"])
+    
+    try:
+        start_time = time.time()
+        logger.info("⏱️  Inizio generazione risposta AI...")
+        # Per small_talk, usa parametri più veloci (risposte più brevi)
+        # MA solo se non abbiamo trovato contesto (vero small talk)
+        # Se abbiamo contesto, significa che è una richiesta informativa e serve risposta completa
+        is_small_talk = intent == "small_talk" and not context
+        with span("ollama"):
+            reply = await chat_nintendo_ai_async(formatted, context=turn["context_pieces"], fast_mode=is_small_talk, session_id=turn["session_id"], latency_budget=turn["latency_budget"], intent=intent, batch=batch)
+        elapsed_time = time.time() - start_time
+        logger.info(f"⏱️  Tempo totale per generare la risposta: {elapsed_time:.2f} secondi ({elapsed_time/60:.2f} minuti)")
+        
+        # Se la risposta è vuota, usa un messaggio di fallback
+        if not reply or len(reply.strip()) == 0:
+            logger.warning("⚠️ Risposta vuota ricevuta da Ollama, uso messaggio di fallback")
+            reply = get_fallback_reply(intent)
+    except QueueFullError:
+        raise
+    except Exception as e:
+        elapsed_time = time.time() - start_time if 'start_time' in locals() else 0
+        logger.error(f"Error in AI response generation dopo {elapsed_time:.2f} secondi: {e}")
+        reply = "Mi dispiace, c'è stato un errore nella generazione della risposta. Puoi riprovare con una domanda diversa sui giochi Nintendo?"
+    return reply
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(payload: ChatRequest):
+    logger.info(f"Chat request received. History length: {len(payload.history)}")
+    
+    try:
+        # Ricerche, scraping e file della memoria sono bloccanti: girano nei worker pool
+        turn = await run_in_pool("chat", prepare_chat_turn, payload)
+        
+        # Se è solo una richiesta di salvataggio, gestiscila direttamente senza chiamare l'AI
+        if turn["is_only_save_request"]:
+            reply = await run_in_pool("memory", handle_save_only_request, turn["last_user_message"], turn["memory"], turn["user_id"])
         else:
-            formatted = format_for_engine(validated)
-            
-            try:
-                start_time = time.time()
-                logger.info("⏱️  Inizio generazione risposta AI...")
-                # Per small_talk, usa parametri più veloci (risposte più brevi)
-                # MA solo se non abbiamo trovato contesto (vero small talk)
-                # Se abbiamo contesto, significa che è una richiesta informativa e serve risposta completa
-                is_small_talk = intent == "small_talk" and not context
-                reply = chat_nintendo_ai(formatted, context=context, fast_mode=is_small_talk)
-                elapsed_time = time.time() - start_time
-                logger.info(f"⏱️  Tempo totale per generare la risposta: {elapsed_time:.2f} secondi ({elapsed_time/60:.2f} minuti)")
-                
-                # Se la risposta è vuota, usa un messaggio di fallback
-                if not reply or len(reply.strip()) == 0:
-                    logger.warning("⚠️ Risposta vuota ricevuta da Ollama, uso messaggio di fallback")
-                    if intent == "small_talk":
-                        reply = "Ciao! Sono qui per aiutarti con i giochi Nintendo! 🎮 Come posso aiutarti oggi?"
-                    elif intent == "recommendation_request":
-                        reply = "Mi dispiace, non sono riuscito a generare una raccomandazione. Potresti provare a descrivere meglio il tipo di gioco che cerchi?"
-                    elif intent == "info_request":
-                        reply = "Mi dispiace, non sono riuscito a recuperare le informazioni richieste. Potresti riprovare con una domanda più specifica?"
-                    else:
-                        reply = "Mi dispiace, c'è stato un problema nella generazione della risposta. Potresti riprovare?"
-            except Exception as e:
-                elapsed_time = time.time() - start_time if 'start_time' in locals() else 0
-                logger.error(f"Error in AI response generation dopo {elapsed_time:.2f} secondi: {e}")
-                reply = "Mi dispiace, c'è stato un errore nella generazione della risposta. Puoi riprovare con una domanda diversa sui giochi Nintendo?"
+            reply = await generate_turn_reply(turn)
         
         # NON cercare giochi raccomandati automaticamente se non esplicitamente richiesto
         # I giochi raccomandati vengono mostrati SOLO quando l'intent è "recommendation_request"
         # Questo evita di mostrare card non inerenti quando l'utente chiede solo informazioni
         
         logger.info("Chat response generated successfully")
-        logger.info(f"Returning response with info: {game_info is not None}, recommended_game: {recommended_game is not None}")
-        
-        # Controlla se l'utente vuole salvare nei preferiti (solo se non è già stato gestito)
-        if not is_only_save_request:
-            should_save_favorite = detect_save_favorite_intent(last_user_message)
-            saved_to_favorites = False
-            
-            if should_save_favorite:
-                # Prova a salvare il gioco corrente
-                game_to_save = None
-                game_name_to_save = None
-                
-                if game_info:
-                    game_to_save = game_info.model_dump() if hasattr(game_info, 'model_dump') else game_info.dict()
-                    game_name_to_save = game_info.title
-                    saved_to_favorites = save_to_favorites(game_name_to_save, game_to_save)
-                elif recommended_game:
-                    game_to_save = recommended_game.model_dump() if hasattr(recommended_game, 'model_dump') else recommended_game.dict()
-                    game_name_to_save = recommended_game.title
-                    saved_to_favorites = save_to_favorites(game_name_to_save, game_to_save)
-                else:
-                    # Se non c'è game_info nel contesto, prova a estrarre il nome del gioco dal messaggio
-                    # o cercarlo nella memoria recente
-                    from app.services.user_memory_service import extract_game_names, load_memory
-                    memory = load_memory()
-                    
-                    # Estrai nomi di giochi dal messaggio
-                    games_in_message = extract_game_names(last_user_message)
-                    
-                    # Cerca anche nei giochi menzionati di recente o nelle info fornite
-                    if not games_in_message and memory.get("provided_info"):
-                        # Prendi l'ultimo gioco di cui si sono chiesti info
-                        last_info = memory["provided_info"][-1]
-                        games_in_message = [last_info.get("title", "")]
-                    
-                    if games_in_message:
-                        game_name_to_save = games_in_message[0]
-                        # Cerca info del gioco nella memoria
-                        game_info_from_memory = None
-                        for info in memory.get("provided_info", []):
-                            if info.get("title", "").lower() == game_name_to_save.lower():
-                                game_info_from_memory = info
-                                break
-                        
-                        saved_to_favorites = save_to_favorites(game_name_to_save, game_info_from_memory)
-                
-                if saved_to_favorites:
-                    # Aggiungi conferma alla risposta solo se non è già vuota o di errore
-                    game_name = game_name_to_save or (game_info.title if game_info else (recommended_game.title if recommended_game else "questo gioco"))
-                    if reply and "non sono riuscito" not in reply.lower():
-                        reply = f"✅ Ho salvato '{game_name}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo.\n\n{reply}"
-                    else:
-                        # Se la risposta è vuota o di errore, usa solo la conferma
-                        reply = f"✅ Ho salvato '{game_name}' nei tuoi preferiti! Puoi vederlo nella sezione Profilo."
-                elif should_save_favorite:
-                    # Se voleva salvare ma non c'è un gioco da salvare
-                    if reply and "non sono riuscito" not in reply.lower():
-                        reply = "Non ho trovato un gioco da salvare nei preferiti. Chiedimi informazioni su un gioco specifico e poi chiedi di salvarlo!\n\n" + reply
-                    else:
-                        reply = "Non ho trovato un gioco da salvare nei preferiti. Chiedimi informazioni su un gioco specifico e poi chiedi di salvarlo!"
+        logger.info(f"Returning response with info: {turn['game_info'] is not None}, recommended_game: {turn['recommended_game'] is not None}")
         
-        # Salva informazioni nella memoria per personalizzazione futura
-        try:
-            game_info_dict = None
-            if game_info:
-                game_info_dict = game_info.model_dump() if hasattr(game_info, 'model_dump') else game_info.dict()
-            
-            recommended_game_dict = None
-            if recommended_game:
-                recommended_game_dict = recommended_game.model_dump() if hasattr(recommended_game, 'model_dump') else recommended_game.dict()
-            
-            update_memory_from_conversation(
-                user_message=last_user_message,
-                ai_response=reply,
-                game_info=game_info_dict,
-                recommended_game=recommended_game_dict
-            )
-            logger.info("Memory updated successfully")
-        except Exception as mem_error:
-            logger.warning(f"Error updating memory: {mem_error}")
-            # Non bloccare la risposta se c'è un errore nella memoria
+        reply = await run_in_pool("memory", finalize_chat_turn, turn, reply)
         
-        return ChatResponse(reply=reply, recommended_game=recommended_game, info=game_info)
+        return ChatResponse(reply=reply, recommended_game=turn["recommended_game"], info=turn["game_info"])
     
     except Exception as e:
         logger.error(f"Error processing chat request: {str(e)}", exc_info=True)
         raise
 
+def _ndjson_event(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(payload: ChatRequest):
+    """
+    Come /chat, ma restituisce la risposta in streaming NDJSON (un evento JSON per riga):
+    - {"type": "meta", ...}: card recommended_game/info, inviata prima della generazione
+    - {"type": "token", "content": ...}: frammenti di testo già puliti dal markdown
+    - {"type": "done", "reply": ...}: risposta finale completa (con eventuali conferme preferiti)
+    """
+    logger.info(f"Chat stream request received. History length: {len(payload.history)}")
+    turn = await run_in_pool("chat", prepare_chat_turn, payload)
+    is_small_talk = turn["intent"] == "small_talk" and not turn["context"]
+    if not turn["is_only_save_request"]:
+        # Rifiuta con 503 prima di aprire lo stream se la coda è già piena
+        scheduler.ensure_capacity()
+    
+    async def event_stream():
+        game_info = turn["game_info"]
+        recommended_game = turn["recommended_game"]
+        yield _ndjson_event({
+            "type": "meta",
+            "recommended_game": recommended_game.model_dump() if recommended_game else None,
+            "info": game_info.model_dump() if game_info else None
+        })
+        
+        try:
+            if turn["is_only_save_request"]:
+                reply = await run_in_pool("memory", handle_save_only_request, turn["last_user_message"], turn["memory"], turn["user_id"])
+            else:
+                parts = []
+                # Dopo l'header: la durata di Ollama finisce nel log della richiesta, non in Server-Timing
+                with span("ollama"):
+                    async for text in stream_nintendo_ai(format_for_engine(turn["validated"]), context=turn["context_pieces"], fast_mode=is_small_talk, session_id=turn["session_id"], latency_budget=turn["latency_budget"], intent=turn["intent"]):
+                        parts.append(text)
+                        yield _ndjson_event({"type": "token", "content": text})
+                reply = "".join(parts)
+                if not reply.strip():
+                    reply = get_fallback_reply(turn["intent"])
+            
+            reply = await run_in_pool("memory", finalize_chat_turn, turn, reply)
+            yield _ndjson_event({"type": "done", "reply": reply})
+        except QueueFullError as e:
+            yield _ndjson_event({"type": "error", "message": "Il server è occupato, riprova tra poco.", "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"Error processing chat stream: {str(e)}", exc_info=True)
+            yield _ndjson_event({"type": "error", "message": "Errore nella generazione della risposta."})
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+async def _batch_item(payload: ChatRequest, memo: LookupMemo, update_memory: bool) -> dict:
+    start_time = time.time()
+    # Il memo arriva al thread del pool tramite la copia del contesto
+    with memo_scope(memo):
+        turn = await run_in_pool("chat", prepare_chat_turn, payload)
+    if turn["is_only_save_request"]:
+        if not update_memory:
+            raise ValueError("Richiesta di solo salvataggio nei preferiti: serve update_memory")
+        reply = await run_in_pool("memory", handle_save_only_request, turn["last_user_message"], turn["memory"], turn["user_id"])
+    else:
+        # Corsia a bassa priorità: l'elemento aspetta il suo turno senza togliere posto a /chat
+        reply = await generate_turn_reply(turn, batch=True)
+    if update_memory:
+        reply = await run_in_pool("memory", finalize_chat_turn, turn, reply)
+    return {
+        "reply": reply,
+        "intent": turn["intent"],
+        "recommended_game": turn["recommended_game"].model_dump() if turn["recommended_game"] else None,
+        "info": turn["game_info"].model_dump() if turn["game_info"] else None,
+        "seconds": round(time.time() - start_time, 2)
+    }
+
+async def chat_batch(items: List[ChatRequest], concurrency: int = CHAT_BATCH_CONCURRENCY, update_memory: bool = False) -> AsyncIterator[dict]:
+    """
+    Elabora molte conversazioni con la stessa logica di /chat e restituisce i risultati
+    in ordine di completamento (ogni evento ha l'indice dell'elemento).
+    Le ricerche di fonti uguali tra elementi diversi vengono fatte una volta sola.
+    Di default la memoria utente non viene aggiornata (replay e valutazioni).
+    """
+    start_time = time.time()
+    errors = 0
+    memo = LookupMemo()
+    results = run_bounded(items, lambda index, item: _batch_item(item, memo, update_memory), max(1, concurrency))
+    async for index, result, error in results:
+        if error is not None:
+            errors += 1
+            logger.warning(f"Elemento {index} del lotto fallito: {error}")
+            yield {"type": "error", "index": index, "message": str(error)}
+        else:
+            yield {"type": "result", "index": index, **result}
+    elapsed_time = time.time() - start_time
+    logger.info(f"📦 Lotto di {len(items)} conversazioni completato in {elapsed_time:.2f} secondi ({errors} errori)")
+    yield {
+        "type": "done",
+        "completed": len(items) - errors,
+        "errors": errors,
+        "seconds": round(elapsed_time, 2),
+        **memo.stats()
+    }
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(payload: BatchChatRequest):
+    """
+    Molte conversazioni in una sola richiesta, risposta NDJSON in ordine di completamento:
+    - {"type": "result", "index": ..., "reply": ..., ...}: risultato di un elemento
+    - {"type": "error", "index": ..., "message": ...}: elemento fallito
+    - {"type": "done", ...}: riepilogo finale (errori, durata, ricerche deduplicate)
+    """
+    if len(payload.items) > CHAT_BATCH_MAX_ITEMS:
+        return JSONResponse(status_code=413, content={"detail": f"Massimo {CHAT_BATCH_MAX_ITEMS} conversazioni per lotto"})
+    concurrency = min(payload.concurrency or CHAT_BATCH_CONCURRENCY, CHAT_BATCH_CONCURRENCY)
+    logger.info(f"Chat batch request received: {len(payload.items)} conversazioni, parallelismo {concurrency}")
+    
+    async def event_stream():
+        async for event in chat_batch(payload.items, concurrency, payload.update_memory):
+            yield _ndjson_event(event)
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+@app.get("/ready")
+async def readiness():
+    """
+    Readiness del worker: pronto dopo il primo caricamento del modello in Ollama.
+    Il raffreddamento per inattività (status "cold") resta visibile solo nello stato,
+    senza togliere il worker dal bilanciamento.
+    """
+    state = model_state.stats()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content=state)
+    return state
+
+@app.get("/engine/stats")
+async def engine_stats():
+    """Statistiche live del motore AI (coda verso Ollama e tempi di prompt eval per layout)"""
+    return {
+        "scheduler": scheduler.stats(),
+        "prompt_eval": prompt_eval_tracker.stats(),
+        "sessions": session_store.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "throughput": throughput_estimator.stats(),
+        "context_budget": context_assembler.stats(),
+        "model": model_state.stats(),
+        "backends": backend_pool.stats(),
+        "hedging": hedger.stats(),
+        "routes": model_router.stats(),
+        "generations": generation_telemetry.stats(),
+        "retrieval": retrieval_stats(),
+        "worker_pools": pool_stats(),
+        "memory_writer": memory_writer.stats(),
+        "memory_store": memory_store.stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Metriche in formato Prometheus (durate e token di ogni generazione Ollama)"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/games/list", response_model=list[Game])
 async def list_games():
@@ -768,13 +970,13 @@ async def game_info_endpoint(payload: GameInfoRequest):
     logger.info(f"Game info request: {payload.query}")
     
     try:
-        game_data = get_game_info(payload.query)
+        game_data = await run_in_pool("retrieval", get_game_info, payload.query)
         
         if game_data:
             game_info = GameInfo(**game_data)
             return GameInfoResponse(game=game_info)
         else:
-            search_results = search_game_info(payload.query, top_k=1)
+            search_results = await run_in_pool("retrieval", search_game_info, payload.query, top_k=1)
             if search_results:
                 game_info = GameInfo(**search_results[0])
                 return GameInfoResponse(game=game_info)
@@ -786,20 +988,20 @@ async def game_info_endpoint(payload: GameInfoRequest):
         return GameInfoResponse(game=None)
 
 @app.get("/memory")
-async def get_memory():
+async def get_memory(user_id: Optional[str] = None):
     """Restituisce la memoria salvata dell'utente"""
     try:
-        memory = load_memory()
+        memory = await run_in_pool("memory", memory_snapshot, user_id)
         return memory
     except Exception as e:
         logger.error(f"Error getting memory: {str(e)}", exc_info=True)
         return {"error": "Failed to load memory"}
 
 @app.post("/memory/clear")
-async def clear_user_memory():
+async def clear_user_memory(user_id: Optional[str] = None):
     """Cancella tutta la memoria dell'utente"""
     try:
-        clear_memory()
+        await run_in_pool("memory", clear_memory, user_id)
         return {"message": "Memory cleared successfully"}
     except Exception as e:
         logger.error(f"Error clearing memory: {str(e)}", exc_info=True)
@@ -812,27 +1014,27 @@ async def set_profile_name(name_data: dict):
         user_name = name_data.get("name", "").strip()
         if not user_name:
             return {"error": "Name cannot be empty"}
-        set_user_name(user_name)
+        await run_in_pool("memory", set_user_name, user_name, name_data.get("user_id"))
         return {"message": "Name set successfully", "name": user_name}
     except Exception as e:
         logger.error(f"Error setting name: {str(e)}", exc_info=True)
         return {"error": "Failed to set name"}
 
 @app.get("/profile")
-async def get_profile():
+async def get_profile(user_id: Optional[str] = None):
     """Ottiene il profilo completo dell'utente"""
     try:
-        profile = get_user_profile()
+        profile = await run_in_pool("memory", get_user_profile, user_id)
         return profile
     except Exception as e:
         logger.error(f"Error getting profile: {str(e)}", exc_info=True)
         return {"error": "Failed to get profile"}
 
 @app.get("/profile/report")
-async def get_personality_report():
+async def get_personality_report(user_id: Optional[str] = None):
     """Genera un resoconto della personalità dell'utente"""
     try:
-        report = generate_personality_report()
+        report = await run_in_pool("memory", generate_personality_report, user_id)
         return {"report": report}
     except Exception as e:
         logger.error(f"Error generating report: {str(e)}", exc_info=True)
@@ -845,27 +1047,27 @@ async def set_profile_name(name_data: dict):
         user_name = name_data.get("name", "").strip()
         if not user_name:
             return {"error": "Name cannot be empty"}
-        set_user_name(user_name)
+        await run_in_pool("memory", set_user_name, user_name, name_data.get("user_id"))
         return {"message": "Name set successfully", "name": user_name}
     except Exception as e:
         logger.error(f"Error setting name: {str(e)}", exc_info=True)
         return {"error": "Failed to set name"}
 
 @app.get("/profile")
-async def get_profile():
+async def get_profile(user_id: Optional[str] = None):
     """Ottiene il profilo completo dell'utente"""
     try:
-        profile = get_user_profile()
+        profile = await run_in_pool("memory", get_user_profile, user_id)
         return profile
     except Exception as e:
         logger.error(f"Error getting profile: {str(e)}", exc_info=True)
         return {"error": "Failed to get profile"}
 
 @app.get("/profile/report")
-async def get_personality_report():
+async def get_personality_report(user_id: Optional[str] = None):
     """Genera un resoconto della personalità dell'utente"""
     try:
-        report = generate_personality_report()
+        report = await run_in_pool("memory", generate_personality_report, user_id)
         return {"report": report}
     except Exception as e:
         logger.error(f"Error generating report: {str(e)}", exc_info=True)
@@ -879,7 +1081,7 @@ async def wiki_search(query_data: dict):
         if not query:
             return {"error": "Query cannot be empty"}
         
-        results = wiki_agent.search(query)
+        results = await run_in_pool("retrieval", wiki_agent.search, query)
         return {"results": results}
     except Exception as e:
         logger.error(f"Error searching Wikipedia: {str(e)}", exc_info=True)
@@ -893,7 +1095,7 @@ async def wiki_page(title_data: dict):
         if not title:
             return {"error": "Title cannot be empty"}
         
-        page_data = wiki_agent.get_page(title)
+        page_data = await run_in_pool("retrieval", wiki_agent.get_page, title)
         return page_data
     except Exception as e:
         logger.error(f"Error getting Wikipedia page: {str(e)}", exc_info=True)
@@ -907,7 +1109,7 @@ async def wiki_answer(question_data: dict):
         if not question:
             return {"error": "Question cannot be empty"}
         
-        answer = wiki_agent.answer_multilang(question)
+        answer = await run_in_pool("retrieval", wiki_agent.answer_multilang, question)
         return answer
     except Exception as e:
         logger.error(f"Error answering question: {str(e)}", exc_info=True)
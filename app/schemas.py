@@ -23,6 +23,14 @@ class GameInfo(BaseModel):
 
 class ChatRequest(BaseModel):
     history: List[Message]
+    session_id: Optional[str] = None  # Id conversazione per riutilizzare il context di Ollama tra i turni
+    latency_budget: Optional[float] = None  # Secondi massimi per la risposta (default dal server)
+    user_id: Optional[str] = None  # Utente della memoria e dei preferiti (default: profilo unico)
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+    concurrency: Optional[int] = None  # Elementi in parallelo (al massimo CHAT_BATCH_CONCURRENCY)
+    update_memory: bool = False  # Aggiorna memoria e preferiti come /chat (di default no: replay e valutazioni)
 
 class ChatResponse(BaseModel):
     reply: str
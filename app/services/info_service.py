@@ -1,6 +1,8 @@
 from typing import Dict, Optional, List
 from app.knowledge.rag_engine import retrieve_info, search_games, get_context_for_query
+from app.engine.tracing import traced
 
+@traced("local_rag")
 def get_game_info(title: str) -> Optional[Dict]:
     game = retrieve_info(title)
     if game:
@@ -15,6 +17,7 @@ def get_game_info(title: str) -> Optional[Dict]:
         }
     return None
 
+@traced("local_rag")
 def search_game_info(query: str, top_k: int = 3) -> List[Dict]:
     results = search_games(query, top_k=top_k)
     
@@ -32,6 +35,7 @@ def search_game_info(query: str, top_k: int = 3) -> List[Dict]:
     
     return formatted_results
 
+@traced("local_rag")
 def get_context_for_ai(query: str) -> str:
     return get_context_for_query(query, max_games=1)
 
@@ -0,0 +1,347 @@
+"""
+Backend di persistenza della memoria utente.
+
+- JsonMemoryBackend: il file unico user_memory.json di sempre. Un solo utente, un solo worker.
+- SqliteMemoryBackend: database SQLite in modalità WAL, con una riga per utente e tabelle
+  indicizzate per (user_id, ...) per preferiti, giochi menzionati, info fornite, cronologia
+  e preferenze. A ogni salvataggio si scrivono solo le righe cambiate (di solito qualche
+  INSERT), non tutto il profilo. Più worker uvicorn possono usare lo stesso database:
+  ogni salvataggio è una transazione, la colonna version di users conta le modifiche di
+  ogni utente e PRAGMA data_version dice quando un'altra connessione ha scritto, così le
+  copie in memoria degli altri worker si aggiornano.
+
+Alla prima apertura il database importa il vecchio user_memory.json come utente di default.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_ID = "default"
+
+PREFERENCE_KINDS = ("favorite_games", "favorite_genres", "favorite_platforms", "preferred_difficulty", "mood_preferences")
+
+# Liste della memoria salvate come righe: colonne e chiave che identifica l'elemento
+LIST_TABLES = {
+    "favorites": {"columns": ("title", "platform", "description", "timestamp"), "key": ("title",), "unique": True},
+    "mentioned_games": {"columns": ("title",), "key": ("title",), "unique": True},
+    "provided_info": {"columns": ("title", "platform", "description", "timestamp"), "key": ("title",), "unique": True},
+    "conversation_history": {"columns": ("user", "ai", "timestamp"), "key": ("user", "ai", "timestamp"), "unique": False}
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    user_name TEXT NOT NULL DEFAULT '',
+    last_updated TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS preferences (
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (user_id, kind, value)
+);
+CREATE TABLE IF NOT EXISTS favorites (
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    platform TEXT,
+    description TEXT,
+    timestamp TEXT,
+    PRIMARY KEY (user_id, title)
+);
+CREATE TABLE IF NOT EXISTS mentioned_games (
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    PRIMARY KEY (user_id, title)
+);
+CREATE TABLE IF NOT EXISTS provided_info (
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    platform TEXT,
+    description TEXT,
+    timestamp TEXT,
+    PRIMARY KEY (user_id, title)
+);
+CREATE TABLE IF NOT EXISTS conversation_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    "user" TEXT,
+    ai TEXT,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS conversation_history_user ON conversation_history (user_id, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def empty_memory() -> Dict:
+    return {
+        "user_name": "",
+        "preferences": {
+            "favorite_games": [],
+            "favorite_genres": [],
+            "favorite_platforms": [],
+            "preferred_difficulty": [],
+            "mood_preferences": []
+        },
+        "favorites": [],  # Lista di giochi salvati nei preferiti
+        "mentioned_games": [],
+        "provided_info": [],
+        "conversation_history": [],
+        "last_updated": None
+    }
+
+
+def read_json_memory(path: str) -> Optional[Dict]:
+    """Memoria salvata nel vecchio formato JSON, o None se il file non c'è o non è leggibile"""
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.warning(f"Error loading memory: {e}")
+    return None
+
+
+class JsonMemoryBackend:
+    """Un solo file JSON per tutti: ogni salvataggio riscrive il profilo intero"""
+    
+    multi_user = False
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def load(self, user_id: str) -> Tuple[Dict, int]:
+        return read_json_memory(self.path) or empty_memory(), 0
+    
+    def save(self, user_id: str, before: Dict, after: Dict, version: int) -> int:
+        # Gli errori arrivano al writer: la base salvata non avanza e la modifica viene riscritta al prossimo salvataggio
+        # Assicurati che la directory esista
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        
+        # Scrittura su file temporaneo e rename: chi legge il file mentre viene
+        # salvato vede quello vecchio o quello nuovo, mai uno scritto a metà
+        temp_file = self.path + ".tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(after, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.path)
+        
+        logger.info("Memory saved successfully")
+        return version + 1
+    
+    def generation(self) -> int:
+        # Nessun altro processo scrive il file: la copia in memoria è sempre valida
+        return 0
+    
+    def version(self, user_id: str) -> int:
+        return 0
+    
+    def oversized_users(self, limits: Dict[str, int]) -> List[str]:
+        memory = read_json_memory(self.path) or {}
+        if any(len(memory.get(field) or []) > limit for field, limit in limits.items()):
+            return [DEFAULT_USER_ID]
+        return []
+    
+    def checkpoint(self):
+        pass
+
+
+def _item_key(spec: Dict, item) -> tuple:
+    if isinstance(item, dict):
+        return tuple(item.get(column) for column in spec["key"])
+    return (item,)
+
+
+def _item_row(spec: Dict, item) -> tuple:
+    if isinstance(item, dict):
+        return tuple(item.get(column) for column in spec["columns"])
+    return (item,)
+
+
+def _keyed(spec: Dict, items: Optional[List]) -> Dict[tuple, object]:
+    # Elementi per chiave, in ordine; di un duplicato conta l'ultima occorrenza (la più recente)
+    keyed: Dict[tuple, object] = {}
+    for item in items or []:
+        key = _item_key(spec, item)
+        keyed.pop(key, None)
+        keyed[key] = item
+    return keyed
+
+
+def _row_item(spec: Dict, row: sqlite3.Row):
+    if len(spec["columns"]) == 1:
+        return row[spec["columns"][0]]
+    return {column: row[column] for column in spec["columns"]}
+
+
+def _quoted(columns) -> str:
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+class SqliteMemoryBackend:
+    """Memoria di più utenti in SQLite (WAL): letture e scritture per singolo utente"""
+    
+    multi_user = True
+    
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None):
+        self.path = path
+        self._local = threading.local()
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connection()
+        # WAL: i lettori non bloccano chi scrive (e viceversa), anche tra processi diversi
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if legacy_json_path:
+            self._migrate_json(legacy_json_path)
+    
+    def _connection(self) -> sqlite3.Connection:
+        # Una connessione per thread (pool "chat", "memory" e writer in background)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            self._local.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return conn
+    
+    @contextmanager
+    def _transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        # IMMEDIATE prende subito il lock di scrittura: due worker non salvano mai insieme
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def _migrate_json(self, legacy_json_path: str):
+        with self._transaction(immediate=True) as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+            legacy = read_json_memory(legacy_json_path)
+            if legacy:
+                self._write(conn, DEFAULT_USER_ID, empty_memory(), legacy)
+                logger.info(f"📦 Memoria di {legacy_json_path} importata in {self.path} (utente {DEFAULT_USER_ID})")
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+    
+    def load(self, user_id: str) -> Tuple[Dict, int]:
+        memory = empty_memory()
+        with self._transaction() as conn:
+            user = conn.execute("SELECT user_name, last_updated, version FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user is None:
+                return memory, 0
+            memory["user_name"] = user["user_name"]
+            memory["last_updated"] = user["last_updated"]
+            for row in conn.execute("SELECT kind, value FROM preferences WHERE user_id = ? ORDER BY rowid", (user_id,)):
+                memory["preferences"].setdefault(row["kind"], []).append(row["value"])
+            for field, spec in LIST_TABLES.items():
+                rows = conn.execute(f"SELECT {_quoted(spec['columns'])} FROM {field} WHERE user_id = ? ORDER BY rowid", (user_id,))
+                memory[field] = [_row_item(spec, row) for row in rows]
+            return memory, user["version"]
+    
+    def save(self, user_id: str, before: Dict, after: Dict, version: int) -> int:
+        """Scrive le differenze tra before e after e restituisce la nuova versione dell'utente"""
+        with self._transaction(immediate=True) as conn:
+            return self._write(conn, user_id, before, after)
+    
+    def _write(self, conn: sqlite3.Connection, user_id: str, before: Dict, after: Dict) -> int:
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        
+        before_prefs = before.get("preferences") or {}
+        after_prefs = after.get("preferences") or {}
+        for kind in set(before_prefs) | set(after_prefs):
+            old, new = set(before_prefs.get(kind) or []), after_prefs.get(kind) or []
+            removed = old - set(new)
+            if removed:
+                conn.executemany("DELETE FROM preferences WHERE user_id = ? AND kind = ? AND value = ?", [(user_id, kind, value) for value in removed])
+            conn.executemany("INSERT OR IGNORE INTO preferences (user_id, kind, value) VALUES (?, ?, ?)", [(user_id, kind, value) for value in new if value not in old])
+        
+        for field, spec in LIST_TABLES.items():
+            old = _keyed(spec, before.get(field))
+            new = _keyed(spec, after.get(field))
+            positions = {key: index for index, key in enumerate(old)}
+            removed = [(user_id,) + key for key in old if key not in new]
+            updated, appended = [], []
+            # Le righe si leggono in ordine di rowid: dal primo elemento nuovo o spostato
+            # (es. un gioco menzionato di nuovo, che diventa il più recente) in poi si reinseriscono in coda
+            tail = False
+            last = -1
+            for key, item in new.items():
+                position = positions.get(key)
+                tail = tail or position is None or position < last
+                if tail:
+                    # Con chiave primaria la riga può esserci anche se non era nella base:
+                    # l'ha già scritta un altro worker. Si cancella e si reinserisce in coda
+                    if position is not None or spec["unique"]:
+                        removed.append((user_id,) + key)
+                    appended.append((user_id,) + _item_row(spec, item))
+                else:
+                    last = position
+                    if old[key] != item:
+                        updated.append((user_id,) + _item_row(spec, item))
+            
+            if removed:
+                key_filter = " AND ".join(f'"{column}" = ?' for column in spec["key"])
+                conn.executemany(f"DELETE FROM {field} WHERE user_id = ? AND {key_filter}", removed)
+            insert = f"INSERT INTO {field} (user_id, {_quoted(spec['columns'])}) VALUES (?{', ?' * len(spec['columns'])})"
+            if updated:
+                # Elemento già presente (stessa chiave): aggiorna la riga senza cambiarne la posizione
+                updates = [column for column in spec["columns"] if column not in spec["key"]]
+                conflict = f"DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in updates)}" if updates else "DO NOTHING"
+                conn.executemany(f"{insert} ON CONFLICT (user_id, {_quoted(spec['key'])}) {conflict}", updated)
+            if appended:
+                conn.executemany(insert, appended)
+        
+        conn.execute(
+            "UPDATE users SET user_name = ?, last_updated = ?, version = version + 1 WHERE user_id = ?",
+            (after.get("user_name") or "", after.get("last_updated"), user_id)
+        )
+        return conn.execute("SELECT version FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+    
+    def generation(self) -> int:
+        """
+        Contatore che cresce quando un'altra connessione (anche di un altro worker) ha scritto
+        nel database: chi ha copie in memoria più vecchie ricontrolla la versione dell'utente.
+        """
+        conn = self._connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self._generation_lock:
+            if data_version != self._local.data_version:
+                self._local.data_version = data_version
+                self._generation += 1
+            return self._generation
+    
+    def version(self, user_id: str) -> int:
+        row = self._connection().execute("SELECT version FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+    
+    def users(self) -> List[str]:
+        return [row[0] for row in self._connection().execute("SELECT user_id FROM users ORDER BY user_id")]
+    
+    def oversized_users(self, limits: Dict[str, int]) -> List[str]:
+        """Utenti con più righe di limit in almeno una delle tabelle indicate"""
+        conn = self._connection()
+        users = set()
+        for field, limit in limits.items():
+            rows = conn.execute(f"SELECT user_id FROM {field} GROUP BY user_id HAVING COUNT(*) > ?", (limit,))
+            users.update(row[0] for row in rows)
+        return sorted(users)
+    
+    def checkpoint(self):
+        """Riporta nel database le pagine del WAL e lo tronca (dopo le compattazioni il file non resta gonfio)"""
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
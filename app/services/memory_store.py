@@ -0,0 +1,150 @@
+"""
+Memoria utente tenuta nel processo: il profilo di ogni utente viene letto dal backend
+(SQLite o file JSON) una sola volta e poi servito dalla copia in memoria.
+
+Le modifiche sono copy-on-write: ogni aggiornamento lavora su una copia e poi la pubblica
+con una nuova versione. Uno snapshot già consegnato non cambia più, quindi una richiesta
+che prende lo snapshot all'inizio del turno vede la stessa memoria fino alla fine,
+anche se nel frattempo altri turni la aggiornano. Gli snapshot vanno solo letti.
+
+Con più worker sullo stesso database, una copia senza modifiche in sospeso viene riletta
+quando il backend segnala che un altro processo ha scritto quell'utente.
+"""
+import copy
+import itertools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.engine.telemetry import registry
+
+logger = logging.getLogger(__name__)
+
+# Profili tenuti nel processo: oltre si scartano i meno usati tra quelli già salvati
+MEMORY_STORE_MAX_USERS = int(os.getenv("MEMORY_STORE_MAX_USERS", "1024"))
+
+_snapshots = registry.counter("memory_store_snapshots_total", "Snapshot della memoria utente consegnati")
+_changes = registry.counter("memory_store_changes_total", "Aggiornamenti che hanno modificato la memoria utente")
+_reloads = registry.counter("memory_store_reloads_total", "Profili riletti perché modificati da un altro worker")
+_evictions = registry.counter("memory_store_evictions_total", "Profili tolti dalla memoria del processo (LRU)")
+
+
+class MemoryStore:
+    """Memoria utente già analizzata, per utente, con versione e aggiornamenti copy-on-write"""
+    
+    def __init__(self, backend, max_users: int = MEMORY_STORE_MAX_USERS):
+        self._backend = backend
+        self.max_users = max(1, max_users)
+        # user_id -> {memory, base (ultima memoria salvata o letta), version, generation, stale, revision}, in ordine LRU
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # Revisione della copia in memoria: cambia a ogni modifica o rilettura (per le cache derivate)
+        self._revisions = itertools.count(1)
+        self.version = 0
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+    
+    def _load(self, user_id: str, generation: int) -> Dict:
+        # Chiamato con il lock
+        memory, version = self._backend.load(user_id)
+        entry = {"memory": memory, "base": memory, "version": version, "generation": generation, "stale": False,
+                 "revision": next(self._revisions)}
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        self.loads += 1
+        self._evict(keep=user_id)
+        return entry
+    
+    def _evict(self, keep: Optional[str] = None):
+        # Chiamato con il lock. Si scartano solo profili senza modifiche da salvare (quelli
+        # in attesa del writer restano finché non sono salvati) e mai keep, appena letto
+        if len(self._entries) <= self.max_users:
+            return
+        for user_id in [user_id for user_id, entry in self._entries.items() if entry["memory"] is entry["base"] and user_id != keep]:
+            if len(self._entries) <= self.max_users:
+                break
+            del self._entries[user_id]
+            self.evictions += 1
+            _evictions.inc()
+    
+    def _entry(self, user_id: str) -> Dict:
+        # Chiamato con il lock: la prima richiesta legge il profilo, le altre usano la copia in memoria
+        generation = self._backend.generation()
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return self._load(user_id, generation)
+        self._entries.move_to_end(user_id)
+        if entry["memory"] is entry["base"] and (entry["stale"] or entry["generation"] != generation):
+            # Un altro worker ha scritto nel database: rileggi solo se questo utente è cambiato
+            if entry["stale"] or self._backend.version(user_id) != entry["version"]:
+                self.reloads += 1
+                _reloads.inc()
+                return self._load(user_id, generation)
+            entry["generation"] = generation
+        return entry
+    
+    def snapshot(self, user_id: str) -> Dict:
+        """Memoria corrente dell'utente (da non modificare: gli aggiornamenti passano da update)"""
+        with self._lock:
+            memory = self._entry(user_id)["memory"]
+        _snapshots.inc()
+        return memory
+    
+    def snapshot_with_version(self, user_id: str) -> Tuple[Dict, int]:
+        """Come snapshot, con la revisione della memoria: cambia solo quando cambia la memoria"""
+        with self._lock:
+            entry = self._entry(user_id)
+            memory, revision = entry["memory"], entry["revision"]
+        _snapshots.inc()
+        return memory, revision
+    
+    def update(self, user_id: str, op: Callable[[Dict], Any]) -> Tuple[Any, bool]:
+        """
+        Applica op a una copia della memoria dell'utente e la pubblica se è cambiata.
+        Restituisce (risultato di op, memoria cambiata).
+        """
+        with self._lock:
+            entry = self._entry(user_id)
+            current = entry["memory"]
+            memory = copy.deepcopy(current)
+            result = op(memory)
+            changed = memory != current
+            if changed:
+                memory["last_updated"] = datetime.now().isoformat()
+                entry["memory"] = memory
+                entry["revision"] = next(self._revisions)
+                self.version += 1
+        if changed:
+            _changes.inc()
+        return result, changed
+    
+    def pending(self, user_id: str) -> Optional[Tuple[Dict, Dict, int]]:
+        """(memoria salvata, memoria corrente, versione salvata) se l'utente ha modifiche da scrivere"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry["memory"] is entry["base"]:
+                return None
+            return entry["base"], entry["memory"], entry["version"]
+    
+    def persisted(self, user_id: str, memory: Dict, base_version: int, version: int):
+        """Registra il salvataggio di memory: version è la versione restituita dal backend"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            entry["base"] = memory
+            entry["version"] = version
+            self._evict()
+            if version != base_version + 1:
+                # Nel frattempo ha scritto anche un altro worker: la copia va riletta
+                # (appena non ci sono più modifiche in sospeso) per includere le sue
+                entry["stale"] = True
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"version": self.version, "loads": self.loads, "reloads": self.reloads,
+                    "evictions": self.evictions, "users": len(self._entries)}
@@ -0,0 +1,256 @@
+"""
+Scrittura differita (write-behind) della memoria utente.
+
+Gli aggiornamenti arrivano come operazioni op(memory) di un utente e vengono accodati:
+un thread in background li applica subito, in ordine, alla memoria tenuta nel processo
+(MemoryStore) e salva nel backend al massimo ogni MEMORY_FLUSH_INTERVAL secondi gli
+utenti cambiati. Così la risposta di /chat non aspetta né l'analisi del testo né il disco,
+e più aggiornamenti ravvicinati diventano una sola scrittura.
+
+Tutte le modifiche passano dallo stesso thread, quindi restano in ordine e non si
+sovrascrivono a vicenda. Chi ha bisogno del risultato (es. salvataggio nei preferiti)
+attende il Future, che si completa appena l'operazione è applicata; con urgent la
+scrittura su disco parte subito. flush() aspetta che la memoria sia su disco.
+Allo shutdown (e con atexit) le modifiche ancora in sospeso vengono scritte prima di uscire.
+
+Se il salvataggio di un utente fallisce, la sua memoria resta in sospeso e viene ritentata
+con attese crescenti (fino a MEMORY_FLUSH_RETRY_MAX secondi), anche se l'utente non scrive
+più nulla. flush() e close() ritentano subito una volta e restituiscono gli utenti ancora
+non salvati.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from app.engine.telemetry import registry
+from app.services.memory_store import MemoryStore
+
+logger = logging.getLogger(__name__)
+
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "1.0"))
+MEMORY_FLUSH_MAX_PENDING = int(os.getenv("MEMORY_FLUSH_MAX_PENDING", "50"))
+MEMORY_FLUSH_RETRY_MAX = float(os.getenv("MEMORY_FLUSH_RETRY_MAX", "60"))
+
+_updates = registry.counter("memory_writer_updates_total", "Aggiornamenti della memoria utente accodati")
+_flushes = registry.counter("memory_writer_flushes_total", "Salvataggi della memoria di un utente nel backend")
+_pending_gauge = registry.gauge("memory_writer_pending", "Modifiche della memoria non ancora scritte su disco")
+_failed_gauge = registry.gauge("memory_writer_failed_users", "Utenti con la memoria non salvata dopo un errore (in attesa di nuovo tentativo)")
+_flush_seconds = registry.histogram("memory_writer_flush_seconds", "Durata del salvataggio della memoria di un utente")
+
+
+class MemoryWriter:
+    """Applica in ordine le operazioni sulla memoria e salva a lotti gli utenti cambiati"""
+    
+    def __init__(self, store: MemoryStore, backend,
+                 interval: float = MEMORY_FLUSH_INTERVAL, max_pending: int = MEMORY_FLUSH_MAX_PENDING):
+        self._store = store
+        self._backend = backend
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        self._queue: List[Tuple[str, Callable[[Dict], Any], Future]] = []
+        self._dirty = 0
+        self._dirty_users: Set[str] = set()
+        self._dirty_since = 0.0
+        # Utenti il cui salvataggio è fallito: user_id -> (tentativi, prossimo tentativo)
+        self._retry: Dict[str, Tuple[int, float]] = {}
+        self._urgent = False
+        self._busy = False
+        self._closed = False
+        self._flush_waiters: List[Future] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.updates = 0
+        self.flushes = 0
+    
+    def submit(self, user_id: str, op: Callable[[Dict], Any], urgent: bool = False) -> Future:
+        """
+        Accoda op(memory) per l'utente. Il Future si completa con il risultato di op appena è applicata
+        alla memoria in processo. Con urgent la scrittura su disco parte senza attendere altro.
+        """
+        future: Future = Future()
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                self._queue.append((user_id, op, future))
+                self.updates += 1
+                if urgent:
+                    self._urgent = True
+                self._ensure_thread()
+                self._cond.notify()
+        _updates.inc()
+        if closed:
+            # Dopo lo shutdown non c'è più il thread: applica e scrive subito
+            self._apply([(user_id, op, future)])
+            self._retry_later(self._persist(self._take_dirty_users(force=True)))
+        return future
+    
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+            self._thread.start()
+    
+    def _persist_due(self) -> bool:
+        # Chiamato con il lock
+        now = time.monotonic()
+        if any(retry_at <= now for _, retry_at in self._retry.values()):
+            return True
+        if not self._dirty:
+            return False
+        return bool(self._urgent or self._dirty >= self.max_pending or now - self._dirty_since >= self.interval)
+    
+    def _next_wakeup(self) -> Optional[float]:
+        # Chiamato con il lock: secondi al prossimo salvataggio previsto (None se non c'è nulla da scrivere)
+        deadlines = [retry_at for _, retry_at in self._retry.values()]
+        if self._dirty:
+            deadlines.append(self._dirty_since + self.interval)
+        return max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._flush_waiters and not self._closed and not self._persist_due():
+                    self._cond.wait(self._next_wakeup())
+                # flush() e close() forzano un tentativo per tutti gli utenti in sospeso, anche in attesa
+                # di un nuovo tentativo; chi aspetta riparte dopo questo giro anche se qualcosa fallisce
+                batch, self._queue = self._queue, []
+                waiters, self._flush_waiters = self._flush_waiters, []
+                closing = self._closed
+                self._busy = True
+            failed: List[str] = []
+            try:
+                if batch:
+                    self._apply(batch)
+                force = bool(waiters) or closing
+                with self._cond:
+                    users = self._take_dirty_users(force) if force or self._persist_due() else None
+                if users:
+                    failed = self._persist(users)
+            finally:
+                with self._cond:
+                    self._retry_later(failed)
+                    self._busy = False
+                    unsaved = sorted(self._retry)
+                for waiter in waiters:
+                    waiter.set_result(unsaved)
+            if closing:
+                with self._cond:
+                    if self._queue or self._flush_waiters:
+                        continue
+                    # Da qui un flush() successivo avvia un nuovo thread
+                    self._thread = None
+                if unsaved:
+                    logger.error(f"Memoria non salvata allo shutdown per {len(unsaved)} utenti: {', '.join(unsaved)}")
+                return
+    
+    def _apply(self, batch: List[Tuple[str, Callable[[Dict], Any], Future]]):
+        for user_id, op, future in batch:
+            try:
+                result, changed = self._store.update(user_id, op)
+            except Exception as e:
+                logger.error(f"Aggiornamento della memoria fallito: {e}")
+                future.set_exception(e)
+                continue
+            if changed:
+                with self._cond:
+                    if not self._dirty:
+                        self._dirty_since = time.monotonic()
+                    self._dirty += 1
+                    self._dirty_users.add(user_id)
+                    _pending_gauge.set(self._dirty)
+            future.set_result(result)
+    
+    def _take_dirty_users(self, force: bool = False) -> List[str]:
+        """Utenti da salvare ora: quelli cambiati e quelli da ritentare (tutti con force)"""
+        with self._cond:
+            now = time.monotonic()
+            retry = [user_id for user_id, (_, retry_at) in self._retry.items() if force or retry_at <= now]
+            users, self._dirty_users = sorted(self._dirty_users.union(retry)), set()
+            self._dirty = 0
+            self._urgent = False
+            _pending_gauge.set(0)
+        return users
+    
+    def _retry_later(self, failed: List[str]):
+        # Chi è fallito torna in sospeso con un'attesa che raddoppia a ogni errore
+        with self._cond:
+            now = time.monotonic()
+            for user_id in failed:
+                attempts = self._retry.get(user_id, (0, 0.0))[0] + 1
+                delay = min(MEMORY_FLUSH_RETRY_MAX, self.interval * 2 ** (attempts - 1))
+                self._retry[user_id] = (attempts, now + delay)
+                logger.warning(f"Nuovo tentativo di salvataggio della memoria di {user_id} tra {delay:.1f}s (tentativo {attempts})")
+            _failed_gauge.set(len(self._retry))
+    
+    def _persist(self, users: List[str]) -> List[str]:
+        """Salva gli utenti nel backend e restituisce quelli il cui salvataggio è fallito"""
+        failed = []
+        for user_id in users:
+            pending = self._store.pending(user_id)
+            if pending is None:
+                self._saved(user_id)
+                continue
+            base, memory, base_version = pending
+            start = time.monotonic()
+            try:
+                version = self._backend.save(user_id, base, memory, base_version)
+            except Exception as e:
+                # La base salvata non avanza: le modifiche restano in sospeso e l'utente viene ritentato
+                logger.error(f"Salvataggio della memoria di {user_id} fallito: {e}")
+                failed.append(user_id)
+                continue
+            self._saved(user_id)
+            self._store.persisted(user_id, memory, base_version, version)
+            self.flushes += 1
+            _flushes.inc()
+            elapsed = time.monotonic() - start
+            _flush_seconds.observe(elapsed)
+            logger.info(f"💾 Memoria di {user_id} salvata (versione {version}) in {elapsed:.3f}s")
+        return failed
+    
+    def _saved(self, user_id: str):
+        with self._cond:
+            if self._retry.pop(user_id, None) is not None:
+                _failed_gauge.set(len(self._retry))
+    
+    def flush(self, timeout: Optional[float] = None) -> List[str]:
+        """
+        Attende che le operazioni già accodate siano applicate e scritte su disco.
+        Restituisce gli utenti rimasti non salvati per un errore del backend.
+        """
+        waiter: Future = Future()
+        with self._cond:
+            if not self._queue and not self._dirty and not self._busy and not self._retry:
+                return []
+            self._flush_waiters.append(waiter)
+            self._ensure_thread()
+            self._cond.notify()
+        return waiter.result(timeout)
+    
+    def close(self, timeout: float = 5.0) -> List[str]:
+        """
+        Scrive le modifiche in sospeso e ferma il thread (shutdown del server o uscita del processo).
+        Restituisce gli utenti la cui memoria non è stata salvata.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            return sorted(self._retry.keys() | self._dirty_users)
+    
+    def stats(self) -> Dict:
+        with self._cond:
+            queued, dirty, failed = len(self._queue), self._dirty, len(self._retry)
+        return {
+            "queued": queued,
+            "unsaved_changes": dirty,
+            "failed_users": failed,
+            "updates": self.updates,
+            "flushes": self.flushes,
+            "flush_seconds": _flush_seconds.summary()
+        }
@@ -2,6 +2,7 @@ import json
 from pathlib import Path
 from typing import List, Dict, Optional
 from difflib import SequenceMatcher
+from app.engine.tracing import traced
 
 GAMES_DB_PATH = Path(__file__).parent.parent / "db" / "nintendo_games.json"
 
@@ -101,6 +102,7 @@ def extract_platform_from_text(text: str) -> Optional[str]:
     
     return None
 
+@traced("recommend")
 def smart_recommend(games: List[Dict], tags: List[str], mood: Optional[List[str]] = None, user_text: str = "") -> Dict:
     all_tags = tags.copy()
     if mood:
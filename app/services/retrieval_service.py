@@ -0,0 +1,161 @@
+"""
+Ricerca in parallelo nelle fonti di conoscenza (Fandom, database locale, Wikipedia).
+
+Le fonti partono tutte insieme, ognuna con la sua scadenza. Vince la prima in ordine di
+preferenza che restituisce qualcosa di utile: appena è pronta, e le fonti preferite hanno
+già fallito o superato la scadenza, si risponde senza aspettare le altre.
+La latenza diventa quella della fonte utile più lenta, non la somma delle fonti.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.engine.telemetry import registry
+from app.engine.worker_pools import get_pool
+
+logger = logging.getLogger(__name__)
+
+# Secondi massimi di attesa per fonte. Le richieste HTTP sottostanti hanno timeout di 30s
+# e una ricerca Fandom ne fa più di una (ricerca, pagina, immagine): oltre la scadenza la fonte
+# viene lasciata perdere anche se avrebbe risposto. Lo scraping completo ha una scadenza a parte
+SOURCE_TIMEOUTS = {
+    "local": float(os.getenv("RETRIEVAL_LOCAL_TIMEOUT", "3")),
+    "fandom": float(os.getenv("RETRIEVAL_FANDOM_TIMEOUT", "20")),
+    "fandom_deep": float(os.getenv("RETRIEVAL_FANDOM_DEEP_TIMEOUT", "45")),
+    "wikipedia": float(os.getenv("RETRIEVAL_WIKIPEDIA_TIMEOUT", "15"))
+}
+DEFAULT_SOURCE_TIMEOUT = 10.0
+
+# WEB_RETRIEVAL=0 spegne le fonti su internet (Fandom, Wikipedia, DuckDuckGo): restano solo
+# i dati locali. Serve ai benchmark e ai test di carico, che così non dipendono dalla rete
+WEB_RETRIEVAL_ENABLED = os.getenv("WEB_RETRIEVAL", "1") != "0"
+WEB_SOURCES = {"fandom", "wikipedia"}
+
+_source_seconds = registry.histogram("retrieval_source_seconds", "Durata delle ricerche per fonte (anche quelle non usate)")
+_source_outcomes = registry.counter("retrieval_source_outcomes_total", "Esito delle ricerche per fonte (found, used, empty, timeout, error, cancelled, skipped, disabled)")
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _count(name: str, outcome: str):
+    _source_outcomes.inc(labels={"source": name, "outcome": outcome})
+    with _stats_lock:
+        entry = _stats.setdefault(name, {})
+        entry[outcome] = entry.get(outcome, 0) + 1
+
+
+def is_wiki_answer(answer: Optional[Dict]) -> bool:
+    """Risposta di WikiAgent.answer_multilang utilizzabile (senza errore)"""
+    return bool(answer) and "error" not in answer
+
+
+def retrieval_source(name: str, fetch: Callable[[], Any], timeout: Optional[float] = None,
+                     is_useful: Callable[[Any], bool] = bool) -> Dict:
+    """Descrive una fonte: nome, funzione di ricerca, scadenza e criterio di utilità del risultato"""
+    if timeout is None:
+        timeout = SOURCE_TIMEOUTS.get(name, DEFAULT_SOURCE_TIMEOUT)
+    return {"name": name, "fetch": fetch, "timeout": timeout, "is_useful": is_useful}
+
+
+def fandom_timeout(deep_scrape: bool = False) -> float:
+    """Scadenza della fonte Fandom: lo scraping completo scarica e analizza più pagine"""
+    return SOURCE_TIMEOUTS["fandom_deep" if deep_scrape else "fandom"]
+
+
+class RetrievalFanOut:
+    """
+    Avvia le ricerche di tutte le fonti nel pool "retrieval" (con i contextvars del chiamante,
+    ad esempio il memo di /chat/batch) e le raccoglie in ordine di preferenza.
+    
+    Le ricerche annullate che non sono ancora partite non partono più; quelle già in corso
+    non si possono interrompere e il loro risultato viene semplicemente ignorato.
+    """
+    
+    def __init__(self, sources: List[Dict]):
+        self.sources = sources
+        self.started = time.monotonic()
+        self._futures: Dict[str, Future] = {}
+        self._collected: Dict[str, Any] = {}
+        pool = get_pool("retrieval")
+        for source in sources:
+            if not WEB_RETRIEVAL_ENABLED and source["name"] in WEB_SOURCES:
+                # Fonte web spenta: conta come già raccolta e vuota, senza partire
+                _count(source["name"], "disabled")
+                self._collected[source["name"]] = None
+                continue
+            self._futures[source["name"]] = pool.submit(self._timed, source)
+    
+    @staticmethod
+    def _timed(source: Dict) -> Any:
+        start = time.monotonic()
+        try:
+            return source["fetch"]()
+        finally:
+            _source_seconds.observe(time.monotonic() - start, {"source": source["name"]})
+    
+    def result(self, name: str) -> Any:
+        """Risultato della fonte entro la sua scadenza, o None se vuoto, scaduto o in errore"""
+        if name in self._collected:
+            return self._collected[name]
+        source = next(s for s in self.sources if s["name"] == name)
+        future = self._futures[name]
+        remaining = self.started + source["timeout"] - time.monotonic()
+        value = None
+        try:
+            value = future.result(timeout=max(0.0, remaining))
+            if source["is_useful"](value):
+                _count(name, "found")
+            else:
+                _count(name, "empty")
+                value = None
+        except FutureTimeoutError:
+            future.cancel()
+            _count(name, "timeout")
+            logger.warning(f"⏱️ Fonte {name} oltre la scadenza di {source['timeout']:g}s, la salto")
+        except Exception as e:
+            _count(name, "error")
+            logger.warning(f"Ricerca su {name} fallita: {e}")
+        self._collected[name] = value
+        return value
+    
+    def first(self, keep: Iterable[str] = ()) -> Tuple[Optional[str], Any]:
+        """
+        Prima fonte utile in ordine di preferenza (nome, risultato), o (None, None).
+        Le fonti successive vengono annullate, tranne quelle in keep.
+        """
+        for index, source in enumerate(self.sources):
+            value = self.result(source["name"])
+            if value is not None:
+                _count(source["name"], "used")
+                self.cancel(skip=[source["name"]] + list(keep), rest=self.sources[index + 1:])
+                logger.info(f"🔎 Fonte scelta: {source['name']} dopo {time.monotonic() - self.started:.2f}s")
+                return source["name"], value
+        return None, None
+    
+    def cancel(self, skip: Iterable[str] = (), rest: Optional[List[Dict]] = None):
+        skip = set(skip)
+        for source in self.sources if rest is None else rest:
+            name = source["name"]
+            if name in skip or name in self._collected:
+                continue
+            future = self._futures[name]
+            if future.cancel():
+                _count(name, "skipped")
+            elif not future.done():
+                _count(name, "cancelled")
+            self._collected[name] = None
+
+
+def first_available(sources: List[Dict]) -> Tuple[Optional[str], Any]:
+    """Avvia le fonti in parallelo e restituisce la prima utile in ordine di preferenza"""
+    return RetrievalFanOut(sources).first()
+
+
+def retrieval_stats() -> Dict[str, Dict[str, int]]:
+    """Esiti per fonte: found/empty/timeout/error e quante volte è stata usata o annullata"""
+    with _stats_lock:
+        return {name: dict(entry) for name, entry in _stats.items()}
@@ -1,54 +1,65 @@
-import json
+import atexit
 import os
 import re
-from typing import Dict, List, Optional
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 import logging
+from app.engine.telemetry import registry
+from app.engine.tracing import traced
+from app.services.memory_backends import DEFAULT_USER_ID, JsonMemoryBackend, SqliteMemoryBackend, empty_memory
+from app.services.memory_store import MemoryStore
+from app.services.memory_writer import MemoryWriter
 
 logger = logging.getLogger(__name__)
 
 MEMORY_FILE = os.path.join(os.path.dirname(__file__), "..", "db", "user_memory.json")
+MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH", os.path.join(os.path.dirname(__file__), "..", "db", "user_memory.sqlite3"))
+# "sqlite" (più utenti, più worker) oppure "json" (il vecchio file unico)
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "sqlite").lower()
+PERSONALIZATION_CACHE_SIZE = int(os.getenv("PERSONALIZATION_CACHE_SIZE", "1024"))
+# Limiti delle liste della memoria: oltre si scartano gli elementi meno recenti
+MEMORY_MAX_MENTIONED_GAMES = int(os.getenv("MEMORY_MAX_MENTIONED_GAMES", "100"))
+MEMORY_MAX_PROVIDED_INFO = int(os.getenv("MEMORY_MAX_PROVIDED_INFO", "50"))
+MEMORY_MAX_CONVERSATIONS = int(os.getenv("MEMORY_MAX_CONVERSATIONS", "10"))
+# Ogni quanti secondi cercare (e compattare) i profili salvati oltre i limiti
+MEMORY_COMPACTION_INTERVAL = float(os.getenv("MEMORY_COMPACTION_INTERVAL", "3600"))
+MEMORY_LIMITS = {
+    "mentioned_games": MEMORY_MAX_MENTIONED_GAMES,
+    "provided_info": MEMORY_MAX_PROVIDED_INFO,
+    "conversation_history": MEMORY_MAX_CONVERSATIONS
+}
 
-def load_memory() -> Dict:
-    """Carica la memoria dell'utente dal file JSON"""
-    try:
-        if os.path.exists(MEMORY_FILE):
-            with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        logger.warning(f"Error loading memory: {e}")
-    
-    # Ritorna struttura vuota se non esiste o errore
-    return {
-        "user_name": "",
-        "preferences": {
-            "favorite_games": [],
-            "favorite_genres": [],
-            "favorite_platforms": [],
-            "preferred_difficulty": [],
-            "mood_preferences": []
-        },
-        "favorites": [],  # Lista di giochi salvati nei preferiti
-        "mentioned_games": [],
-        "provided_info": [],
-        "conversation_history": [],
-        "last_updated": None
-    }
+def _create_backend():
+    if MEMORY_BACKEND == "json":
+        return JsonMemoryBackend(MEMORY_FILE)
+    return SqliteMemoryBackend(MEMORY_DB_PATH, legacy_json_path=MEMORY_FILE)
 
-def save_memory(memory: Dict):
-    """Salva la memoria dell'utente nel file JSON"""
-    try:
-        # Assicurati che la directory esista
-        os.makedirs(os.path.dirname(MEMORY_FILE), exist_ok=True)
-        
-        memory["last_updated"] = datetime.now().isoformat()
-        
-        with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(memory, f, ensure_ascii=False, indent=2)
-        
-        logger.info("Memory saved successfully")
-    except Exception as e:
-        logger.error(f"Error saving memory: {e}")
+memory_backend = _create_backend()
+# Memoria già analizzata nel processo; tutte le modifiche passano dal writer in background
+# (un solo thread, in ordine), che salva nel backend solo gli utenti cambiati
+memory_store = MemoryStore(memory_backend)
+memory_writer = MemoryWriter(memory_store, memory_backend)
+# Scrive le modifiche in sospeso anche se il processo esce senza lo shutdown di FastAPI
+atexit.register(memory_writer.close)
+
+def _user(user_id: Optional[str]) -> str:
+    # Il file JSON ha un solo profilo: tutti gli utenti finiscono in quello di default
+    if not user_id or not memory_backend.multi_user:
+        return DEFAULT_USER_ID
+    return user_id
+
+def memory_snapshot(user_id: Optional[str] = None) -> Dict:
+    """
+    Snapshot della memoria dell'utente senza rileggere il backend: resta uguale per chi lo
+    tiene anche se la memoria viene aggiornata. Va solo letto (le modifiche passano da memory_writer).
+    """
+    return memory_store.snapshot(_user(user_id))
+
+def memory_snapshot_with_version(user_id: Optional[str] = None) -> Tuple[Dict, int]:
+    """Snapshot e revisione della memoria: la revisione cambia a ogni modifica (preferiti, nome, conversazione)"""
+    return memory_store.snapshot_with_version(_user(user_id))
 
 def extract_game_names(text: str) -> List[str]:
     """Estrae nomi di giochi dal testo"""
@@ -165,21 +176,24 @@ def extract_preferences_from_text(text: str) -> Dict:
     
     return preferences
 
-def update_memory_from_conversation(user_message: str, ai_response: str, game_info: Optional[Dict] = None, recommended_game: Optional[Dict] = None):
+def update_memory_from_conversation(user_message: str, ai_response: str, game_info: Optional[Dict] = None, recommended_game: Optional[Dict] = None,
+                                    user_id: Optional[str] = None):
+    """
+    Accoda l'aggiornamento della memoria basato sulla conversazione e ritorna subito:
+    estrazione di giochi e preferenze e salvataggio avvengono nel writer in background.
+    """
+    memory_writer.submit(_user(user_id), lambda memory: _apply_conversation(memory, user_message, ai_response, game_info, recommended_game))
+
+def _apply_conversation(memory: Dict, user_message: str, ai_response: str, game_info: Optional[Dict], recommended_game: Optional[Dict]):
     """Aggiorna la memoria basandosi sulla conversazione"""
-    memory = load_memory()
-    
-    # Estrai giochi menzionati
+    # Estrai giochi menzionati (già presenti: diventano i più recenti)
     games_mentioned = extract_game_names(user_message + " " + ai_response)
     for game in games_mentioned:
-        if game not in memory["mentioned_games"]:
-            memory["mentioned_games"].append(game)
+        _remember(memory["mentioned_games"], game, MEMORY_MAX_MENTIONED_GAMES)
     
     # Aggiungi gioco raccomandato se presente
     if recommended_game and recommended_game.get("title"):
-        game_title = recommended_game.get("title")
-        if game_title not in memory["mentioned_games"]:
-            memory["mentioned_games"].append(game_title)
+        _remember(memory["mentioned_games"], recommended_game.get("title"), MEMORY_MAX_MENTIONED_GAMES)
     
     # Estrai preferenze dal messaggio dell'utente
     prefs = extract_preferences_from_text(user_message)
@@ -209,29 +223,114 @@ def update_memory_from_conversation(user_message: str, ai_response: str, game_in
             "timestamp": datetime.now().isoformat(),
             "description": game_info.get("description", "")[:200]  # Limita lunghezza
         }
-        # Evita duplicati
-        existing = [i for i in memory["provided_info"] if i.get("title") == info_entry["title"]]
-        if not existing:
-            memory["provided_info"].append(info_entry)
+        # Evita duplicati: un gioco già presente torna in coda con le info aggiornate
+        _remember(memory["provided_info"], info_entry, MEMORY_MAX_PROVIDED_INFO, key=_title)
     
-    # Salva ultima conversazione (solo ultimi 10 scambi per non appesantire)
+    # Salva ultima conversazione (solo ultimi MEMORY_MAX_CONVERSATIONS scambi per non appesantire)
     conversation_entry = {
         "user": user_message[:500],  # Limita lunghezza
         "ai": ai_response[:500],
         "timestamp": datetime.now().isoformat()
     }
     memory["conversation_history"].append(conversation_entry)
-    # Mantieni solo ultimi 10 scambi
-    if len(memory["conversation_history"]) > 10:
-        memory["conversation_history"] = memory["conversation_history"][-10:]
+    # Mantieni solo gli ultimi scambi
+    if len(memory["conversation_history"]) > MEMORY_MAX_CONVERSATIONS:
+        memory["conversation_history"] = memory["conversation_history"][-MEMORY_MAX_CONVERSATIONS:]
     
-    save_memory(memory)
     logger.info("Memory updated from conversation")
 
-def get_personalization_context() -> str:
+def _title(item: Dict) -> Optional[str]:
+    return item.get("title")
+
+def _remember(items: List, item, limit: int, key: Optional[Callable] = None):
+    """
+    Insieme ordinato per recenza: item va in coda (il più recente) togliendo l'eventuale copia
+    precedente, e oltre limit si scartano i più vecchi. Il costo dipende solo da limit.
+    
+    La lista resta una lista, senza un indice chiave -> posizione a fianco: la memoria viene
+    salvata così com'è (JSON o righe SQLite) e copiata a ogni aggiornamento (copy-on-write),
+    quindi un indice andrebbe ricostruito ogni volta, con lo stesso costo O(limit) della
+    scansione. La scansione parte dalla coda, dove stanno gli elementi citati di recente.
+    """
+    item_key = key(item) if key else item
+    for index in range(len(items) - 1, -1, -1):
+        if (key(items[index]) if key else items[index]) == item_key:
+            del items[index]
+            break
+    items.append(item)
+    if len(items) > limit:
+        del items[:len(items) - limit]
+
+def compact_memory(memory: Dict):
+    """Riporta la memoria entro i limiti: toglie i duplicati e tiene gli elementi più recenti"""
+    for field, key in (("mentioned_games", None), ("provided_info", _title)):
+        seen = set()
+        kept = []
+        # Dal più recente al più vecchio: di ogni elemento resta l'ultima occorrenza
+        for item in reversed(memory.get(field) or []):
+            item_key = key(item) if key else item
+            if item_key in seen:
+                continue
+            seen.add(item_key)
+            kept.append(item)
+            if len(kept) >= MEMORY_LIMITS[field]:
+                break
+        kept.reverse()
+        memory[field] = kept
+    memory["conversation_history"] = (memory.get("conversation_history") or [])[-MEMORY_MAX_CONVERSATIONS:]
+
+def compact_memory_store() -> int:
+    """
+    Compattazione della memoria salvata: i profili oltre i limiti (es. vecchi user_memory.json
+    cresciuti senza limiti, o importati nel database) vengono ridotti e risalvati.
+    Restituisce il numero di profili compattati.
+    """
+    users = memory_backend.oversized_users(MEMORY_LIMITS)
+    for user_id in users:
+        memory_writer.submit(user_id, compact_memory)
+    if users:
+        memory_writer.flush()
+        logger.info(f"🧹 Memoria compattata per {len(users)} utenti")
+    memory_backend.checkpoint()
+    return len(users)
+
+# Blocco di personalizzazione già composto per utente: (revisione della memoria, testo).
+# Finché la memoria non cambia, ogni turno riusa lo stesso testo
+_personalization_cache: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+_personalization_lock = threading.Lock()
+_personalization_lookups = registry.counter("personalization_cache_total", "Contesti di personalizzazione per esito della cache (hit, miss)")
+
+@traced("personalization")
+def get_personalization_context(memory: Optional[Dict] = None, user_id: Optional[str] = None, version: Optional[int] = None) -> str:
+    """
+    Contesto di personalizzazione basato sulla memoria (o sullo snapshot del turno, con la sua
+    revisione in version). Il testo resta in cache per utente finché la memoria non cambia.
+    """
+    if memory is None:
+        memory, version = memory_snapshot_with_version(user_id)
+    if version is None:
+        # Memoria senza revisione: niente cache
+        return _render_personalization_context(memory)
+    
+    user = _user(user_id)
+    with _personalization_lock:
+        cached = _personalization_cache.get(user)
+        if cached is not None and cached[0] == version:
+            _personalization_cache.move_to_end(user)
+            _personalization_lookups.inc(labels={"result": "hit"})
+            return cached[1]
+    
+    context = _render_personalization_context(memory)
+    with _personalization_lock:
+        _personalization_cache[user] = (version, context)
+        _personalization_cache.move_to_end(user)
+        while len(_personalization_cache) > PERSONALIZATION_CACHE_SIZE:
+            _personalization_cache.popitem(last=False)
+    _personalization_lookups.inc(labels={"result": "miss"})
+    return context
+
+def _render_personalization_context(memory: Dict) -> str:
     """Genera un contesto di personalizzazione basato sulla memoria"""
-    memory = load_memory()
-    
     if not memory.get("mentioned_games") and not memory.get("preferences"):
         return ""  # Nessuna memoria, niente personalizzazione
     
@@ -239,7 +338,7 @@ def get_personalization_context() -> str:
     
     # Giochi menzionati/preferiti
     if memory.get("mentioned_games"):
-        games = ", ".join(memory["mentioned_games"][:5])  # Max 5 giochi
+        games = ", ".join(memory["mentioned_games"][-5:])  # Max 5 giochi, i più recenti
         context_parts.append(f"🎮 Giochi menzionati/preferiti dall'utente: {games}")
     
     # Preferenze di genere
@@ -280,11 +379,14 @@ def get_personalization_context() -> str:
     
     return ""
 
-def clear_memory():
-    """Cancella tutta la memoria dell'utente"""
+def clear_memory(user_id: Optional[str] = None):
+    """Cancella tutta la memoria dell'utente (dopo gli aggiornamenti già in coda)"""
+    def reset(memory: Dict):
+        memory.clear()
+        memory.update(empty_memory())
+    
     try:
-        if os.path.exists(MEMORY_FILE):
-            os.remove(MEMORY_FILE)
+        memory_writer.submit(_user(user_id), reset, urgent=True).result()
         logger.info("Memory cleared")
     except Exception as e:
         logger.error(f"Error clearing memory: {e}")
@@ -300,10 +402,11 @@ def detect_save_favorite_intent(user_message: str) -> bool:
     ]
     return any(keyword in message_lower for keyword in save_keywords)
 
-def save_to_favorites(game_title: str, game_info: Optional[Dict] = None):
-    """Salva un gioco nei preferiti"""
-    memory = load_memory()
-    
+def save_to_favorites(game_title: str, game_info: Optional[Dict] = None, user_id: Optional[str] = None):
+    """Salva un gioco nei preferiti (attende che sia applicato: il risultato serve alla risposta)"""
+    return memory_writer.submit(_user(user_id), lambda memory: _add_favorite(memory, game_title, game_info), urgent=True).result()
+
+def _add_favorite(memory: Dict, game_title: str, game_info: Optional[Dict]) -> bool:
     if "favorites" not in memory:
         memory["favorites"] = []
     
@@ -321,20 +424,20 @@ def save_to_favorites(game_title: str, game_info: Optional[Dict] = None):
     }
     
     memory["favorites"].append(favorite_entry)
-    save_memory(memory)
     logger.info(f"Saved {game_title} to favorites")
     return True
 
-def set_user_name(name: str):
+def set_user_name(name: str, user_id: Optional[str] = None):
     """Imposta il nome utente"""
-    memory = load_memory()
-    memory["user_name"] = name.strip()
-    save_memory(memory)
+    def apply(memory: Dict):
+        memory["user_name"] = name.strip()
+    
+    memory_writer.submit(_user(user_id), apply, urgent=True).result()
     logger.info(f"User name set to: {name}")
 
-def get_user_profile() -> Dict:
+def get_user_profile(user_id: Optional[str] = None) -> Dict:
     """Ottiene il profilo completo dell'utente"""
-    memory = load_memory()
+    memory = memory_snapshot(user_id)
     return {
         "user_name": memory.get("user_name", ""),
         "favorites": memory.get("favorites", []),
@@ -343,9 +446,9 @@ def get_user_profile() -> Dict:
         "total_conversations": len(memory.get("conversation_history", [])),
     }
 
-def generate_personality_report() -> str:
+def generate_personality_report(user_id: Optional[str] = None) -> str:
     """Genera un resoconto della personalità dell'utente basato sulle conversazioni"""
-    memory = load_memory()
+    memory = memory_snapshot(user_id)
     
     if not memory.get("conversation_history") and not memory.get("favorites"):
         return "Non ci sono ancora abbastanza dati per generare un resoconto. Inizia a chattare e salva alcuni giochi nei preferiti!"
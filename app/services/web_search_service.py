@@ -1,13 +1,66 @@
 """Servizio per ricerca web quando le informazioni non sono disponibili localmente"""
 import requests
 from bs4 import BeautifulSoup
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, Callable, Any
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
 import logging
 import re
 import urllib.parse
 
+from app.engine.batch import LookupMemo
+from app.engine.telemetry import registry
+from app.engine.tracing import traced
+from app.services.retrieval_service import WEB_RETRIEVAL_ENABLED
+
 logger = logging.getLogger(__name__)
 
+# Memo delle ricerche web per una singola richiesta (turno di chat): ogni pagina viene scaricata
+# e analizzata una sola volta anche se contesto, immagine e info strutturate la chiedono separatamente
+_request_memo: ContextVar[Optional[LookupMemo]] = ContextVar("web_request_memo", default=None)
+
+_page_requests = registry.counter("web_page_requests_total", "Pagine web richieste (anche quelle servite dal memo della richiesta)")
+_page_fetches = registry.counter("web_page_fetches_total", "Pagine web scaricate davvero")
+
+class CachedPage:
+    """Risposta HTTP ridotta a quello che serve allo scraping (condivisibile nel memo)"""
+    
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+    
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+@contextmanager
+def web_request_scope():
+    """Attiva il memo delle ricerche web per la richiesta corrente (riusa quello già attivo)"""
+    if _request_memo.get() is not None:
+        yield
+        return
+    token = _request_memo.set(LookupMemo())
+    try:
+        yield
+    finally:
+        _request_memo.reset(token)
+
+def _request_memoized(key: Tuple, fn: Callable[[], Any]) -> Any:
+    memo = _request_memo.get()
+    if memo is None:
+        return fn()
+    return memo.get_or_compute(key, fn)
+
+def _get_page(url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> CachedPage:
+    """GET con timeout di 30s, una sola volta per URL nella richiesta corrente"""
+    def fetch() -> CachedPage:
+        _page_fetches.inc()
+        response = requests.get(url, params=params, headers=headers, timeout=30)
+        return CachedPage(response.status_code, response.text)
+    
+    _page_requests.inc()
+    return _request_memoized(("page", url, tuple(sorted((params or {}).items()))), fetch)
+
 def normalize_game_name(game_name: str) -> str:
     """
     Normalizza il nome del gioco per gestire varianti comuni in modo generico.
@@ -648,7 +701,7 @@ def scrape_fandom_page(fandom_name: str, page_name: str, is_game: bool = False,
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = _get_page(url, headers=headers)
             
             if response.status_code == 200:
                 soup = BeautifulSoup(response.text, 'html.parser')
@@ -870,18 +923,25 @@ def scrape_fandom_page(fandom_name: str, page_name: str, is_game: bool = False,
     logger.warning(f"Nessuna variante del nome ha funzionato per {page_name} su {fandom_name}.fandom.com")
     return None
 
+@traced("fandom")
 def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = False) -> tuple:
     """
     Cerca informazioni su un gioco/personaggio Nintendo su internet.
     Prima prova Fandom, poi fallback su DuckDuckGo/Google.
     Restituisce una tupla (contenuto: str, image_url: Optional[str]) o (None, None) se non trovato.
+    Dentro web_request_scope la stessa ricerca viene eseguita una volta sola.
     """
+    # Estrai il nome dell'entità
+    entity_name = extract_entity_name(game_title)
+    if not entity_name:
+        entity_name = game_title.strip()
+    return _request_memoized(
+        ("search", entity_name, query, deep_scrape),
+        lambda: _search_web_entity(game_title, entity_name, query, deep_scrape)
+    )
+
+def _search_web_entity(game_title: str, entity_name: str, query: str, deep_scrape: bool) -> tuple:
     try:
-        # Estrai il nome dell'entità
-        entity_name = extract_entity_name(game_title)
-        if not entity_name:
-            entity_name = game_title.strip()
-        
         # PRIMA PRIORITÀ: Prova Fandom per PERSONAGGI (prima dei giochi, per evitare falsi positivi)
         fandom_info = detect_fandom_series(entity_name, query)
         if fandom_info:
@@ -940,7 +1000,7 @@ def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = F
             'skip_disambig': '1'
         }
         
-        response = requests.get(api_url, params=params, timeout=30)
+        response = _get_page(api_url, params=params)
         
         if response.status_code == 200:
             data = response.json()
@@ -950,7 +1010,7 @@ def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = F
                 abstract_lower = abstract.lower()
                 if any(keyword in abstract_lower for keyword in ['nintendo', 'switch', 'wii', '3ds', 'game', 'zelda', 'mario', 'pokemon', 'character', 'princess', 'principessa']):
                     if len(abstract) > 50:
-                        return abstract[:500]
+                        return (abstract[:500], None)
             
             if data.get('RelatedTopics'):
                 for topic in data.get('RelatedTopics', [])[:3]:
@@ -959,7 +1019,7 @@ def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = F
                         text_lower = text.lower()
                         if any(keyword in text_lower for keyword in ['nintendo', 'switch', 'wii', '3ds', 'game', 'zelda', 'mario', 'pokemon', 'character']):
                             if len(text) > 50:
-                                return text[:500]
+                                return (text[:500], None)
         
         # Fallback finale: ricerca Google
         try:
@@ -968,7 +1028,7 @@ def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = F
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             params = {'q': search_query}
-            response = requests.get(google_url, params=params, headers=headers, timeout=30)
+            response = _get_page(google_url, params=params, headers=headers)
             
             if response.status_code == 200:
                 soup = BeautifulSoup(response.text, 'html.parser')
@@ -988,6 +1048,70 @@ def search_web_game_info(game_title: str, query: str = "", deep_scrape: bool = F
         logger.warning(f"Errore nella ricerca web per {game_title}: {str(e)}")
         return (None, None)
 
+def detect_platform(text: str) -> str:
+    """Piattaforma menzionata nel testo (solo per giochi), "Nintendo" se non trovata"""
+    text_lower = text.lower()
+    if "switch" in text_lower:
+        return "Nintendo Switch"
+    elif "wii u" in text_lower or "wiiu" in text_lower:
+        return "Nintendo Wii U"
+    elif "3ds" in text_lower:
+        return "Nintendo 3DS"
+    elif "wii" in text_lower and "wii u" not in text_lower:
+        return "Nintendo Wii"
+    elif "ds" in text_lower and "3ds" not in text_lower:
+        return "Nintendo DS"
+    return "Nintendo"  # Default più generico per personaggi
+
+def lookup_web(game_title: str, query: str = "", deep_scrape: bool = False) -> Optional[Dict]:
+    """
+    Una sola ricerca web per gioco/personaggio con tutto quello che serve alla chat:
+    - "content": testo trovato (Fandom o ricerca tradizionale)
+    - "context": contesto formattato per l'AI (come get_web_context)
+    - "image_url": URL dell'immagine da Fandom, già ripulito
+    - "platform": piattaforma rilevata nel testo
+    - "info": dict strutturato simile a GameInfo per il frontend (come get_web_game_info)
+    Restituisce None se non trova nulla (o se le ricerche web sono spente con WEB_RETRIEVAL=0).
+    """
+    if not WEB_RETRIEVAL_ENABLED:
+        return None
+    web_info, image_url = search_web_game_info(game_title, query, deep_scrape=deep_scrape)
+    if not web_info:
+        return None
+    
+    # Pulisci l'URL da newline e spazi
+    if image_url:
+        image_url = image_url.strip().replace('\n', '').replace('\r', '').replace(' ', '')
+    
+    # Usa il nome pulito come titolo
+    clean_name = extract_entity_name(game_title)
+    title = clean_name.title() if clean_name else game_title
+    platform = detect_platform(web_info)
+    
+    return {
+        "content": web_info,
+        "context": f"""
+🌐 INFORMAZIONI TROVATE SU INTERNET PER "{game_title}":
+
+{web_info}
+
+⚠️ NOTA: Queste informazioni provengono da ricerche web e potrebbero non essere completamente accurate.
+Usa queste informazioni con cautela e menziona all'utente che sono informazioni generali trovate online.
+""",
+        "image_url": image_url,
+        "platform": platform,
+        "info": {
+            "title": title,
+            "platform": platform,
+            "description": web_info[:400] if len(web_info) > 400 else web_info,  # Descrizione più lunga
+            "gameplay": web_info,  # Usa tutto il testo come gameplay
+            "difficulty": "N/A",  # Non disponibile da web
+            "modes": [],  # Non disponibile da web
+            "keywords": [],  # Potremmo estrarli ma per ora vuoto
+            "image_url": image_url  # URL dell'immagine da Fandom
+        }
+    }
+
 def get_web_context(game_title: str, additional_query: str = "", deep_scrape: bool = False) -> Optional[str]:
     """
     Ottiene contesto da web per un gioco quando non disponibile localmente.
@@ -998,28 +1122,15 @@ def get_web_context(game_title: str, additional_query: str = "", deep_scrape: bo
         additional_query: Query aggiuntiva per contesto
         deep_scrape: Se True, estrae tutto il contenuto. Se False, limita a 15 paragrafi e 5 liste
     """
-    web_info, _ = search_web_game_info(game_title, additional_query, deep_scrape=deep_scrape)  # Ignora immagine nel contesto
-    
-    if web_info:
-        return f"""
-🌐 INFORMAZIONI TROVATE SU INTERNET PER "{game_title}":
-
-{web_info}
-
-⚠️ NOTA: Queste informazioni provengono da ricerche web e potrebbero non essere completamente accurate.
-Usa queste informazioni con cautela e menziona all'utente che sono informazioni generali trovate online.
-"""
-    return None
+    result = lookup_web(game_title, additional_query, deep_scrape=deep_scrape)
+    return result["context"] if result else None
 
 def get_web_image_url(game_title: str, query: str = "", deep_scrape: bool = False) -> Optional[str]:
     """
     Ottiene l'URL dell'immagine da Fandom per un personaggio/gioco.
     """
-    _, image_url = search_web_game_info(game_title, query, deep_scrape=deep_scrape)
-    # Pulisci l'URL da newline e spazi
-    if image_url:
-        image_url = image_url.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-    return image_url
+    result = lookup_web(game_title, query, deep_scrape=deep_scrape)
+    return result["image_url"] if result else None
 
 def extract_entity_name(query: str) -> str:
     """
@@ -1072,41 +1183,5 @@ def get_web_game_info(game_title: str, query: str = "") -> Optional[Dict]:
     Cerca informazioni su un gioco/personaggio su internet e restituisce un dict strutturato
     simile a GameInfo per essere passato al frontend.
     """
-    # Estrai il nome pulito dall'input
-    clean_name = extract_entity_name(game_title)
-    if not clean_name:
-        clean_name = game_title
-    
-    web_info, image_url = search_web_game_info(clean_name, query)
-    
-    if not web_info:
-        return None
-    
-    # Estrai piattaforma se menzionata (solo per giochi)
-    platform = "Nintendo"  # Default più generico per personaggi
-    if "switch" in web_info.lower():
-        platform = "Nintendo Switch"
-    elif "wii u" in web_info.lower() or "wiiu" in web_info.lower():
-        platform = "Nintendo Wii U"
-    elif "3ds" in web_info.lower():
-        platform = "Nintendo 3DS"
-    elif "wii" in web_info.lower() and "wii u" not in web_info.lower():
-        platform = "Nintendo Wii"
-    elif "ds" in web_info.lower() and "3ds" not in web_info.lower():
-        platform = "Nintendo DS"
-    
-    # Usa il nome pulito come titolo
-    title = clean_name.title() if clean_name else game_title
-    
-    # Crea un dict strutturato simile a GameInfo
-    return {
-        "title": title,
-        "platform": platform,
-        "description": web_info[:400] if len(web_info) > 400 else web_info,  # Descrizione più lunga
-        "gameplay": web_info,  # Usa tutto il testo come gameplay
-        "difficulty": "N/A",  # Non disponibile da web
-        "modes": [],  # Non disponibile da web
-        "keywords": [],  # Potremmo estrarli ma per ora vuoto
-        "image_url": image_url  # URL dell'immagine da Fandom
-    }
-
+    result = lookup_web(game_title, query)
+    return result["info"] if result else None
@@ -0,0 +1,225 @@
+"""
+Benchmark end-to-end della pipeline di chat: invia a /chat (o /chat/stream) un mix
+realistico di small_talk, info_request e recommendation_request e riporta
+latenze p50/p95/p99 (totali e per intent) e throughput.
+
+Ogni richiesta ha un session_id diverso, quindi salta la cache delle risposte e l'accorpamento
+delle richieste identiche: le latenze misurano generazioni vere. Le risposte servite comunque
+dalla cache (con --shared-cache) vengono riportate a parte, lette da /engine/stats.
+
+Con il server Ollama finto e le fonti web spente si ottiene una baseline ripetibile senza GPU né rete:
+    python -m app.tools.mock_ollama --port 11434 &
+    OLLAMA_URLS=http://127.0.0.1:11434 OLLAMA_RESPONSE_CACHE_TTL=0 WEB_RETRIEVAL=0 uvicorn app.main:app --port 8000 &
+    python -m app.tools.benchmark --url http://127.0.0.1:8000 --requests 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+
+# Messaggi di esempio per intent, con il peso di ciascun intent nel mix
+MESSAGE_MIX = {
+    "small_talk": (0.3, [
+        "Ciao! Come stai?",
+        "Grazie mille, sei stato utile!",
+        "Buongiorno, che si dice?",
+        "Ok, a dopo!"
+    ]),
+    "info_request": (0.4, [
+        "Parlami di The Legend of Zelda: Breath of the Wild",
+        "Che tipo di gioco è Metroid Dread?",
+        "Quante modalità ha Mario Kart 8 Deluxe?",
+        "Dimmi qualcosa su Super Mario Odyssey",
+        "Com'è il gameplay di Splatoon 3?"
+    ]),
+    "recommendation_request": (0.3, [
+        "Consigliami un gioco rilassante per Switch",
+        "Cerco un gioco da fare in compagnia con gli amici",
+        "Mi suggerisci un'avventura difficile?",
+        "Che gioco mi consigli se mi è piaciuto Animal Crossing?"
+    ])
+}
+
+
+def percentile(samples: List[float], p: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def pick_message(rng: random.Random) -> Dict:
+    intents = list(MESSAGE_MIX)
+    weights = [MESSAGE_MIX[intent][0] for intent in intents]
+    intent = rng.choices(intents, weights=weights)[0]
+    return {"intent": intent, "content": rng.choice(MESSAGE_MIX[intent][1])}
+
+
+async def _send(client: httpx.AsyncClient, url: str, message: Dict, stream: bool, latency_budget: Optional[float],
+                session_id: Optional[str] = None) -> Dict:
+    body = {"history": [{"role": "user", "content": message["content"]}]}
+    if session_id:
+        # Con una sessione il server non usa cache né richieste accorpate
+        body["session_id"] = session_id
+    if latency_budget:
+        body["latency_budget"] = latency_budget
+    start = time.perf_counter()
+    first_token = None
+    if stream:
+        async with client.stream("POST", f"{url}/chat/stream", json=body) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if first_token is None and line and json.loads(line).get("type") == "token":
+                    first_token = time.perf_counter() - start
+    else:
+        response = await client.post(f"{url}/chat", json=body)
+        response.raise_for_status()
+    return {"intent": message["intent"], "seconds": time.perf_counter() - start, "first_token": first_token}
+
+
+async def _engine_stats(client: httpx.AsyncClient, url: str) -> Optional[Dict]:
+    try:
+        response = await client.get(f"{url}/engine/stats")
+        response.raise_for_status()
+        return response.json()
+    except Exception:
+        return None
+
+
+def _cache_usage(before: Optional[Dict], after: Optional[Dict]) -> Optional[Dict]:
+    """Risposte servite dalla cache e richieste accorpate durante il benchmark (None se non disponibili)"""
+    if not before or not after:
+        return None
+    return {
+        "cache_enabled": after["response_cache"]["enabled"],
+        "cache_hits": after["response_cache"]["hits"] - before["response_cache"]["hits"],
+        "coalesced": after["single_flight"]["coalesced"] - before["single_flight"]["coalesced"]
+    }
+
+
+async def run_benchmark(url: str, total: int, concurrency: int, stream: bool = False, seed: int = 42,
+                        latency_budget: Optional[float] = None, timeout: float = 300.0, shared_cache: bool = False) -> Dict:
+    """
+    Esegue total richieste con al massimo concurrency in parallelo e restituisce il report.
+    Con shared_cache le richieste non hanno session_id e possono essere servite dalla cache.
+    """
+    rng = random.Random(seed)
+    run_id = uuid.uuid4().hex[:8]
+    messages = [pick_message(rng) for _ in range(total)]
+    results: List[Dict] = []
+    errors: Dict[str, int] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for index, message in enumerate(messages):
+        queue.put_nowait((index, message))
+    
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            index, message = queue.get_nowait()
+            session_id = None if shared_cache else f"benchmark-{run_id}-{index}"
+            try:
+                results.append(await _send(client, url, message, stream, latency_budget, session_id))
+            except Exception as e:
+                key = f"{type(e).__name__}"
+                if isinstance(e, httpx.HTTPStatusError):
+                    key = f"HTTP {e.response.status_code}"
+                errors[key] = errors.get(key, 0) + 1
+    
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        stats_before = await _engine_stats(client, url)
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall_seconds = time.perf_counter() - start
+        stats_after = await _engine_stats(client, url)
+    
+    report = build_report(results, errors, wall_seconds, concurrency, stream)
+    report["cache"] = _cache_usage(stats_before, stats_after)
+    return report
+
+
+def _summary(samples: List[float]) -> Dict:
+    return {
+        "count": len(samples),
+        "p50": _round(percentile(samples, 50)),
+        "p95": _round(percentile(samples, 95)),
+        "p99": _round(percentile(samples, 99)),
+        "max": _round(max(samples) if samples else None)
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
+
+
+def build_report(results: List[Dict], errors: Dict[str, int], wall_seconds: float, concurrency: int, stream: bool) -> Dict:
+    report = {
+        "endpoint": "/chat/stream" if stream else "/chat",
+        "concurrency": concurrency,
+        "completed": len(results),
+        "errors": errors,
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(len(results) / wall_seconds, 2) if wall_seconds else None,
+        "latency": _summary([r["seconds"] for r in results]),
+        "by_intent": {}
+    }
+    if stream:
+        report["first_token"] = _summary([r["first_token"] for r in results if r["first_token"] is not None])
+    for intent in MESSAGE_MIX:
+        samples = [r["seconds"] for r in results if r["intent"] == intent]
+        if samples:
+            report["by_intent"][intent] = _summary(samples)
+    return report
+
+
+def print_report(report: Dict):
+    print(f"\n📊 Benchmark {report['endpoint']} (concorrenza {report['concurrency']})")
+    print(f"   Completate: {report['completed']}  Errori: {sum(report['errors'].values())} {report['errors'] or ''}")
+    print(f"   Durata: {report['wall_seconds']}s  Throughput: {report['throughput_rps']} richieste/s")
+    cache = report.get("cache")
+    if cache:
+        print(f"   Cache: {cache['cache_hits']} risposte dalla cache, {cache['coalesced']} accorpate (cache {'attiva' if cache['cache_enabled'] else 'spenta'})")
+        if cache["cache_hits"] or cache["coalesced"]:
+            print("   ⚠️ Le latenze includono risposte non generate: usa OLLAMA_RESPONSE_CACHE_TTL=0 o togli --shared-cache")
+    rows = [("totale", report["latency"])]
+    if "first_token" in report:
+        rows.append(("primo token", report["first_token"]))
+    rows.extend(report["by_intent"].items())
+    print(f"   {'':<24}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, summary in rows:
+        values = "".join(f"{summary[key] if summary[key] is not None else '-':>9}" for key in ("p50", "p95", "p99", "max"))
+        print(f"   {name:<24}{summary['count']:>6}{values}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end di /chat")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="URL del backend FastAPI")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--stream", action="store_true", help="Usa /chat/stream e misura anche il primo token")
+    parser.add_argument("--latency-budget", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=42, help="Seed del mix di messaggi (stesso seed = stesso carico)")
+    parser.add_argument("--shared-cache", action="store_true",
+                        help="Richieste senza session_id: possono usare cache e accorpamento (misura il caso con cache)")
+    parser.add_argument("--json", dest="json_path", help="Salva il report anche in questo file JSON")
+    args = parser.parse_args()
+    
+    report = asyncio.run(run_benchmark(
+        args.url, args.requests, args.concurrency,
+        stream=args.stream, seed=args.seed, latency_budget=args.latency_budget,
+        shared_cache=args.shared_cache
+    ))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Server Ollama finto per benchmark e prove senza GPU né modelli scaricati.
+
+Implementa /api/generate, /api/chat e /api/tags (streaming NDJSON o risposta unica)
+con token al secondo, ritardo del primo token e tempo di caricamento configurabili.
+Avviando più porte si simula un pool di istanze (OLLAMA_URLS).
+
+Uso:
+    python -m app.tools.mock_ollama --port 11434 --port 11435 --tokens-per-second 25 --first-token-delay 0.8
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODELS = ["qwen3:8b", "llama3.2:1b"]
+
+# Testo della risposta finta: abbastanza lungo da coprire num_predict realistici
+REPLY_SENTENCES = [
+    "The Legend of Zelda: Breath of the Wild è un'avventura open world uscita nel 2017 per Nintendo Switch.",
+    "Puoi esplorare Hyrule liberamente, scalare montagne e risolvere i sacrari in qualunque ordine.",
+    "Se cerchi qualcosa di rilassante ti consiglio Animal Crossing: New Horizons.",
+    "Per giocare in compagnia Mario Kart 8 Deluxe resta una delle scelte migliori.",
+    "Super Mario Odyssey offre livelli pieni di segreti e lune da collezionare.",
+    "Metroid Dread riprende l'esplorazione in 2D con un ritmo molto serrato.",
+    "Kirby e la terra perduta è perfetto anche per chi gioca per la prima volta."
+]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _estimate_prompt_tokens(payload: Dict) -> int:
+    if "messages" in payload:
+        text = "".join(str(msg.get("content", "")) for msg in payload.get("messages", []))
+    else:
+        text = str(payload.get("system", "")) + str(payload.get("prompt", ""))
+    # Con context di sessione Ollama valuta solo il nuovo testo
+    return max(1, len(text) // 4)
+
+
+class MockOllama:
+    """Configurazione e contatori condivisi da tutte le porte"""
+    
+    def __init__(self, models: List[str], tokens_per_second: float, first_token_delay: float,
+                 load_delay: float, jitter: float, empty_rate: float, error_rate: float):
+        self.models = models
+        self.tokens_per_second = tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.load_delay = load_delay
+        self.jitter = jitter
+        self.empty_rate = empty_rate
+        self.error_rate = error_rate
+        self._loaded = set()
+        self._lock = threading.Lock()
+        self.requests = 0
+    
+    def _delay(self, seconds: float) -> float:
+        if self.jitter:
+            seconds *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, seconds)
+    
+    def _load(self, port: int, model: str) -> float:
+        # Il primo uso di un modello su una porta paga il caricamento, come in Ollama
+        with self._lock:
+            self.requests += 1
+            key = (port, model)
+            if key in self._loaded:
+                return 0.0
+            self._loaded.add(key)
+        return self.load_delay
+    
+    def generate(self, port: int, payload: Dict, chat: bool) -> Iterator[Dict]:
+        """Chunk della risposta nel formato di Ollama (l'ultimo con done=True e le statistiche)"""
+        model = payload.get("model") or self.models[0]
+        start = time.monotonic()
+        load_seconds = self._load(port, model)
+        time.sleep(load_seconds)
+        
+        options = payload.get("options") or {}
+        num_predict = int(options.get("num_predict") or 256)
+        if num_predict < 0:
+            num_predict = 256
+        words = " ".join(random.sample(REPLY_SENTENCES, len(REPLY_SENTENCES))).split(" ")
+        if random.random() < self.empty_rate:
+            words = []
+        words = words[:num_predict]
+        
+        prompt_tokens = _estimate_prompt_tokens(payload)
+        prompt_seconds = self._delay(self.first_token_delay)
+        time.sleep(prompt_seconds)
+        
+        eval_start = time.monotonic()
+        for index, word in enumerate(words):
+            token = word if index == len(words) - 1 else word + " "
+            chunk = {"model": model, "created_at": _now(), "done": False}
+            if chat:
+                chunk["message"] = {"role": "assistant", "content": token}
+            else:
+                chunk["response"] = token
+            yield chunk
+            time.sleep(self._delay(1.0 / self.tokens_per_second))
+        eval_seconds = time.monotonic() - eval_start
+        
+        final = {
+            "model": model,
+            "created_at": _now(),
+            "done": True,
+            "done_reason": "length" if len(words) == num_predict else "stop",
+            "total_duration": int((time.monotonic() - start) * 1e9),
+            "load_duration": int(load_seconds * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_seconds * 1e9),
+            "eval_count": len(words),
+            "eval_duration": int(eval_seconds * 1e9)
+        }
+        if chat:
+            final["message"] = {"role": "assistant", "content": ""}
+        else:
+            final["response"] = ""
+            # Context finto: token del turno precedente più quelli nuovi
+            final["context"] = list(payload.get("context") or []) + list(range(prompt_tokens + len(words)))
+        yield final
+
+
+def _make_handler(mock: MockOllama, port: int):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def log_message(self, format, *args):
+            logger.debug(f"[{port}] " + format % args)
+        
+        def _send_json(self, status: int, body: Dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_GET(self):
+            if self.path.rstrip("/") == "/api/tags":
+                models = [{"name": name, "model": name, "size": 0, "modified_at": _now()} for name in mock.models]
+                self._send_json(200, {"models": models})
+            elif self.path == "/":
+                body = b"Ollama is running"
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {"error": "not found"})
+        
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._send_json(400, {"error": "invalid JSON"})
+                return
+            
+            path = self.path.rstrip("/")
+            if path not in ("/api/generate", "/api/chat"):
+                self._send_json(404, {"error": "not found"})
+                return
+            model = payload.get("model")
+            if model not in mock.models and f"{model}:latest" not in mock.models:
+                self._send_json(404, {"error": f"model '{model}' not found"})
+                return
+            if random.random() < mock.error_rate:
+                self._send_json(500, {"error": "errore simulato"})
+                return
+            
+            chunks = mock.generate(port, payload, chat=path == "/api/chat")
+            if payload.get("stream", True) is False:
+                text = []
+                final = {}
+                for chunk in chunks:
+                    text.append(chunk["message"]["content"] if "message" in chunk else chunk["response"])
+                    final = chunk
+                if "message" in final:
+                    final["message"]["content"] = "".join(text)
+                else:
+                    final["response"] = "".join(text)
+                self._send_json(200, final)
+                return
+            
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    line = (json.dumps(chunk) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Il client ha chiuso lo stream (deadline o hedging): Ollama smette di generare
+                logger.debug(f"[{port}] Stream interrotto dal client")
+    
+    return Handler
+
+
+def serve(mock: MockOllama, host: str, ports: List[int]) -> List[ThreadingHTTPServer]:
+    """Avvia un server per porta in thread separati"""
+    servers = []
+    for port in ports:
+        server = ThreadingHTTPServer((host, port), _make_handler(mock, port))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        logger.info(f"🧪 Mock Ollama in ascolto su http://{host}:{port}")
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server Ollama finto per benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, action="append", help="Porta (ripetibile per simulare più istanze)")
+    parser.add_argument("--model", action="append", help="Modelli installati (default: qwen3:8b e llama3.2:1b)")
+    parser.add_argument("--tokens-per-second", type=float, default=25.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.5, help="Secondi di prompt eval prima del primo token")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="Secondi di caricamento al primo uso di un modello")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Variazione relativa dei ritardi (0-1)")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="Frazione di risposte vuote")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Frazione di errori HTTP 500")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    mock = MockOllama(
+        models=args.model or DEFAULT_MODELS,
+        tokens_per_second=args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        load_delay=args.load_delay,
+        jitter=args.jitter,
+        empty_rate=args.empty_rate,
+        error_rate=args.error_rate
+    )
+    servers = serve(mock, args.host, args.port or [11434])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ import logging
 from typing import Dict, List, Optional
 import wikipediaapi
 
+from app.engine.tracing import traced
+
 logger = logging.getLogger(__name__)
 
 
@@ -32,6 +34,7 @@ class WikiAgent:
         )
         logger.info(f"WikiAgent initialized for language: {lang}")
     
+    @traced("wikipedia")
     def search(self, query: str) -> List[str]:
         """
         Search Wikipedia for pages matching the query.
@@ -51,6 +54,7 @@ class WikiAgent:
             logger.error(f"Error searching Wikipedia: {e}")
             return []
     
+    @traced("wikipedia")
     def get_page(self, title: str) -> Dict:
         """
         Get full page content from Wikipedia.
@@ -267,6 +271,7 @@ class WikiAgent:
             logger.error(f"Error answering question '{question}': {e}")
             return {"error": "no_results"}
     
+    @traced("wikipedia")
     def answer_multilang(self, question: str) -> Dict:
         """
         Answer a natural language question using both Italian and English Wikipedia.
@@ -1,4 +1,5 @@
 from typing import List, Dict, Any
+from app.engine.tracing import traced
 
 def sanitize_user_input(text: str) -> str:
     """
@@ -19,6 +20,7 @@ def sanitize_user_input(text: str) -> str:
     
     return text
 
+@traced("intent")
 def classify_intent(user_message: str) -> str:
     message_lower = user_message.lower()
     
@@ -0,0 +1,54 @@
+import copy
+import os
+import tempfile
+import unittest
+
+from app.services.memory_backends import SqliteMemoryBackend
+
+
+class SqliteMemoryBackendConcurrencyTest(unittest.TestCase):
+    """Due worker sullo stesso database che partono dallo stesso profilo"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "memory.sqlite3")
+        self.worker_a = SqliteMemoryBackend(path)
+        self.worker_b = SqliteMemoryBackend(path)
+    
+    def tearDown(self):
+        self.tmp.cleanup()
+    
+    def test_same_new_titles_saved_by_two_workers(self):
+        base, version = self.worker_a.load("user")
+        after = copy.deepcopy(base)
+        after["mentioned_games"] = ["zelda"]
+        after["favorites"] = [{"title": "Zelda", "platform": "Switch", "description": "", "timestamp": "t"}]
+        after["provided_info"] = [{"title": "Zelda", "platform": "Switch", "description": "", "timestamp": "t"}]
+        
+        self.assertEqual(self.worker_a.save("user", base, after, version), 1)
+        # Prima falliva con UNIQUE constraint failed: la riga c'era già
+        self.assertEqual(self.worker_b.save("user", base, after, version), 2)
+        
+        memory, version = self.worker_a.load("user")
+        self.assertEqual(version, 2)
+        self.assertEqual(memory["mentioned_games"], ["zelda"])
+        self.assertEqual([item["title"] for item in memory["favorites"]], ["Zelda"])
+        self.assertEqual([item["title"] for item in memory["provided_info"]], ["Zelda"])
+    
+    def test_new_title_from_other_worker_goes_to_the_end(self):
+        base, version = self.worker_a.load("user")
+        first = copy.deepcopy(base)
+        first["mentioned_games"] = ["zelda", "mario"]
+        self.worker_a.save("user", base, first, version)
+        
+        # Il worker B non ha visto la scrittura di A e aggiunge anche lui "zelda"
+        second = copy.deepcopy(base)
+        second["mentioned_games"] = ["kirby", "zelda"]
+        self.worker_b.save("user", base, second, version)
+        
+        memory, _ = self.worker_a.load("user")
+        self.assertEqual(memory["mentioned_games"], ["mario", "kirby", "zelda"])
+
+
+if __name__ == "__main__":
+    unittest.main()